@@ -2,6 +2,9 @@ import zlib
 import base64
 from enum import Enum
 from collections import defaultdict
+from typing import Optional
+
+from server.inflate import check_encoded_size, inflate
 
 # Define the reserved keywords
 simple_reserved_keywords = {
@@ -26,7 +29,7 @@ simple_reserved_keywords = {
     "vertical-gap",
     "horizontal-gap",
     "class",
-    "line"
+    "line",
     "vars",
 }
 
@@ -83,8 +86,6 @@ for keyword in sorted(reserved_keywords):
 
 #-><--<->3danimatedboldborder-radiusbottomclassclassesconstraintdescdirectiondouble-borderfillfill-patternfilledfontfont-colorfont-sizegrid-columnsgrid-gapgrid-rowsheighthorizontal-gapiconitaliclabellayersleftlinevarslinkmultiplenearopacityrightscenariosshadowshapesource-arrowheadstepsstrokestroke-dashstroke-widthstyletarget-arrowheadtext-transformtooltiptopunderlinevertical-gapwidth
 
-print("Compression dictionary:", compression_dict)
-
 compression_dict = "-><---<->3danimatedboldborder-radiusclassclassesconstraintdescdirectiondouble-borderfillfill-patternfilledfontfont-colorfont-sizegrid-columnsgrid-gapgrid-rowsheighthorizontal-gapiconitaliclabellayersleftlinkmultiplenearopacityscenariosshadowshapesource-arrowheadstepsstrokestroke-dashstroke-widthstyletarget-arrowheadtext-transformtooltiptopunderlinevarsvertical-gapwidth"
 
 class Layout(Enum):
@@ -110,13 +111,15 @@ def encode(raw: str) -> str:
 
     return encoded_bytes.decode('utf-8')
 
-def decode(encoded: str) -> str:
+def decode(encoded: str, max_length: Optional[int] = None) -> str:
+    # Reject scripts too long to fit the output budget before decoding them
+    check_encoded_size(len(encoded), max_length, ratio=4 / 3)
+
     # Decode the base64 string to bytes
     encoded_bytes = base64.urlsafe_b64decode(encoded)
 
-    # Decompress the bytes using the compression dictionary
-    decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS, zdict=compression_dict.encode('utf-8'))
-    decompressed_bytes = decompressor.decompress(encoded_bytes) + decompressor.flush()
+    # Decompress the bytes using the compression dictionary, at most max_length bytes
+    decompressed_bytes = inflate(encoded_bytes, -zlib.MAX_WBITS, compression_dict.encode('utf-8'), max_length)
 
     return decompressed_bytes.decode('utf-8')
 
@@ -125,6 +128,7 @@ def generate_d2graphviz_url(edge_def, layout=Layout.DAGRE, theme=Theme.DEFAULT):
     return f"https://play.d2lang.com/?script={encoded_edge_def}&layout={layout.value}&theme={theme.value}"
 
 if __name__ == "__main__":
+    print("Compression dictionary:", compression_dict)
     edge_def = """
 timeline mixer: "" {
   explanation: |md
@@ -2,24 +2,41 @@ import asyncio
 import logging
 import os
 
-logging.basicConfig(level=logging.INFO)
+from server import deadline
+
 logger = logging.getLogger(__name__)
 
+# Seconds the encoder may run outside a request deadline
+DEFAULT_TIMEOUT = 10.0
+
 async def run_go_script(input_data: str):
+    left = deadline.remaining()
+    if left is not None and left <= 0:
+        # Starting the encoder only to kill it at once would waste a process
+        raise asyncio.TimeoutError("Request deadline exceeded before encoding")
     try:
-        print("Running go script")
         process = await asyncio.create_subprocess_exec(
             './D2/main', 'encode', input_data,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await process.communicate()
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), DEFAULT_TIMEOUT if left is None else left)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Never leave the encoder running past the deadline or a disconnect
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
         if process.returncode != 0:
-            logger.error(f"Go script execution failed with error: {stderr.decode()}")
+            logger.error("Go script execution failed with error: %s", stderr.decode())
             return None
-        logger.info(f"Go script run succeeded with output: {stdout.decode()}")
+        logger.debug("Go script run succeeded", extra={"input_size": len(input_data), "output_size": len(stdout)})
         theme = "0"
         layout = "elk" or "dagre"
         return f"https://api.d2lang.com/render/svg?script={stdout.decode().strip()}&layout={layout}&theme={theme}&sketch=0", input_data, f"https://play.d2lang.com/?script={stdout.decode().strip()}&layout={layout}&theme={theme}"
+    except asyncio.TimeoutError:
+        # A deadline is the caller's to answer (504), not an encoder failure
+        raise
     except Exception as e:
-        logger.error(f"Go script execution failed with error: {str(e)}")
-        return None
\ No newline at end of file
+        logger.error("Go script execution failed with error: %s", e)
+        return None
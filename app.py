@@ -1,16 +1,70 @@
+import asyncio
 import logging
 import os
 import subprocess
+import math
+import time
+import zlib
+from contextlib import asynccontextmanager, nullcontext
+from typing import Optional
 from pydantic import BaseModel, field_validator
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request, Response, WebSocket
 from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from plantuml import PlantUML
+from plantuml import PlantUML, PlantUMLHTTPError, plantuml_encode
+from plantuml.includes import IncludeResolver
+from plantuml.pages import page_count
 from mermaid.mermaid import generate_diagram_state, generate_mermaid_live_editor_url
-from kroki.kroki import generate_diagram as generate_kroki_diagram, LANGUAGE_OUTPUT_SUPPORT as KROKI_LANGUAGE_SUPPORT
+from kroki.kroki import Kroki, KrokiError, LANGUAGE_OUTPUT_SUPPORT as KROKI_LANGUAGE_SUPPORT
+from validation import DiagramSyntaxError, validate_source
+from graph import GRAPH_LANGS, Graph, GraphError, check_graph, compile_graph
+from cli.migrate import decode_url
+from server.logs import configure_logging
+from server.profiling import ProfilingMiddleware, check_admin_token
+from server.memory import MemoryTracer
+from server import timing
+from server.timing import ServerTimingMiddleware
+from server.deadline import DeadlineMiddleware
+from server.inflate import DecodeLimitExceeded
+from server.jobs import JobFailed, JobRunner, JobStore
+from server.ratelimit import CostExceedsCapacity, RateLimitExceeded, client_key, limiter_from_env
+from server.cache import NegativeCache, SharedCache, cache_key
+from server.preview import DEFAULT_DEBOUNCE, PreviewSession
+from server.fastjson import FastJSONRoute
+from server.artifacts import ArtifactOptimizer, can_convert
+from server.pool import (UNIX_SCHEME, apreconnect, close_shared_async_client, close_shared_client, preconnect,
+                         resolve_url, shared_async_client, shared_client, upstream_urls)
+from server.results import DiagramResult, parse_fields
+from server.scheduler import Scheduler, estimate_cost
+from server.warmup import HotDiagrams, load_manifest
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up in the background (see ``/ready``) and persist state on shutdown."""
+    app.state.ready = False
+    warmup = asyncio.create_task(warm_up(app))
+    app.state.job_runner = JobRunner.from_env(app.state.jobs, render_job)
+    if app.state.job_runner is not None:
+        app.state.job_runner.start()
+    try:
+        yield
+    finally:
+        warmup.cancel()
+        if app.state.job_runner is not None:
+            await app.state.job_runner.close()
+        manifest = os.environ.get("WARMUP_MANIFEST")
+        if manifest and app.state.hot_diagrams is not None:
+            try:
+                app.state.hot_diagrams.save(manifest)
+            except OSError as e:
+                logger.warning("Could not write the warm-up manifest: %s", e)
+        app.state.artifacts.close()
+        close_shared_client()
+        await close_shared_async_client()
 
 app = FastAPI(
+    lifespan=lifespan,
     title="GPT Plugin Diagrams",
     description="This plugin generates diagrams from text using GPT-4.",
     version="1.1.2",
@@ -21,10 +75,8 @@ app = FastAPI(
 
 app.mount("/.well-known", StaticFiles(directory=".well-known"), name="static")
 
-# Add logging configuration
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# Structured JSON logging through a background queue listener (see server/logs.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 origins = [
@@ -36,13 +88,104 @@ origins = [
     "devtools"
 ]
 
+# Innermost: a 504 on deadline still gets CORS and Server-Timing headers (see server/deadline.py)
+app.add_middleware(DeadlineMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["GET", "POST", "OPTIONS", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
+# Token buckets per caller and per upstream service (see server/ratelimit.py)
+app.state.client_limiter = limiter_from_env("client", "20/40")
+app.state.upstream_limiter = limiter_from_env("upstream", "50/100")
+
+# Successful renders, shared by all workers when RENDER_CACHE_PATH is set (see server/cache.py)
+app.state.render_cache = SharedCache.from_env()
+# Sources the upstream rejected, answered with the same 400 for NEGATIVE_CACHE_TTL seconds
+app.state.failures = NegativeCache.from_env(app.state.render_cache)
+
+# Most requested diagrams, primed into the caches at the next startup (see server/warmup.py)
+app.state.hot_diagrams = HotDiagrams.from_env() if os.environ.get("WARMUP_MANIFEST") else None
+
+# Shortest-job-first slots in front of the backends (see server/scheduler.py)
+app.state.scheduler = Scheduler.from_env()
+
+# Render jobs submitted with POST /jobs, shared by the workers of the host (see server/jobs.py)
+app.state.jobs = JobStore.from_env()
+app.state.job_runner = None
+
+# tracemalloc snapshots behind /admin/memory (see server/memory.py)
+app.state.memory = MemoryTracer()
+
+# Local !include inlining from PLANTUML_INCLUDE_DIRS (see plantuml/includes.py)
+plantuml_includes = IncludeResolver.from_env()
+
+# SVG minification / PNG re-compression of fetched images (see server/artifacts.py)
+app.state.artifacts = ArtifactOptimizer.from_env()
+
+
+def upstream_for(lang: str) -> str:
+    """Name of the upstream service whose quota fetching a diagram consumes."""
+    # Images of every other language, Mermaid included, come from Kroki (see fetch_artifact)
+    return "plantuml" if lang == "plantuml" else "kroki"
+
+
+def upstream_requests(diagram: "DiagramRequest") -> int:
+    """Upstream calls :func:`render_diagram` makes: one per page of a PlantUML document,
+    none for the other languages, whose links are built locally.
+
+    Raises:
+        HTTPException: 413 when the document has more than ``PLANTUML_MAX_PAGES`` pages
+    """
+    if diagram.lang != "plantuml":
+        return 0
+    code = plantuml_includes.inline(diagram.code) if plantuml_includes is not None else diagram.code
+    pages = page_count(code)
+    if pages > PLANTUML_MAX_PAGES:
+        raise HTTPException(status_code=413, detail=f"The document has {pages} pages, at most {PLANTUML_MAX_PAGES} are rendered.")
+    return pages
+
+
+def scheduled(state, diagram: "DiagramRequest", output_format: str = "svg", requests: int = 1):
+    """A scheduler slot sized for ``diagram`` (``requests`` upstream calls), to hold while its backend works."""
+    scheduler = state.scheduler
+    if scheduler is None:
+        return nullcontext()
+    # The server parses the whole document for each page it renders
+    return scheduler.slot(estimate_cost(diagram.lang, len(diagram.code), output_format) * max(requests, 1))
+
+
+async def admit(limiter, key: str, cost: int = 1) -> None:
+    """Wait for ``cost`` tokens from ``limiter`` or answer 429 with Retry-After
+    (413 when no wait could ever gather that many)."""
+    if limiter is None:
+        return
+    try:
+        await limiter.acquire(key, cost)
+    except CostExceedsCapacity:
+        raise HTTPException(status_code=413, detail="The request needs more upstream calls than the rate limit allows.")
+    except RateLimitExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests.",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+
+VALID_LANGS = [
+    "plantuml", "mermaid", "mermaidjs", "d2lang", "D2", "d2", "terrastruct", "graphviz",
+    "blockdiag", "bpmn", "bytefield", "seqdiag", "actdiag", "nwdiag", 
+    "packetdiag", "rackdiag", "c4plantuml", "dbml", "ditaa", "erd", 
+    "excalidraw", "nomnoml", "pikchr", "structurizr", "svgbob", 
+    "symbolator", "tikz", "umlet", "vega", "vegalite", "wavedrom", "wireviz"
+]
+
+D2_LANGS = ["d2lang", "D2", "d2", "terrastruct"]
 
 class DiagramRequest(BaseModel):
     lang: str
@@ -53,14 +196,7 @@ class DiagramRequest(BaseModel):
     @field_validator("lang")
     @classmethod
     def validate_lang(cls, v: str) -> str:
-        valid_langs = [
-            "plantuml", "mermaid", "mermaidjs", "d2lang", "D2", "d2", "terrastruct", "graphviz",
-            "blockdiag", "bpmn", "bytefield", "seqdiag", "actdiag", "nwdiag", 
-            "packetdiag", "rackdiag", "c4plantuml", "dbml", "ditaa", "erd", 
-            "excalidraw", "nomnoml", "pikchr", "structurizr", "svgbob", 
-            "symbolator", "tikz", "umlet", "vega", "vegalite", "wavedrom", "wireviz"
-        ]
-        if v not in valid_langs:
+        if v not in VALID_LANGS:
             raise ValueError(f"Invalid diagram language: {v}")
         return v
 
@@ -69,7 +205,7 @@ class DiagramRequest(BaseModel):
     def validate_type(cls, v: str) -> str:
         valid_types = ["class", "sequence", "activity", "component", "state", "object", "usecase", "mindmap", "git", "gantt"]
         if v not in valid_types:
-            logger.error(f"Invalid diagram type: {v}")
+            logger.error("Invalid diagram type: %s", v)
         return v
 
     @field_validator("code")
@@ -79,56 +215,485 @@ class DiagramRequest(BaseModel):
             raise ValueError("Diagram code is too long.")
         return v
 
-@app.post("/generate_diagram")
-async def generate_diagram_endpoint(diagram: DiagramRequest):
-    logger.info(f"Received request to generate a {diagram.lang} diagram.")
+# Servers images are fetched from; sidecars may be given as unix:///path.sock (see server/pool.py)
+PUBLIC_PLANTUML_SERVER = "https://www.plantuml.com/plantuml"
+PLANTUML_SERVER = os.environ.get("PLANTUML_URL", PUBLIC_PLANTUML_SERVER).rstrip("/")
+KROKI_SERVER = os.environ.get("KROKI_URL", "https://kroki.io")
+# Pages of one PlantUML document fetched at once
+PLANTUML_PAGE_CONCURRENCY = int(os.environ.get("PLANTUML_PAGE_CONCURRENCY", "4"))
+# Longer PlantUML documents are refused (413)
+PLANTUML_MAX_PAGES = int(os.environ.get("PLANTUML_MAX_PAGES", "100"))
+
+def plantuml_link(url: str) -> str:
+    """The link to hand out for an image URL of PLANTUML_SERVER; a socket is only reachable from here."""
+    if PLANTUML_SERVER.startswith(UNIX_SCHEME):
+        return PUBLIC_PLANTUML_SERVER + url[len(resolve_url(PLANTUML_SERVER)):]
+    return url
+
+def plantuml_playground(url: str) -> str:
+    return f"https://www.plantuml.com/plantuml/uml/{url.split('/')[-1]}"
+
+async def render_diagram(diagram: DiagramRequest) -> DiagramResult:
+    """Dispatch a validated request to its backend; playground links are only built when read."""
+    code = str(diagram.code)
+    if diagram.lang in ["plantuml"]:
+        if not diagram.theme:
+            diagram.theme = "blueprint"
+        plantuml = PlantUML(url=f"{PLANTUML_SERVER}/dpng", client=shared_client(), includes=plantuml_includes)
+        # Every page of a multi-page document is fetched at once
+        pages = await plantuml.render_pages(code, shared_async_client(), PLANTUML_PAGE_CONCURRENCY)
+        results = [DiagramResult(plantuml_link(url), code, lambda url=url: plantuml_playground(url)) for url, _ in pages]
+        return DiagramResult(results[0].url, code, lambda: results[0].playground,
+                             pages=results if len(results) > 1 else None)
+    elif diagram.lang in ["mermaid", "mermaidjs"]:
+        if not diagram.theme:
+            diagram.theme = "dark"
+        # URL and playground share one serialized state
+        diagram_state = generate_diagram_state(code, str(diagram.theme))
+        url, content, playground = generate_mermaid_live_editor_url(diagram_state)
+        if url is None:
+            raise HTTPException(status_code=400, detail="Invalid Mermaid syntax.")
+        return DiagramResult(url, content, playground)
+    elif diagram.lang in D2_LANGS or diagram.lang in KROKI_LANGUAGE_SUPPORT:
+        kroki_type = "d2" if diagram.lang in D2_LANGS else diagram.lang
+        kroki = Kroki(client=shared_client(), includes=plantuml_includes)
+        return DiagramResult(lambda: kroki.get_url(kroki_type, code, "svg"), code,
+                             lambda: kroki.get_playground_url(kroki_type, code) or "")
+    else:
+        raise HTTPException(status_code=422, detail=f"Unknown diagram type: {diagram.lang}")
+
+def check_diagram(diagram: DiagramRequest) -> None:
+    """Reject empty fields and sources the offline validators flag."""
     if not diagram.code:
         raise HTTPException(status_code=422, detail="No diagram code provided.")
     if not diagram.lang:
         raise HTTPException(status_code=422, detail="No diagram language provided.")
     if not diagram.type:
         raise HTTPException(status_code=422, detail="No diagram type provided.")
-    logger.info(f"A request was made to generate a {diagram.lang} diagram.")
     try:
-        if diagram.lang in ["plantuml"]:
-            if not diagram.theme:
-                diagram.theme = "blueprint"
-            logger.info("Generating PlantUML diagram.")
-            plantuml = PlantUML(url="https://www.plantuml.com/plantuml/dpng")
-            url, content, playground = plantuml.generate_image_from_string(str(diagram.code))
-            print(url)
-            print(content)
-            if url is None:
-                raise HTTPException(status_code=400, detail="Invalid PlantUML syntax.")
-            return {"url": url, "content": content, "playground": playground}
-        elif diagram.lang in ["mermaid", "mermaidjs"]:
-            if not diagram.theme:
-                diagram.theme = "dark"
-            logger.info("Generating Mermaid diagram.")
-            diagram_state = generate_diagram_state(str(diagram.code), str(diagram.theme))
-            url, content, playground = generate_mermaid_live_editor_url(diagram_state)
-            if url is None:
-                raise HTTPException(status_code=400, detail="Invalid Mermaid syntax.")
-            return {"url": url, "content": content, "playground": playground}
-        elif diagram.lang in ["d2lang", "D2", "d2", "terrastruct"]:
-            logger.info(f"Generating D2 diagram via Kroki ({diagram.lang}).")
-            output_format = "svg"
-            url, content, playground = await generate_kroki_diagram(
-                "d2", str(diagram.code), output_format
-            )
-            return {"url": url, "content": content, "playground": playground}
-        elif diagram.lang in KROKI_LANGUAGE_SUPPORT:
-            logger.info(f"Generating Kroki diagram ({diagram.lang}).")
-            output_format = "svg"
-            url, content, playground = await generate_kroki_diagram(diagram.lang, str(diagram.code), output_format)
-            return {"url": url, "content": content, "playground": playground}
-        else:
-            raise HTTPException(status_code=422, detail=f"Unknown diagram type: {diagram.lang}")
+        with timing.phase("validation"):
+            validate_source(diagram.lang, diagram.code)
+    except DiagramSyntaxError as e:
+        raise HTTPException(status_code=400, detail=e.to_dict())
+
+def upstream_syntax_error(e: Exception) -> Optional[DiagramSyntaxError]:
+    """The error an upstream reported when it rejected the source itself, if any."""
+    message = getattr(e, "diagram_error", None)
+    if not message:
+        return None
+    # Upstreams report a line at most, and not always
+    line = getattr(e, "diagram_error_line", None)
+    return DiagramSyntaxError(message, line, 1 if line is not None else None)
+
+def check_failures(state, key: bytes) -> None:
+    """Answer 400 right away when the upstream rejected this source recently."""
+    failures = state.failures
+    error = failures.get(key) if failures is not None else None
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+
+def reject_upstream_error(state, key: bytes, e: Exception) -> None:
+    """Turn an upstream rejection of the source into a 400, remembered for retries."""
+    error = upstream_syntax_error(e)
+    if error is None:
+        return
+    if state.failures is not None:
+        state.failures.set(key, error.to_dict())
+    raise HTTPException(status_code=400, detail=error.to_dict())
+
+ARTIFACT_MEDIA_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "pdf": "application/pdf",
+    "jpeg": "image/jpeg",
+    "txt": "text/plain",
+}
+
+def render_key(diagram: DiagramRequest) -> bytes:
+    """Render cache key; PlantUML sources are keyed with their includes inlined."""
+    code = diagram.code
+    if plantuml_includes is not None and diagram.lang in ("plantuml", "c4plantuml"):
+        code = plantuml_includes.inline(code)
+    return cache_key(diagram.lang, diagram.theme, code)
+
+# Formats the public PlantUML server renders itself
+PLANTUML_FORMATS = ["png", "svg", "txt"]
+
+def kroki_lang(lang: str) -> str:
+    if lang in D2_LANGS:
+        return "d2"
+    if lang == "mermaidjs":
+        return "mermaid"
+    return lang
+
+def native_formats(lang: str) -> list:
+    """Output formats the upstream of ``lang`` can produce."""
+    if lang == "plantuml":
+        return PLANTUML_FORMATS
+    return KROKI_LANGUAGE_SUPPORT.get(kroki_lang(lang), [])
+
+def check_format(diagram: DiagramRequest, output_format: str) -> None:
+    """Answer 422 for unknown formats and 501 for ones ``diagram`` cannot be rendered as."""
+    if output_format not in ARTIFACT_MEDIA_TYPES:
+        raise HTTPException(status_code=422, detail=f"Unknown output format: {output_format}")
+    check_diagram(diagram)
+    if output_format not in native_formats(diagram.lang):
+        if "svg" not in native_formats(diagram.lang) or not can_convert(output_format):
+            raise HTTPException(status_code=501, detail=f"{diagram.lang} cannot be rendered as {output_format} on this server.")
+
+def fetch_artifact(diagram: DiagramRequest, output_format: str) -> bytes:
+    """Fetch the rendered image from PlantUML or Kroki (blocking)."""
+    if diagram.lang == "plantuml":
+        return PlantUML(url=f"{PLANTUML_SERVER}/{output_format}", client=shared_client(), includes=plantuml_includes).render(diagram.code)
+    return Kroki(KROKI_SERVER, client=shared_client(), includes=plantuml_includes).render_diagram(kroki_lang(diagram.lang), diagram.code, output_format)
+
+async def artifact_for(state, diagram: DiagramRequest, output_format: str) -> bytes:
+    """
+    Return the optimized artifact, fetching it upstream at most once.
+
+    Formats the upstream lacks are converted locally from its SVG, so asking
+    for several of them costs a single upstream call.
+    """
+    artifacts = state.artifacts
+    # Keyed by the inlined source, so editing an included file is a miss
+    key = cache_key("artifact", render_key(diagram).hex(), output_format)
+    data = artifacts.get(key)
+    if data is not None:
+        return data
+    if output_format in native_formats(diagram.lang):
+        await admit(state.upstream_limiter, f"upstream:{upstream_for(diagram.lang)}")
+        async with scheduled(state, diagram, output_format):
+            data = await asyncio.to_thread(fetch_artifact, diagram, output_format)
+        with timing.phase("optimize"):
+            data = await artifacts.optimize(data, output_format)
+    else:
+        svg = await artifact_for(state, diagram, "svg")
+        with timing.phase("convert"):
+            data = await artifacts.convert(svg, output_format)
+    artifacts.put(key, data)
+    return data
+
+# msgspec/orjson fast path with pydantic fallback (see server/fastjson.py)
+diagram_router = APIRouter(route_class=FastJSONRoute)
+
+@diagram_router.post("/generate_diagram")
+async def generate_diagram_endpoint(diagram: DiagramRequest, request: Request, fields: Optional[str] = Query(
+        None, description="Comma separated subset of url, content and playground to return (default: all)")):
+    timing.mark("endpoint")
+    await admit(request.app.state.client_limiter, client_key(request.headers, request.client and request.client.host))
+    started = time.perf_counter()
+    log_fields = {"lang": diagram.lang, "code_size": len(diagram.code)}
+    try:
+        selected = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    check_diagram(diagram)
+    if request.app.state.hot_diagrams is not None:
+        request.app.state.hot_diagrams.record(diagram.lang, diagram.type, diagram.code, diagram.theme)
+    cache = request.app.state.render_cache
+    source_key = render_key(diagram)
+    # Partial bodies are cached apart from full ones
+    key = source_key if selected is None else cache_key(source_key.hex(), *selected)
+    try:
+        result = cache.get(key)
+        log_fields["cached"] = result is not None
+        if result is None:
+            check_failures(request.app.state, source_key)
+            requests = upstream_requests(diagram)
+            if requests:
+                await admit(request.app.state.upstream_limiter, f"upstream:{upstream_for(diagram.lang)}", requests)
+            try:
+                async with scheduled(request.app.state, diagram, requests=requests):
+                    result = (await render_diagram(diagram)).to_dict(selected)
+            except (PlantUMLHTTPError, KrokiError) as e:
+                reject_upstream_error(request.app.state, source_key, e)
+                raise
+            cache.set(key, result)
+        return result
     except HTTPException as e:
         raise e
     except Exception as e:
-        logger.error(f"Error generating {diagram.lang} diagram: {str(e)}")
+        logger.error("Diagram generation failed", extra={**log_fields, "error": type(e).__name__})
         return {"error": "An error occurred while generating the diagram."}
+    finally:
+        timing.mark("endpoint_done")
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info("Diagram request handled", extra={**log_fields, "duration_ms": duration_ms})
+
+@diagram_router.post("/render_diagram", response_class=Response, responses={
+    200: {"content": {media_type: {} for media_type in ARTIFACT_MEDIA_TYPES.values()}},
+})
+async def render_diagram_endpoint(diagram: DiagramRequest, request: Request, output_format: str = Query("svg", alias="format")):
+    """Render the diagram upstream (or convert its SVG locally) and return the optimized image."""
+    timing.mark("endpoint")
+    await admit(request.app.state.client_limiter, client_key(request.headers, request.client and request.client.host))
+    check_format(diagram, output_format)
+    source_key = render_key(diagram)
+    check_failures(request.app.state, source_key)
+    try:
+        data = await artifact_for(request.app.state, diagram, output_format)
+    except (PlantUMLHTTPError, KrokiError) as e:
+        reject_upstream_error(request.app.state, source_key, e)
+        logger.error("Artifact fetch failed", extra={"lang": diagram.lang, "error": type(e).__name__})
+        raise HTTPException(status_code=502, detail="The diagram server returned an error.")
+    timing.mark("endpoint_done")
+    return Response(content=data, media_type=ARTIFACT_MEDIA_TYPES[output_format])
+
+def job_view(job: dict) -> dict:
+    """What ``/jobs`` tells the submitter about a job."""
+    view = {"id": job["id"], "status": job["status"]}
+    if job["result"] is not None:
+        view["result"] = job["result"]
+        view["artifact"] = f"/jobs/{job['id']}/artifact"
+    if job["error"] is not None:
+        view["error"] = job["error"]
+    return view
+
+@diagram_router.post("/jobs", status_code=202)
+async def submit_job_endpoint(diagram: DiagramRequest, request: Request, response: Response,
+                              output_format: str = Query("svg", alias="format")):
+    """Queue the diagram for rendering and return the job id at once; poll ``GET /jobs/{id}``."""
+    await admit(request.app.state.client_limiter, client_key(request.headers, request.client and request.client.host))
+    check_format(diagram, output_format)
+    content_hash = cache_key("job", render_key(diagram).hex(), output_format).hex()
+    job, created = await asyncio.to_thread(
+        request.app.state.jobs.submit, content_hash, {"diagram": diagram.model_dump(), "format": output_format})
+    if created and request.app.state.job_runner is not None:
+        request.app.state.job_runner.wake()
+    if job["status"] == "done":
+        response.status_code = 200
+    return job_view(job)
+
+# Seconds a render job may spend waiting out upstream rate limits before it fails
+JOBS_MAX_THROTTLED = float(os.environ.get("JOBS_MAX_THROTTLED", "300"))
+
+async def render_job(job_request: dict):
+    """Render a queued job: the ``/generate_diagram`` result plus the image in the job's format."""
+    diagram = DiagramRequest(**job_request["diagram"])
+    waited = 0.0
+    while True:
+        try:
+            return await render_job_once(diagram, job_request["format"])
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise JobFailed(e.detail if isinstance(e.detail, dict) else {"message": e.detail})
+            # Jobs wait out the upstream quota instead of failing, for a while
+            retry_after = float(e.headers["Retry-After"])
+            if waited + retry_after > JOBS_MAX_THROTTLED:
+                raise JobFailed({"message": "The upstream rate limit kept the job from running."})
+            await asyncio.sleep(retry_after)
+            waited += retry_after
+
+async def render_job_once(diagram: DiagramRequest, output_format: str):
+    state = app.state
+    source_key = render_key(diagram)
+    check_failures(state, source_key)
+    try:
+        result = state.render_cache.get(source_key)
+        if result is None:
+            requests = upstream_requests(diagram)
+            if requests:
+                await admit(state.upstream_limiter, f"upstream:{upstream_for(diagram.lang)}", requests)
+            async with scheduled(state, diagram, requests=requests):
+                result = (await render_diagram(diagram)).to_dict()
+            state.render_cache.set(source_key, result)
+        return result, await artifact_for(state, diagram, output_format)
+    except (PlantUMLHTTPError, KrokiError) as e:
+        reject_upstream_error(state, source_key, e)
+        raise
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Status of a render job, with its result once done."""
+    job = await asyncio.to_thread(app.state.jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return job_view(job)
+
+@app.get("/jobs/{job_id}/artifact", response_class=Response)
+async def job_artifact(job_id: str):
+    """The image rendered by a finished job."""
+    job = await asyncio.to_thread(app.state.jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    data = await asyncio.to_thread(app.state.jobs.artifact, job_id)
+    if data is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
+    return Response(content=data, media_type=ARTIFACT_MEDIA_TYPES[job["request"]["format"]])
+
+app.include_router(diagram_router)
+
+async def warm_up(app: FastAPI) -> None:
+    """Pre-connect the upstreams and prime the render cache, then report ready."""
+    started = time.perf_counter()
+    primed = 0
+    try:
+        connections = int(os.environ.get("WARMUP_CONNECTIONS", "2"))
+        # The sync pool serves artifacts, the loop's async client the PlantUML pages
+        await asyncio.gather(*(asyncio.to_thread(preconnect, url, connections) for url in upstream_urls()),
+                             *(apreconnect(url, connections) for url in upstream_urls()))
+        manifest = os.environ.get("WARMUP_MANIFEST")
+        if manifest:
+            cache = app.state.render_cache
+            semaphore = asyncio.Semaphore(8)
+
+            async def prime(entry: dict) -> bool:
+                async with semaphore:
+                    try:
+                        diagram = DiagramRequest(**entry)
+                        check_diagram(diagram)
+                        key = render_key(diagram)
+                        if cache.get(key) is None:
+                            cache.set(key, (await render_diagram(diagram)).to_dict())
+                        return True
+                    except Exception as e:
+                        logger.warning("Could not prime a %s diagram: %s", entry.get("lang"), e)
+                        return False
+
+            entries = load_manifest(manifest, int(os.environ.get("WARMUP_TOP_N", "50")))
+            primed = sum(await asyncio.gather(*(prime(entry) for entry in entries)))
+    finally:
+        app.state.ready = True
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info("Warm-up finished", extra={"primed": primed, "duration_ms": duration_ms})
+
+def render_graph(graph: Graph, lang: str, output_format: str) -> DiagramResult:
+    """Kroki URL of a compiled graph, streamed into the compressor; the source is only joined when read."""
+    kroki = Kroki(client=shared_client())
+    with timing.phase("encode"):
+        data, checksum = kroki.deflate_stream(compile_graph(graph, lang))
+        url = kroki.get_deflated_url(lang, data, checksum, output_format)
+    source = []
+
+    def content() -> str:
+        if not source:
+            source.append("".join(compile_graph(graph, lang)))
+        return source[0]
+
+    if lang == "plantuml":
+        # Same deflate data in the PlantUML alphabet
+        return DiagramResult(url, content, lambda: plantuml_playground(plantuml_encode(data)))
+    return DiagramResult(url, content, lambda: kroki.get_playground_url(lang, content()) or "")
+
+@app.post("/compile_graph")
+async def compile_graph_endpoint(graph: Graph, request: Request,
+                                 lang: str = Query("d2", description="Target language: d2, mermaid or plantuml"),
+                                 output_format: str = Query("svg", alias="format"), fields: Optional[str] = Query(
+        None, description="Comma separated subset of url, content and playground to return (default: all)")):
+    """Compile a structured graph (nodes, edges, groups, styles) into diagram source and its Kroki URL."""
+    await admit(request.app.state.client_limiter, client_key(request.headers, request.client and request.client.host))
+    try:
+        selected = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if lang not in GRAPH_LANGS:
+        raise HTTPException(status_code=422, detail=f"Cannot compile graphs to {lang}. Choose from {', '.join(GRAPH_LANGS)}.")
+    if output_format not in KROKI_LANGUAGE_SUPPORT[lang]:
+        raise HTTPException(status_code=422, detail=f"Unknown output format for {lang}: {output_format}")
+    try:
+        with timing.phase("validation"):
+            check_graph(graph)
+    except GraphError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Large graphs take a while to write and compress; keep the event loop free
+    return await asyncio.to_thread(lambda: render_graph(graph, lang, output_format).to_dict(selected))
+
+@app.get("/decode")
+async def decode_diagram_url(request: Request, url: str = Query(
+        ..., max_length=16384, description="A plantuml.com, mermaid.ink, mermaid.live or play.d2lang.com link")):
+    """Decode a diagram or playground link back to its language and source."""
+    await admit(request.app.state.client_limiter, client_key(request.headers, request.client and request.client.host))
+    try:
+        with timing.phase("decode"):
+            lang, code = decode_url(url)
+    except DecodeLimitExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode the link: {e}")
+    return {"lang": lang, "code": code}
+
+@app.get("/metrics", include_in_schema=False, response_class=PlainTextResponse)
+async def metrics():
+    """Scheduler queue metrics of this worker, in the Prometheus text format."""
+    scheduler = app.state.scheduler
+    return scheduler.metrics() if scheduler is not None else ""
+
+def require_admin(request: Request) -> None:
+    if not check_admin_token(request.headers.get("X-Admin-Token")):
+        raise HTTPException(status_code=403, detail="A valid admin token is required.")
+
+@app.post("/admin/memory/start", include_in_schema=False)
+async def memory_start(request: Request, frames: int = Query(25, ge=1, le=100)):
+    """Start tracing allocations with ``frames`` frames per traceback."""
+    require_admin(request)
+    app.state.memory.start(frames)
+    return {"tracing": True}
+
+@app.post("/admin/memory/stop", include_in_schema=False)
+async def memory_stop(request: Request):
+    """Stop tracing and drop the snapshots."""
+    require_admin(request)
+    app.state.memory.stop()
+    return {"tracing": False}
+
+@app.post("/admin/memory/snapshots/{name}", include_in_schema=False)
+async def memory_snapshot(request: Request, name: str):
+    """Keep the current allocations as ``name``, to compare later ones against."""
+    require_admin(request)
+    try:
+        await asyncio.to_thread(app.state.memory.snapshot, name)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"snapshots": list(app.state.memory.snapshots)}
+
+@app.get("/admin/memory", include_in_schema=False)
+async def memory_report(request: Request, top: int = Query(20, ge=1, le=500), since: Optional[str] = None,
+                        until: Optional[str] = None):
+    """Top allocation sites grouped by backend, or their growth between two snapshots."""
+    require_admin(request)
+    try:
+        return await asyncio.to_thread(app.state.memory.report, top, since, until)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown snapshot: {e.args[0]}")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/ready", include_in_schema=False)
+async def readiness():
+    """Readiness probe: 503 until the startup warm-up has finished."""
+    if not getattr(app.state, "ready", False):
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
+
+class PreviewEncoder:
+    """Local-only URL encoding for live preview; never contacts an upstream."""
+
+    def __init__(self):
+        self._plantuml = None
+        self._kroki = None
+
+    def __call__(self, lang: str, code: str, theme: str) -> dict:
+        if lang == "plantuml":
+            if self._plantuml is None:
+                self._plantuml = PlantUML(url=f"{PLANTUML_SERVER}/dpng", client=shared_client(), includes=plantuml_includes)
+            url = plantuml_link(self._plantuml.get_url(code))
+            return {"url": url, "playground": plantuml_playground(url)}
+        if lang in ["mermaid", "mermaidjs"]:
+            url, _, playground = generate_mermaid_live_editor_url(generate_diagram_state(code, theme or "dark"))
+            return {"url": url, "playground": playground}
+        if self._kroki is None:
+            self._kroki = Kroki(client=shared_client(), includes=plantuml_includes)
+        kroki_type = "d2" if lang in D2_LANGS else lang
+        return {
+            "url": self._kroki.get_url(kroki_type, code, "svg"),
+            "playground": self._kroki.get_playground_url(kroki_type, code) or "",
+        }
+
+@app.websocket("/ws/preview")
+async def preview_websocket(websocket: WebSocket, debounce: float = DEFAULT_DEBOUNCE):
+    await websocket.accept()
+    session = PreviewSession(websocket, PreviewEncoder(), VALID_LANGS.__contains__, min(max(debounce, 0.0), 2.0))
+    await session.run()
 
 @app.get("/logo.png")
 def plugin_logo():
@@ -156,10 +721,45 @@ async def openapi_spec_json():
 async def privacy_policy():
     return FileResponse("./.well-known/privacy.txt")
 
-def main():
+def main(argv=None):
+    import argparse
+    import importlib.util
+    import tempfile
     import uvicorn
-    logger.info("Starting server.")
-    uvicorn.run(app, host="localhost", port=5003)
+
+    parser = argparse.ArgumentParser(description="Run the diagram plugin server.")
+    parser.add_argument("--host", default=os.environ.get("HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5003")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "1")),
+                        help="number of worker processes")
+    parser.add_argument("--max-requests", type=int, default=None,
+                        help="recycle a worker after this many requests (multi-worker mode)")
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="seconds to finish in-flight requests on shutdown")
+    args = parser.parse_args(argv)
+
+    # uvicorn's fast event loop and HTTP parser are optional extras
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    options = {}
+    if args.workers > 1:
+        if not os.environ.get("RENDER_CACHE_PATH"):
+            cache_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            # Workers inherit the environment, so they all map the same file
+            os.environ["RENDER_CACHE_PATH"] = os.path.join(cache_dir, f"diagram-render-cache-{args.port}")
+        options["limit_max_requests"] = args.max_requests
+
+    logger.info("Starting server.", extra={"workers": args.workers, "loop": loop, "http": http})
+    uvicorn.run(
+        "app:app" if args.workers > 1 else app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=loop,
+        http=http,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        **options,
+    )
 
 if __name__ == "__main__":
     main()
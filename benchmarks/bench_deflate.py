@@ -0,0 +1,89 @@
+"""
+Encoding cost of the Kroki URL plus the PlantUML playground link.
+
+For a PlantUML source rendered through Kroki both links are built from the
+same text. The previous encoders compressed it twice (level 9 for Kroki,
+``zlib.compress`` again for the playground) and built the PlantUML alphabet
+one 3-byte group at a time; :class:`kroki.kroki.Kroki` now deflates once
+and derives both encodings from those bytes. Sources are generated C4
+container diagrams of growing size.
+
+Usage:
+    python benchmarks/bench_deflate.py [--repeat 20]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+import zlib
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kroki.kroki import Kroki  # noqa: E402
+from plantuml import PlantUML  # noqa: E402
+
+
+def c4_source(containers: int) -> str:
+    lines = ["@startuml", "!include <C4/C4_Container>", "LAYOUT_WITH_LEGEND()",
+             'Person(user, "User", "A user of the system")', 'System_Boundary(system, "System") {']
+    for i in range(containers):
+        lines.append(f'  Container(service{i}, "Service {i}", "Python, FastAPI", "Handles domain {i % 17} requests")')
+        lines.append(f'  ContainerDb(db{i}, "Store {i}", "PostgreSQL", "Keeps the state of service {i}")')
+    lines.append("}")
+    for i in range(containers):
+        lines.append(f'Rel(user, service{i}, "Uses", "HTTPS")')
+        lines.append(f'Rel(service{i}, db{i}, "Reads and writes", "SQL")')
+        if i:
+            lines.append(f'Rel(service{i}, service{i - 1}, "Calls", "gRPC")')
+    lines.append("@enduml")
+    return "\n".join(lines)
+
+
+CLIENT = httpx.Client()
+ENCODER = PlantUML("https://www.plantuml.com/plantuml/uml", client=CLIENT)
+
+
+def legacy_links(text: str) -> tuple:
+    """The two links as built before: two compressions and the per-group encoder."""
+    compress_obj = zlib.compressobj(level=9, method=zlib.DEFLATED, wbits=15)
+    url = base64.urlsafe_b64encode(compress_obj.compress(text.encode()) + compress_obj.flush()).decode()
+    data = zlib.compress(text.encode())[2:-4]
+    playground = ""
+    for i in range(0, len(data), 3):
+        group = data[i:i + 3] + b"\0" * (3 - len(data[i:i + 3]))
+        playground += ENCODER._encode3bytes(*group)
+    return url, playground
+
+
+def shared_links(text: str) -> tuple:
+    # A fresh instance per call, so nothing is reused across iterations
+    kroki = Kroki(client=CLIENT)
+    return kroki.get_url("plantuml", text), kroki.get_playground_url("plantuml", text)
+
+
+def measure(func, text: str, repeat: int) -> float:
+    started = time.process_time()
+    for _ in range(repeat):
+        func(text)
+    return (time.process_time() - started) / repeat * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    print(f"{'source':>10} {'before ms':>10} {'after ms':>10} {'speed-up':>9}")
+    for containers in (50, 200, 500):
+        text = c4_source(containers)
+        before = measure(legacy_links, text, args.repeat)
+        after = measure(shared_links, text, args.repeat)
+        print(f"{len(text) // 1024:>8}KB {before:>10.2f} {after:>10.2f} {before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
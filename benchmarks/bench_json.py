@@ -0,0 +1,95 @@
+"""
+Requests per second per core for ``POST /generate_diagram``.
+
+Runs the real endpoint twice in one process and on one event loop, once
+behind FastAPI's default ``APIRoute`` and once behind
+:class:`server.fastjson.FastJSONRoute`, by calling the ASGI app directly (no
+sockets, no middleware). Rate limits are disabled and the render cache is
+warm, so the numbers isolate request parsing, validation and response
+serialisation.
+
+Usage:
+    python benchmarks/bench_json.py [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.routing import APIRoute  # noqa: E402
+
+import app as app_module  # noqa: E402
+from server.cache import SharedCache  # noqa: E402
+from server.fastjson import FastJSONRoute, msgspec, orjson  # noqa: E402
+
+BODY = json.dumps({"lang": "mermaid", "type": "sequence", "code": "graph TD; A-->B; B-->C;", "theme": "dark"}).encode()
+
+
+def build_app(route_class) -> FastAPI:
+    bench_app = FastAPI()
+    bench_app.state.client_limiter = None
+    bench_app.state.upstream_limiter = None
+    bench_app.state.hot_diagrams = None
+    bench_app.state.scheduler = None
+    bench_app.state.failures = None
+    bench_app.state.render_cache = SharedCache(slots=64)
+    bench_app.router.add_api_route("/generate_diagram", app_module.generate_diagram_endpoint,
+                                   methods=["POST"], route_class_override=route_class)
+    return bench_app
+
+
+async def call(bench_app: FastAPI) -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/generate_diagram", "raw_path": b"/generate_diagram", "root_path": "",
+        "query_string": b"", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234), "server": ("testserver", 80), "app": bench_app,
+    }
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": BODY, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await bench_app(scope, receive, send)
+    return status
+
+
+async def measure(bench_app: FastAPI, requests: int) -> float:
+    assert await call(bench_app) == 200  # warms the render cache
+    started = time.process_time()
+    for _ in range(requests):
+        await call(bench_app)
+    return requests / (time.process_time() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    logging_level = app_module.logging.getLogger().level
+    app_module.logging.getLogger().setLevel(app_module.logging.WARNING)
+    try:
+        baseline = asyncio.run(measure(build_app(APIRoute), args.requests))
+        fast = asyncio.run(measure(build_app(FastJSONRoute), args.requests))
+    finally:
+        app_module.logging.getLogger().setLevel(logging_level)
+    print(f"decoder: {'msgspec' if msgspec else 'orjson' if orjson else 'json'}, "
+          f"encoder: {'orjson' if orjson else 'msgspec' if msgspec else 'json'}")
+    print(f"APIRoute:      {baseline:8.0f} req/s per core")
+    print(f"FastJSONRoute: {fast:8.0f} req/s per core ({fast / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
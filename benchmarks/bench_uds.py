@@ -0,0 +1,108 @@
+"""
+Upstream latency over loopback TCP and over a Unix domain socket.
+
+Starts a stand-in renderer answering every ``GET`` with a small SVG, listening
+on ``127.0.0.1`` and on a Unix socket at once, and renders the same diagram
+through :class:`kroki.kroki.Kroki` on the shared pool against both
+(``http://127.0.0.1:<port>`` and ``unix:///<dir>/kroki.sock``). Connections
+are kept alive, so the numbers compare the per-request cost of the two
+transports as a sidecar deployment sees it.
+
+Usage:
+    python benchmarks/bench_uds.py [--requests 2000] [--concurrency 1]
+"""
+
+import argparse
+import os
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kroki.kroki import Kroki  # noqa: E402
+from server.pool import close_shared_client, shared_client  # noqa: E402
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg">' + b'<rect width="10" height="10"/>' * 64 + b"</svg>"
+SOURCE = "digraph { " + " ".join(f"n{i} -> n{i + 1};" for i in range(50)) + " }"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/svg+xml")
+        self.send_header("Content-Length", str(len(SVG)))
+        self.end_headers()
+        self.wfile.write(SVG)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return "local"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPHandler(Handler):
+    # Headers and body go out in two writes; without this, delayed ACKs dominate
+    disable_nagle_algorithm = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def measure(base_url: str, requests: int, concurrency: int) -> list:
+    kroki = Kroki(base_url, client=shared_client())
+
+    def one(_) -> float:
+        started = time.perf_counter()
+        kroki.render_diagram("graphviz", SOURCE, "svg")
+        return (time.perf_counter() - started) * 1000
+
+    # Warm the pool so connection setup is not measured
+    for _ in range(concurrency):
+        one(None)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, range(requests)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kroki.sock")
+        tcp = ThreadingHTTPServer(("127.0.0.1", 0), TCPHandler)
+        uds = ThreadingUnixHTTPServer(path, Handler)
+        serve(tcp)
+        serve(uds)
+        try:
+            print(f"{'transport':>10} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+            for name, url in (("tcp", f"http://127.0.0.1:{tcp.server_address[1]}"), ("unix", f"unix://{path}")):
+                started = time.perf_counter()
+                latencies = measure(url, args.requests, args.concurrency)
+                elapsed = time.perf_counter() - started
+                quantiles = statistics.quantiles(latencies, n=100)
+                print(f"{name:>10} {quantiles[49]:>8.3f} {quantiles[98]:>8.3f} {len(latencies) / elapsed:>8.0f}")
+        finally:
+            close_shared_client()
+            tcp.shutdown()
+            uds.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+"""
+Command line tools for D2COpenAIPlugin.
+"""
@@ -0,0 +1,188 @@
+"""
+Bulk migration of stored diagram links to a Kroki server.
+
+Reads a file with one diagram URL per line (plantuml.com, mermaid.ink,
+mermaid.live or play.d2lang.com), decodes each URL back to its source and
+re-encodes it with :meth:`kroki.kroki.Kroki.get_url`. The mapping is written
+as JSON lines. Work is spread over a process pool and a checkpoint file is
+updated after every batch, so an interrupted run picks up where it stopped.
+
+Usage:
+    python -m cli.migrate urls.txt -o mapping.jsonl --kroki-url https://kroki.example.com
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from D2.d2 import decode as d2_decode
+from kroki.kroki import Kroki
+from mermaid.mermaid import deserialize_state
+from plantuml import PlantUML
+from server.inflate import DecodeLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Per-process clients, created by _init_worker (or lazily outside the pool)
+_plantuml: Optional[PlantUML] = None
+_kroki: Optional[Kroki] = None
+_output_format = "svg"
+
+
+def _pad(data: str) -> str:
+    return data + "=" * (-len(data) % 4)
+
+
+def _get_plantuml() -> PlantUML:
+    global _plantuml
+    if _plantuml is None:
+        _plantuml = PlantUML(url="https://www.plantuml.com/plantuml/dpng")
+    return _plantuml
+
+
+def _mermaid_code(state: str) -> str:
+    try:
+        return deserialize_state(state)["code"]
+    except DecodeLimitExceeded:
+        raise
+    except (ValueError, KeyError, TypeError):
+        # mermaid.ink also accepts the bare base64 diagram source
+        return base64.urlsafe_b64decode(_pad(state)).decode("utf-8")
+
+
+def decode_url(url: str) -> Tuple[str, str]:
+    """
+    Decode a stored diagram URL back to its source.
+
+    Args:
+        url: A plantuml.com, mermaid.ink, mermaid.live or play.d2lang.com URL
+
+    Returns:
+        Tuple of (kroki diagram type, diagram source)
+
+    Raises:
+        ValueError: If the URL is not recognised or cannot be decoded
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.endswith("plantuml.com") or "/plantuml/" in parsed.path:
+        encoded = parsed.path.rstrip("/").rsplit("/", 1)[-1]
+        return "plantuml", _get_plantuml().decode_and_inflate(encoded)
+    if host.endswith("mermaid.ink") or host.endswith("mermaid.live"):
+        state = parsed.fragment or parsed.path.rstrip("/").rsplit("/", 1)[-1]
+        return "mermaid", _mermaid_code(state)
+    if host.endswith("d2lang.com"):
+        script = parse_qs(parsed.query).get("script")
+        if not script:
+            raise ValueError(f"No script parameter in D2 URL: {url}")
+        # parse_qs turns a literal '+' of standard base64 into a space
+        return "d2", d2_decode(_pad(script[0].replace(" ", "+")))
+    raise ValueError(f"Unsupported diagram URL: {url}")
+
+
+def _init_worker(kroki_url: str, output_format: str) -> None:
+    global _kroki, _output_format
+    _kroki = Kroki(base_url=kroki_url)
+    _output_format = output_format
+
+
+def _migrate_one(url: str) -> Optional[Dict[str, str]]:
+    url = url.strip()
+    if not url:
+        return None
+    try:
+        diagram_type, source = decode_url(url)
+        return {"source": url, "kroki": _kroki.get_url(diagram_type, source, _output_format)}
+    except Exception as e:
+        return {"source": url, "error": str(e)}
+
+
+def _load_checkpoint(checkpoint_path: str) -> Dict[str, int]:
+    with open(checkpoint_path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(checkpoint_path: str, state: Dict[str, int]) -> None:
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def migrate(input_path: str, output_path: str, kroki_url: str = "https://kroki.io",
+            output_format: str = "svg", workers: Optional[int] = None, batch_size: int = 1000,
+            checkpoint_path: Optional[str] = None, restart: bool = False) -> Dict[str, int]:
+    """
+    Migrate every URL in ``input_path`` and append the mapping to ``output_path``.
+
+    Args:
+        input_path: File with one diagram URL per line
+        output_path: JSON lines file receiving ``{"source", "kroki"}`` or ``{"source", "error"}``
+        kroki_url: Base URL of the target Kroki server
+        output_format: Kroki output format of the generated URLs
+        workers: Size of the process pool (defaults to the CPU count)
+        batch_size: Number of lines processed between two checkpoints
+        checkpoint_path: Checkpoint file (defaults to ``<output_path>.checkpoint``)
+        restart: Ignore an existing checkpoint and start from the first line
+
+    Returns:
+        Counters with the number of processed lines, migrated and failed URLs
+    """
+    checkpoint_path = checkpoint_path or f"{output_path}.checkpoint"
+    state = {"lines": 0, "offset": 0, "ok": 0, "failed": 0}
+    resume = not restart and os.path.exists(checkpoint_path)
+    if resume:
+        state = _load_checkpoint(checkpoint_path)
+        logger.info("Resuming migration after %d lines.", state["lines"])
+
+    workers = workers or os.cpu_count() or 1
+    with open(input_path, encoding="utf-8") as src, \
+            open(output_path, "ab" if resume else "wb") as out, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(kroki_url, output_format)) as executor:
+        # Drop anything written after the last checkpoint
+        out.truncate(state["offset"])
+        lines = islice(src, state["lines"], None)
+        for batch in iter(lambda: list(islice(lines, batch_size)), []):
+            chunksize = max(1, len(batch) // (workers * 4))
+            for result in executor.map(_migrate_one, batch, chunksize=chunksize):
+                if result is None:
+                    continue
+                state["failed" if "error" in result else "ok"] += 1
+                out.write(json.dumps(result).encode("utf-8") + b"\n")
+            out.flush()
+            state["lines"] += len(batch)
+            state["offset"] = out.tell()
+            _save_checkpoint(checkpoint_path, state)
+            logger.info("Processed %d lines (%d migrated, %d failed).",
+                        state["lines"], state["ok"], state["failed"])
+    return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-encode stored diagram URLs for a Kroki server.")
+    parser.add_argument("input", help="file with one diagram URL per line")
+    parser.add_argument("-o", "--output", required=True, help="JSON lines mapping file")
+    parser.add_argument("--kroki-url", default="https://kroki.io", help="base URL of the Kroki server")
+    parser.add_argument("--format", default="svg", help="Kroki output format")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=1000, help="lines between checkpoints")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    state = migrate(args.input, args.output, kroki_url=args.kroki_url, output_format=args.format,
+                    workers=args.workers, batch_size=args.batch_size,
+                    checkpoint_path=args.checkpoint, restart=args.restart)
+    return 0 if state["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
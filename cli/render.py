@@ -0,0 +1,209 @@
+"""
+Incremental batch renderer for docs-as-code trees.
+
+Walks a directory, picks the backend of every diagram source from its
+extension (PlantUML for ``.puml``, Kroki for Mermaid, D2 and Graphviz) and
+writes the rendered image next to the source, e.g. ``docs/flow.mmd`` ->
+``docs/flow.svg``. Files are rendered concurrently by a bounded thread pool
+sharing one keep-alive HTTP client.
+
+A manifest (``.diagram-manifest.json`` at the root) records the SHA-256 of
+each source together with the backend settings; a re-run skips every file
+whose hash is unchanged and whose output still exists.
+
+Usage:
+    python -m cli.render docs/ --format svg -j 16
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from kroki.kroki import Kroki, KrokiError
+from plantuml import PlantUML, PlantUMLHTTPError
+from plantuml.includes import IncludeResolver
+from server.pool import shared_client
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    ".puml": "plantuml",
+    ".plantuml": "plantuml",
+    ".pu": "plantuml",
+    ".mmd": "mermaid",
+    ".mermaid": "mermaid",
+    ".d2": "d2",
+    ".dot": "graphviz",
+    ".gv": "graphviz",
+}
+MANIFEST_NAME = ".diagram-manifest.json"
+# Per-file failures that must not stop a run (ValueError covers bad UTF-8)
+RENDER_ERRORS = (PlantUMLHTTPError, KrokiError, ValueError)
+SKIPPED_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv"}
+
+
+def find_sources(root: str) -> Iterator[Tuple[str, str]]:
+    """Yield ``(relative path, lang)`` for every diagram source under ``root``."""
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRS and not d.startswith("."))
+        for name in sorted(files):
+            lang = EXTENSIONS.get(os.path.splitext(name)[1].lower())
+            if lang:
+                yield os.path.relpath(os.path.join(directory, name), root), lang
+
+
+def _load_manifest(path: str) -> Dict[str, Dict[str, str]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_manifest(path: str, manifest: Dict[str, Dict[str, str]]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class Renderer:
+    """Render one source file with the backend of its language.
+
+    Args:
+        output_format: Image format (``svg``, ``png``, ...)
+        plantuml_url: Base URL of the PlantUML server
+        kroki_url: Base URL of the Kroki server
+        include_dirs: Directories PlantUML ``!include`` files are inlined from
+    """
+
+    def __init__(self, output_format: str = "svg", plantuml_url: str = "https://www.plantuml.com/plantuml",
+                 kroki_url: str = "https://kroki.io", include_dirs: Optional[List[str]] = None):
+        self.output_format = output_format
+        client = shared_client()
+        self.includes = IncludeResolver(include_dirs) if include_dirs else None
+        self.plantuml = PlantUML(url=f"{plantuml_url.rstrip('/')}/{output_format}", client=client,
+                                 includes=self.includes)
+        self.kroki = Kroki(base_url=kroki_url, client=client, includes=self.includes)
+        # Part of every file hash: other settings mean other images
+        self.settings = f"{output_format}\0{plantuml_url}\0{kroki_url}"
+
+    def fingerprint(self, lang: str, source: bytes) -> str:
+        if lang == "plantuml" and self.includes is not None:
+            # Hash what is sent, so edits of included files count as changes
+            source = self.includes.inline(source.decode("utf-8", "replace")).encode("utf-8")
+        digest = hashlib.sha256(self.settings.encode())
+        digest.update(b"\0" + lang.encode() + b"\0")
+        digest.update(source)
+        return digest.hexdigest()
+
+    def render(self, lang: str, source: str) -> bytes:
+        if lang == "plantuml":
+            return self.plantuml.render(source)
+        return self.kroki.render_diagram(lang, source, self.output_format)
+
+
+def write_output(root: str, relpath: str, renderer: Renderer, source: bytes, lang: str) -> str:
+    """
+    Render ``source`` and write the image next to ``relpath``.
+
+    Returns:
+        The output path, relative to ``root``
+    """
+    output = os.path.splitext(relpath)[0] + "." + renderer.output_format
+    image = renderer.render(lang, source.decode("utf-8"))
+    tmp_path = os.path.join(root, output + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(image)
+    os.replace(tmp_path, os.path.join(root, output))
+    return output
+
+
+def render_tree(root: str, output_format: str = "svg", workers: int = 8,
+                plantuml_url: str = "https://www.plantuml.com/plantuml", kroki_url: str = "https://kroki.io",
+                force: bool = False, include_dirs: Optional[List[str]] = None,
+                renderer: Optional[Renderer] = None) -> Dict[str, int]:
+    """
+    Render every diagram source under ``root`` whose content changed.
+
+    Args:
+        root: Directory to walk
+        output_format: Image format written next to each source
+        workers: Maximum number of concurrent renders
+        plantuml_url: Base URL of the PlantUML server
+        kroki_url: Base URL of the Kroki server
+        force: Render everything, ignoring the manifest
+        include_dirs: Directories PlantUML includes are inlined from
+            (default: ``root``)
+        renderer: Renderer to use instead of one built from the URLs
+
+    Returns:
+        Counters of rendered, skipped and failed files
+    """
+    if include_dirs is None:
+        include_dirs = [root]
+    renderer = renderer or Renderer(output_format, plantuml_url, kroki_url, include_dirs)
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    stored = _load_manifest(manifest_path)
+    previous = {} if force else stored
+    sources = list(find_sources(root))
+    # Entries of files not reached by this run (e.g. it was interrupted) are kept;
+    # only sources that are gone are forgotten
+    present = {relpath for relpath, _ in sources}
+    manifest: Dict[str, Dict[str, str]] = {relpath: entry for relpath, entry in stored.items() if relpath in present}
+    counts = {"rendered": 0, "skipped": 0, "failed": 0}
+
+    def process(item: Tuple[str, str]) -> Tuple[str, Optional[Dict[str, str]], str]:
+        relpath, lang = item
+        with open(os.path.join(root, relpath), "rb") as f:
+            source = f.read()
+        entry = previous.get(relpath)
+        fingerprint = renderer.fingerprint(lang, source)
+        if entry and entry["hash"] == fingerprint and os.path.exists(os.path.join(root, entry["output"])):
+            return relpath, entry, "skipped"
+        try:
+            output = write_output(root, relpath, renderer, source, lang)
+        except RENDER_ERRORS as e:
+            logger.error("Failed to render %s: %s", relpath, e)
+            return relpath, entry, "failed"
+        return relpath, {"hash": fingerprint, "output": output}, "rendered"
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for relpath, entry, status in executor.map(process, sources):
+                counts[status] += 1
+                if entry is not None:
+                    manifest[relpath] = entry
+        finally:
+            # Keep what was rendered so far even if the run is interrupted
+            _save_manifest(manifest_path, manifest)
+    logger.info("Rendered %d, skipped %d unchanged, %d failed.",
+                counts["rendered"], counts["skipped"], counts["failed"])
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render every diagram source of a directory tree.")
+    parser.add_argument("root", help="directory to walk")
+    parser.add_argument("--format", default="svg", help="output image format")
+    parser.add_argument("-j", "--workers", type=int, default=8, help="concurrent renders")
+    parser.add_argument("--plantuml-url", default="https://www.plantuml.com/plantuml", help="base URL of the PlantUML server")
+    parser.add_argument("--kroki-url", default="https://kroki.io", help="base URL of the Kroki server")
+    parser.add_argument("--force", action="store_true", help="ignore the manifest and render everything")
+    parser.add_argument("-I", "--include-dir", action="append", default=None,
+                        help="directory PlantUML !include files are inlined from (default: the root)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    counts = render_tree(args.root, output_format=args.format, workers=args.workers,
+                         plantuml_url=args.plantuml_url, kroki_url=args.kroki_url, force=args.force,
+                         include_dirs=args.include_dir)
+    return 0 if counts["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
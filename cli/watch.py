@@ -0,0 +1,315 @@
+"""
+Watch a docs tree and re-render exactly the diagrams affected by a change.
+
+PlantUML ``!include``/``!include_many``/``!include_once``/``!includesub``/
+``!import`` directives and D2 imports (``x: @file`` and ``...@file``) are
+parsed into a dependency graph. When a file changes, every diagram source
+that (transitively) includes it is re-rendered through
+:class:`cli.render.Renderer`, and nothing else. Saves arriving within the
+debounce delay of each other are coalesced into a single render.
+
+Changes are read from inotify on Linux (through ``ctypes``, no extra
+dependency) and from a periodic ``stat`` scan elsewhere or with ``--poll``.
+
+Usage:
+    python -m cli.watch docs/ --format svg --debounce 0.3
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from cli.render import EXTENSIONS, RENDER_ERRORS, SKIPPED_DIRS, Renderer, write_output
+from plantuml.includes import INCLUDE_DIRECTIVE, is_local_target, split_target
+
+logger = logging.getLogger(__name__)
+
+_D2_IMPORT = re.compile(r"(?:\.\.\.|:\s*)@([\w./\\-]+)")
+
+
+def parse_dependencies(lang: str, text: str) -> Set[str]:
+    """Local file references of a source, as written (relative paths)."""
+    references = set()
+    if lang == "plantuml":
+        for kind, target in INCLUDE_DIRECTIVE.findall(text):
+            path, _ = split_target(target)
+            # stdlib, remote and archive includes are resolved by the server
+            if kind not in ("includeurl", "import") and is_local_target(path):
+                references.add(path)
+    elif lang == "d2":
+        for target in _D2_IMPORT.findall(text):
+            references.add(target if os.path.splitext(target)[1] else f"{target}.d2")
+    return references
+
+
+def _lang_of(path: str) -> Optional[str]:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".iuml", ".wsd"):
+        return "plantuml"  # include-only PlantUML files
+    return EXTENSIONS.get(ext)
+
+
+class DependencyGraph:
+    """Which files include which, for every source under ``root``.
+
+    Paths are relative to ``root``. Includes resolve against the including
+    file's directory first and ``root`` second, like PlantUML's include path.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.includes: Dict[str, Set[str]] = {}
+        self.included_by: Dict[str, Set[str]] = defaultdict(set)
+
+    def scan(self) -> None:
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+            for name in files:
+                self.update(os.path.relpath(os.path.join(directory, name), self.root))
+
+    def _resolve(self, relpath: str, reference: str) -> str:
+        local = os.path.normpath(os.path.join(os.path.dirname(relpath), reference))
+        if os.path.exists(os.path.join(self.root, local)):
+            return local
+        from_root = os.path.normpath(reference.lstrip("/"))
+        return from_root if os.path.exists(os.path.join(self.root, from_root)) else local
+
+    def update(self, relpath: str) -> None:
+        """Re-read the references of ``relpath`` (or forget it when deleted)."""
+        for target in self.includes.pop(relpath, ()):
+            self.included_by[target].discard(relpath)
+        lang = _lang_of(relpath)
+        if lang is None:
+            return
+        try:
+            with open(os.path.join(self.root, relpath), encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, ValueError):
+            return
+        targets = {self._resolve(relpath, reference) for reference in parse_dependencies(lang, text)}
+        self.includes[relpath] = targets
+        for target in targets:
+            self.included_by[target].add(relpath)
+
+    def affected(self, changed: Iterable[str]) -> Set[str]:
+        """Renderable sources depending on any of ``changed``, themselves included."""
+        seen = set()
+        stack = list(changed)
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            stack.extend(self.included_by.get(path, ()))
+        return {
+            path for path in seen
+            if os.path.splitext(path)[1].lower() in EXTENSIONS and os.path.exists(os.path.join(self.root, path))
+        }
+
+
+class PollingWatcher:
+    """Detect changes by comparing ``stat`` snapshots every ``interval`` seconds."""
+
+    def __init__(self, root: str, interval: float = 0.5):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout: float) -> Set[str]:
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """Recursive inotify watch of ``root`` through libc (Linux only)."""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, root: str):
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, str] = {}
+        self._add_tree(root)
+
+    def _add_tree(self, top: str) -> Set[str]:
+        """Watch ``top`` and its subdirectories; return the files already in them."""
+        files = set()
+        for directory, dirs, names in os.walk(top):
+            dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self._dirs[wd] = directory
+            files.update(os.path.join(directory, name) for name in names)
+        return files
+
+    def changes(self, timeout: float) -> Set[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflow; some changes may be missed")
+                continue
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and os.path.basename(path) not in SKIPPED_DIRS:
+                    # Files can land in a new directory before its watch exists
+                    changed.update(self._add_tree(path))
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher(root: str, polling: bool = False, interval: float = 0.5):
+    """An :class:`InotifyWatcher` when available, else a :class:`PollingWatcher`."""
+    if not polling and hasattr(select, "select") and os.uname().sysname == "Linux":
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable (%s); falling back to polling", e)
+    return PollingWatcher(root, interval)
+
+
+def watch(root: str, renderer: Renderer, debounce: float = 0.3, workers: int = 4, polling: bool = False,
+          stop: Optional[threading.Event] = None) -> None:
+    """
+    Re-render affected diagrams until ``stop`` is set.
+
+    Args:
+        root: Directory to watch
+        renderer: Backend clients and output format
+        debounce: Quiet period, in seconds, closing a burst of changes
+        workers: Maximum number of concurrent renders
+        polling: Use the polling watcher even where inotify exists
+        stop: Event ending the loop (runs until interrupted otherwise)
+    """
+    stop = stop or threading.Event()
+    graph = DependencyGraph(root)
+    graph.scan()
+    watcher = create_watcher(root, polling, interval=min(debounce, 0.5))
+    outputs = {f".{renderer.output_format}", ".tmp"}
+    pending: Set[str] = set()
+    logger.info("Watching %s for diagram changes.", root)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while not stop.is_set():
+                changed = watcher.changes(debounce if pending else 0.5)
+                changed = {os.path.relpath(path, root) for path in changed
+                           if os.path.splitext(path)[1].lower() not in outputs}
+                if changed:
+                    pending |= changed
+                    continue
+                if not pending:
+                    continue
+                for relpath in pending:
+                    graph.update(relpath)
+                targets = sorted(graph.affected(pending))
+                pending = set()
+                for relpath, error in zip(targets, executor.map(lambda p: _render(root, p, renderer), targets)):
+                    if error:
+                        logger.error("Failed to render %s: %s", relpath, error)
+                    else:
+                        logger.info("Rendered %s", relpath)
+    finally:
+        watcher.close()
+
+
+def _render(root: str, relpath: str, renderer: Renderer) -> Optional[Exception]:
+    try:
+        with open(os.path.join(root, relpath), "rb") as f:
+            source = f.read()
+        write_output(root, relpath, renderer, source, _lang_of(relpath))
+    except RENDER_ERRORS + (OSError,) as e:
+        return e
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-render diagrams of a directory tree as they change.")
+    parser.add_argument("root", help="directory to watch")
+    parser.add_argument("--format", default="svg", help="output image format")
+    parser.add_argument("-j", "--workers", type=int, default=4, help="concurrent renders")
+    parser.add_argument("--debounce", type=float, default=0.3, help="seconds of quiet before rendering")
+    parser.add_argument("--poll", action="store_true", help="poll the tree instead of using inotify")
+    parser.add_argument("--plantuml-url", default="https://www.plantuml.com/plantuml", help="base URL of the PlantUML server")
+    parser.add_argument("--kroki-url", default="https://kroki.io", help="base URL of the Kroki server")
+    parser.add_argument("-I", "--include-dir", action="append", default=None,
+                        help="directory PlantUML !include files are inlined from (default: the root)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    renderer = Renderer(args.format, args.plantuml_url, args.kroki_url, args.include_dir or [args.root])
+    try:
+        watch(args.root, renderer, debounce=args.debounce, workers=args.workers, polling=args.poll)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
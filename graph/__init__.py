@@ -0,0 +1,5 @@
+"""
+Structured graph to diagram source compilation.
+"""
+
+from .compiler import GRAPH_LANGS, Edge, Graph, GraphError, Group, Node, check_graph, compile_graph
@@ -0,0 +1,379 @@
+"""
+Compile structured graphs (nodes, edges, groups, styles) into diagram sources.
+
+Diagrams generated from service registries can have thousands of nodes;
+writing their D2, Mermaid or PlantUML text by hand (or by a language model)
+is slow and error-prone. A :class:`Graph` is validated once with
+:func:`check_graph` and written by :func:`compile_graph`, a generator of
+source lines that never holds the whole text: :meth:`kroki.kroki.Kroki.deflate_stream`
+compresses the lines as they are produced.
+
+Styles use the D2 vocabulary (``style_keywords`` of :mod:`D2.d2`) for every
+target; Mermaid and PlantUML get the subset they can express. Node and group
+ids may not be D2 reserved keywords, so one graph compiles to all targets.
+"""
+
+import json
+import re
+from typing import Dict, Iterator, List, Optional, Union
+
+from pydantic import BaseModel, Field, StrictBool, field_validator
+
+from D2.d2 import reserved_keywords, style_keywords
+
+GRAPH_LANGS = ("d2", "mermaid", "plantuml")
+DIRECTIONS = ("right", "down", "left", "up")
+# Shapes D2 knows; Mermaid and PlantUML approximate them
+SHAPES = {
+    "rectangle", "square", "page", "parallelogram", "document", "cylinder", "queue", "package", "step",
+    "callout", "stored_data", "person", "diamond", "oval", "circle", "hexagon", "cloud", "text",
+}
+
+# Groups nest at most this deep (the writers recurse along the nesting)
+MAX_GROUP_DEPTH = 32
+
+StyleValue = Union[StrictBool, int, float, str]
+
+_STYLE_STRING = re.compile(r"[\w#.%-]+")
+_D2_BARE_KEY = re.compile(r"[A-Za-z_][A-Za-z0-9_ ]*")
+_SAFE_ID = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+# Words that cannot be Mermaid or PlantUML ids
+_RESERVED_IDS = {"end", "graph", "subgraph", "flowchart", "style", "class", "classdef", "click", "linkstyle",
+                 "direction", "as", "left", "right", "up", "down", "top", "bottom", "to"}
+
+
+class GraphError(ValueError):
+    """The graph cannot be compiled (unknown reference, duplicate id, invalid style, ...)."""
+
+
+class Node(BaseModel):
+    id: str
+    label: Optional[str] = None
+    group: Optional[str] = None
+    shape: Optional[str] = None
+    style: Dict[str, StyleValue] = {}
+
+
+class Edge(BaseModel):
+    source: str
+    target: str
+    label: Optional[str] = None
+    style: Dict[str, StyleValue] = {}
+
+
+class Group(BaseModel):
+    id: str
+    label: Optional[str] = None
+    parent: Optional[str] = None
+    style: Dict[str, StyleValue] = {}
+
+
+class Graph(BaseModel):
+    nodes: List[Node] = Field(default_factory=list, max_length=50000)
+    edges: List[Edge] = Field(default_factory=list, max_length=100000)
+    groups: List[Group] = Field(default_factory=list, max_length=10000)
+    direction: str = "right"
+
+    @field_validator("direction")
+    @classmethod
+    def validate_direction(cls, v: str) -> str:
+        if v not in DIRECTIONS:
+            raise ValueError(f"Invalid direction: {v}. Choose from {', '.join(DIRECTIONS)}.")
+        return v
+
+
+def _check_style(owner: str, style: Dict[str, StyleValue]) -> None:
+    for key, value in style.items():
+        if key not in style_keywords:
+            raise GraphError(f"Unknown style keyword '{key}' on {owner}")
+        if isinstance(value, str) and not _STYLE_STRING.fullmatch(value):
+            raise GraphError(f"Invalid value for style '{key}' on {owner}: {value!r}")
+
+
+def _check_id(kind: str, item_id: str, seen: set) -> None:
+    if not item_id or "\n" in item_id:
+        raise GraphError(f"Invalid {kind} id: {item_id!r}")
+    if item_id.lower() in reserved_keywords:
+        raise GraphError(f"{kind.capitalize()} id '{item_id}' is a reserved D2 keyword")
+    if item_id in seen:
+        raise GraphError(f"Duplicate id '{item_id}'")
+    seen.add(item_id)
+
+
+def check_graph(graph: Graph) -> None:
+    """
+    Validate references, ids, shapes and style keys.
+
+    Raises:
+        GraphError: On the first problem found
+    """
+    seen: set = set()
+    groups = {}
+    for group in graph.groups:
+        _check_id("group", group.id, seen)
+        _check_style(f"group '{group.id}'", group.style)
+        groups[group.id] = group
+    for group in graph.groups:
+        # Walk up the parents; this also stops cycles
+        parent, depth = group.parent, 0
+        while parent is not None:
+            if parent not in groups:
+                raise GraphError(f"Group '{group.id}' has an unknown parent '{parent}'")
+            depth += 1
+            if depth > MAX_GROUP_DEPTH:
+                raise GraphError(f"Group '{group.id}' is nested more than {MAX_GROUP_DEPTH} deep (or in itself)")
+            parent = groups[parent].parent
+    for node in graph.nodes:
+        _check_id("node", node.id, seen)
+        if node.group is not None and node.group not in groups:
+            raise GraphError(f"Node '{node.id}' is in an unknown group '{node.group}'")
+        if node.shape is not None and node.shape not in SHAPES:
+            raise GraphError(f"Unknown shape '{node.shape}' on node '{node.id}'")
+        _check_style(f"node '{node.id}'", node.style)
+    for index, edge in enumerate(graph.edges):
+        for end in (edge.source, edge.target):
+            if end not in seen:
+                raise GraphError(f"Edge {index} references an unknown node or group '{end}'")
+        _check_style(f"edge {index}", edge.style)
+
+
+def _members(graph: Graph):
+    """Child groups and nodes of every group (None for the top level)."""
+    groups: Dict[Optional[str], List[Group]] = {}
+    nodes: Dict[Optional[str], List[Node]] = {}
+    for group in graph.groups:
+        groups.setdefault(group.parent, []).append(group)
+    for node in graph.nodes:
+        nodes.setdefault(node.group, []).append(node)
+    return groups, nodes
+
+
+def _quote(text: str) -> str:
+    return json.dumps(text, ensure_ascii=False)
+
+
+# D2
+
+def _d2_key(item_id: str) -> str:
+    return item_id if _D2_BARE_KEY.fullmatch(item_id) and not item_id.endswith(" ") else _quote(item_id)
+
+
+def _d2_value(value: StyleValue) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value) if isinstance(value, (int, float)) else _quote(value)
+
+
+def _d2_item(key: str, label: Optional[str], shape: Optional[str], style: Dict[str, StyleValue],
+             indent: str, open_block: bool) -> Iterator[str]:
+    head = f"{indent}{key}: {_quote(label)}" if label is not None else f"{indent}{key}"
+    if not (shape or style or open_block):
+        yield head + "\n"
+        return
+    yield head + (" {\n" if label is not None else ": {\n")
+    if shape:
+        yield f"{indent}  shape: {shape}\n"
+    for name, value in style.items():
+        yield f"{indent}  style.{name}: {_d2_value(value)}\n"
+    if not open_block:
+        yield f"{indent}}}\n"
+
+
+def _d2_paths(graph: Graph) -> Dict[str, str]:
+    """Full ``group.subgroup.node`` key of every node and group, as edges need them."""
+    parents = {group.id: group.parent for group in graph.groups}
+    paths: Dict[str, str] = {}
+
+    def path(item_id: str, parent: Optional[str]) -> str:
+        if item_id not in paths:
+            prefix = path(parent, parents[parent]) + "." if parent is not None else ""
+            paths[item_id] = prefix + _d2_key(item_id)
+        return paths[item_id]
+
+    for group in graph.groups:
+        path(group.id, group.parent)
+    for node in graph.nodes:
+        path(node.id, node.group)
+    return paths
+
+
+def _d2_lines(graph: Graph) -> Iterator[str]:
+    groups, nodes = _members(graph)
+    yield f"direction: {graph.direction}\n"
+
+    def members(parent: Optional[str], indent: str) -> Iterator[str]:
+        for group in groups.get(parent, ()):
+            yield from _d2_item(_d2_key(group.id), group.label, None, group.style, indent, True)
+            yield from members(group.id, indent + "  ")
+            yield f"{indent}}}\n"
+        for node in nodes.get(parent, ()):
+            yield from _d2_item(_d2_key(node.id), node.label, node.shape, node.style, indent, False)
+
+    yield from members(None, "")
+    paths = _d2_paths(graph)
+    for edge in graph.edges:
+        yield from _d2_item(f"{paths[edge.source]} -> {paths[edge.target]}", edge.label, None, edge.style, "", False)
+
+
+# Mermaid and PlantUML
+
+def _safe_ids(graph: Graph) -> Dict[str, str]:
+    """Ids usable in Mermaid and PlantUML: the original when it is one, else ``n<i>``."""
+    ids = [group.id for group in graph.groups] + [node.id for node in graph.nodes]
+    taken = {item_id for item_id in ids if _SAFE_ID.fullmatch(item_id) and item_id.lower() not in _RESERVED_IDS}
+    mapping: Dict[str, str] = {}
+    counter = 0
+    for item_id in ids:
+        if item_id in taken:
+            mapping[item_id] = item_id
+            continue
+        while f"n{counter}" in taken:
+            counter += 1
+        mapping[item_id] = f"n{counter}"
+        taken.add(mapping[item_id])
+    return mapping
+
+
+_MERMAID_DIRECTIONS = {"right": "LR", "down": "TB", "left": "RL", "up": "BT"}
+_MERMAID_SHAPES = {
+    "oval": ("([", "])"), "circle": ("((", "))"), "cylinder": ("[(", ")]"), "diamond": ("{", "}"),
+    "hexagon": ("{{", "}}"), "parallelogram": ("[/", "/]"), "step": ("[[", "]]"),
+}
+# D2 style keyword -> CSS property
+_MERMAID_STYLES = {
+    "fill": "fill", "stroke": "stroke", "stroke-width": "stroke-width", "stroke-dash": "stroke-dasharray",
+    "opacity": "opacity", "font-color": "color", "font-size": "font-size",
+}
+
+
+def _mermaid_label(text: str) -> str:
+    return '"' + text.replace('"', "#quot;").replace("\n", "<br>") + '"'
+
+
+def _mermaid_css(style: Dict[str, StyleValue]) -> str:
+    properties = [f"{_MERMAID_STYLES[key]}:{value}" for key, value in style.items()
+                  if key in _MERMAID_STYLES and not isinstance(value, bool)]
+    if style.get("bold") is True:
+        properties.append("font-weight:bold")
+    if style.get("italic") is True:
+        properties.append("font-style:italic")
+    return ",".join(properties)
+
+
+def _mermaid_lines(graph: Graph) -> Iterator[str]:
+    groups, nodes = _members(graph)
+    ids = _safe_ids(graph)
+    yield f"flowchart {_MERMAID_DIRECTIONS[graph.direction]}\n"
+
+    def members(parent: Optional[str], indent: str) -> Iterator[str]:
+        for group in groups.get(parent, ()):
+            yield f"{indent}subgraph {ids[group.id]}[{_mermaid_label(group.label or group.id)}]\n"
+            yield from members(group.id, indent + "  ")
+            yield f"{indent}end\n"
+        for node in nodes.get(parent, ()):
+            opening, closing = _MERMAID_SHAPES.get(node.shape, ("[", "]"))
+            yield f"{indent}{ids[node.id]}{opening}{_mermaid_label(node.label or node.id)}{closing}\n"
+
+    yield from members(None, "  ")
+    for edge in graph.edges:
+        label = f"|{_mermaid_label(edge.label)}|" if edge.label else ""
+        yield f"  {ids[edge.source]} -->{label} {ids[edge.target]}\n"
+    for item in (*graph.groups, *graph.nodes):
+        css = _mermaid_css(item.style)
+        if css:
+            yield f"  style {ids[item.id]} {css}\n"
+    for index, edge in enumerate(graph.edges):
+        css = _mermaid_css(edge.style)
+        if css:
+            yield f"  linkStyle {index} {css}\n"
+
+
+_PLANTUML_SHAPES = {
+    "cylinder": "database", "queue": "queue", "package": "package", "person": "actor", "cloud": "cloud",
+    "hexagon": "hexagon", "circle": "circle", "oval": "usecase", "document": "file", "page": "file",
+    "stored_data": "storage", "step": "node", "text": "label",
+}
+
+
+def _plantuml_label(text: str) -> str:
+    # PlantUML strings have no escape for double quotes
+    return '"' + text.replace('"', "'").replace("\n", "\\n") + '"'
+
+
+def _plantuml_color(value: StyleValue) -> str:
+    return str(value).lstrip("#")
+
+
+def _plantuml_colors(style: Dict[str, StyleValue]) -> str:
+    # ``#back;line:color;line.dashed;text:color``, each part optional
+    parts = []
+    if "fill" in style:
+        parts.append(_plantuml_color(style["fill"]))
+    if "stroke" in style:
+        parts.append(f"line:{_plantuml_color(style['stroke'])}")
+    if style.get("stroke-dash") not in (None, 0, False):
+        parts.append("line.dashed")
+    if "font-color" in style:
+        parts.append(f"text:{_plantuml_color(style['font-color'])}")
+    return " #" + ";".join(parts) if parts else ""
+
+
+def _plantuml_arrow(style: Dict[str, StyleValue]) -> str:
+    options = []
+    if "stroke" in style:
+        options.append("#" + _plantuml_color(style["stroke"]))
+    if style.get("stroke-dash") not in (None, 0, False):
+        options.append("dashed")
+    if style.get("stroke-width") is not None and not isinstance(style["stroke-width"], bool):
+        options.append(f"thickness={style['stroke-width']}")
+    return f"-[{','.join(options)}]->" if options else "-->"
+
+
+def _plantuml_lines(graph: Graph) -> Iterator[str]:
+    groups, nodes = _members(graph)
+    ids = _safe_ids(graph)
+    yield "@startuml\n"
+    if graph.direction in ("right", "left"):
+        yield "left to right direction\n"
+
+    def members(parent: Optional[str], indent: str) -> Iterator[str]:
+        for group in groups.get(parent, ()):
+            yield (f"{indent}rectangle {_plantuml_label(group.label or group.id)} as {ids[group.id]}"
+                   f"{_plantuml_colors(group.style)} {{\n")
+            yield from members(group.id, indent + "  ")
+            yield f"{indent}}}\n"
+        for node in nodes.get(parent, ()):
+            element = _PLANTUML_SHAPES.get(node.shape, "rectangle")
+            yield (f"{indent}{element} {_plantuml_label(node.label or node.id)} as {ids[node.id]}"
+                   f"{_plantuml_colors(node.style)}\n")
+
+    yield from members(None, "")
+    for edge in graph.edges:
+        label = f" : {edge.label.replace(chr(10), ' ')}" if edge.label else ""
+        yield f"{ids[edge.source]} {_plantuml_arrow(edge.style)} {ids[edge.target]}{label}\n"
+    yield "@enduml\n"
+
+
+_WRITERS = {"d2": _d2_lines, "mermaid": _mermaid_lines, "plantuml": _plantuml_lines}
+
+
+def compile_graph(graph: Graph, lang: str) -> Iterator[str]:
+    """
+    Write ``graph`` as ``lang`` source, a few lines at a time.
+
+    The graph must have passed :func:`check_graph`.
+
+    Args:
+        graph: The graph
+        lang: One of ``GRAPH_LANGS``
+
+    Returns:
+        An iterator of source chunks whose concatenation is the diagram
+
+    Raises:
+        GraphError: If ``lang`` is not supported
+    """
+    writer = _WRITERS.get(lang)
+    if writer is None:
+        raise GraphError(f"Cannot compile graphs to {lang}. Choose from {', '.join(GRAPH_LANGS)}.")
+    return writer(graph)
@@ -6,11 +6,17 @@ Kroki is a unified API for generating diagrams from textual descriptions.
 """
 
 import base64
+import struct
 import zlib
 import httpx
 import logging
 import json
-from typing import Dict, List, Optional, Tuple, Union
+import re
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from plantuml import plantuml_encode
+from server.pool import UNIX_MOUNT, UNIX_SCHEME, UnixSocketTransport, request_timeout, resolve_url, shared_client
+from server.timing import phase
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +52,12 @@ LANGUAGE_OUTPUT_SUPPORT = {
     "wireviz": ["png", "svg"],
 }
 
+# Diagram types using the PlantUML preprocessor (and so ``!include``)
+PLANTUML_TYPES = ("plantuml", "c4plantuml")
+
+# Header zlib.compressobj(level=9) writes in front of the raw deflate data
+_ZLIB_HEADER = b"\x78\xda"
+
 
 class KrokiError(Exception):
     """Base exception for Kroki errors."""
@@ -58,15 +70,41 @@ class KrokiConnectionError(KrokiError):
 
 
 class KrokiHTTPError(KrokiError):
-    """Request to Kroki server returned HTTP Error."""
+    """Request to Kroki server returned HTTP Error.
+    
+    Attributes:
+        diagram_error: The message of a 400 response, i.e. why the diagram
+            was rejected (None for other errors).
+        diagram_error_line: The 1-based line that message points at, when
+            it names one.
+    """
     def __init__(self, response, content):
         self.response = response
         self.content = content
         self.url = response.url
         self.message = f"HTTP Error: {self.url} {response.status_code}"
+        self.diagram_error, self.diagram_error_line = _diagram_error(response.status_code, content)
         super(KrokiHTTPError, self).__init__(self.message)
 
 
+# "... (line: 3)", "syntax error in line 3", "Parse error on line 3:", d2's "-:3:7: ..."
+_ERROR_LINE = re.compile(r"\bline:?\s*(\d+)|(?:^|\s)\S*?:(\d+):\d+:", re.IGNORECASE)
+_ERROR_PREFIX = re.compile(r"^Error(?: \d{3})?:\s*")
+
+
+def _diagram_error(status_code: int, content) -> Tuple[Optional[str], Optional[int]]:
+    """Message and line of a Kroki 400 response body."""
+    if status_code != 400 or not content:
+        return None, None
+    text = content.decode("utf-8", "replace") if isinstance(content, bytes) else str(content)
+    lines = [line.strip() for line in text.strip().splitlines() if line.strip()]
+    if not lines:
+        return None, None
+    message = _ERROR_PREFIX.sub("", " ".join(lines[:3]))[:500]
+    match = _ERROR_LINE.search(text)
+    return message, int(match.group(1) or match.group(2)) if match else None
+
+
 class Kroki:
     """Client for the Kroki diagram generation service.
     
@@ -87,20 +125,45 @@ class Kroki:
         "graphviz": "https://dreampuf.github.io/GraphvizOnline/#",
     }
     
-    def __init__(self, base_url: str = "https://kroki.io", **http_opts):
+    def __init__(self, base_url: str = "https://kroki.io", client: Optional[httpx.Client] = None,
+                 includes=None, **http_opts):
         """
         Initialize the Kroki client.
         
         Args:
-            base_url: The base URL of the Kroki service.
+            base_url: The base URL of the Kroki service, or
+                ``unix:///path/to/kroki.sock`` for one on a Unix domain socket.
+            client: An existing httpx client to reuse (e.g. the shared
+                upstream pool); ``http_opts`` are ignored when it is given.
+            includes: A :class:`plantuml.includes.IncludeResolver` inlining
+                local ``!include`` files of PlantUML-based diagrams.
             **http_opts: Additional options to pass to the httpx client.
         """
-        self.base_url = base_url.rstrip("/")
-        client_opts = dict(http_opts)
-        proxies = client_opts.pop("proxies", None)
-        if proxies is not None:
-            client_opts["proxy"] = proxies
-        self.client = httpx.Client(**client_opts)
+        self.base_url = resolve_url(base_url).rstrip("/")
+        self.includes = includes
+        self._deflated: Optional[Tuple[str, bytes]] = None
+        # Only a client created here is closed by close()
+        self._owns_client = client is None
+        if client is None:
+            client_opts = dict(http_opts)
+            proxies = client_opts.pop("proxies", None)
+            if proxies is not None:
+                client_opts["proxy"] = proxies
+            if base_url.startswith(UNIX_SCHEME):
+                client_opts["mounts"] = {UNIX_MOUNT: UnixSocketTransport(), **client_opts.get("mounts", {})}
+            client = httpx.Client(**client_opts)
+        self.client = client
+
+    def close(self) -> None:
+        """Close the HTTP client if this instance created it; a shared one is left open."""
+        if self._owns_client:
+            self.client.close()
+
+    def __enter__(self) -> "Kroki":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
     
     def get_url(self, diagram_type: str, diagram_text: str, output_format: str = "svg") -> str:
         """
@@ -117,6 +180,33 @@ class Kroki:
         Raises:
             ValueError: If the diagram type or output format is not supported
         """
+        self._check_output(diagram_type, output_format)
+        with phase("encode"):
+            if self.includes is not None and diagram_type in PLANTUML_TYPES:
+                diagram_text = self.includes.inline(diagram_text)
+            encoded_diagram = self.deflate_and_encode(diagram_text)
+        return f"{self.base_url}/{diagram_type}/{output_format}/{encoded_diagram}"
+
+    def get_deflated_url(self, diagram_type: str, data: bytes, checksum: int, output_format: str = "svg") -> str:
+        """
+        Generate the URL for a diagram already compressed with :meth:`deflate_stream`.
+        
+        Args:
+            diagram_type: The type of diagram (plantuml, mermaid, etc.)
+            data: Raw deflate data of the diagram text
+            checksum: Adler-32 of the diagram text
+            output_format: The desired output format (svg, png, etc.)
+            
+        Returns:
+            The URL where the diagram can be accessed
+            
+        Raises:
+            ValueError: If the diagram type or output format is not supported
+        """
+        self._check_output(diagram_type, output_format)
+        return f"{self.base_url}/{diagram_type}/{output_format}/{self._encode_deflated(data, checksum)}"
+
+    def _check_output(self, diagram_type: str, output_format: str) -> None:
         if diagram_type not in self.DIAGRAM_TYPES:
             raise ValueError(f"Unsupported diagram type: {diagram_type}")
         
@@ -126,9 +216,6 @@ class Kroki:
                 f"Unsupported output format '{output_format}' for {diagram_type}. "
                 f"Supported formats: {', '.join(supported_formats)}"
             )
-            
-        encoded_diagram = self.deflate_and_encode(diagram_text)
-        return f"{self.base_url}/{diagram_type}/{output_format}/{encoded_diagram}"
     
     def get_playground_url(self, diagram_type: str, diagram_text: str) -> Optional[str]:
         """
@@ -145,11 +232,16 @@ class Kroki:
             return None
             
         base_playground = self.DIAGRAM_PLAYGROUNDS[diagram_type]
-        
+        with phase("encode"):
+            return f"{base_playground}{self._encode_for_playground(diagram_type, diagram_text)}"
+
+    def _encode_for_playground(self, diagram_type: str, diagram_text: str) -> str:
         # Different encodings for different playgrounds
         if diagram_type == "plantuml":
-            encoded = self.encode_plantuml(diagram_text)
-            return f"{base_playground}{encoded}"
+            # The playground cannot read local includes either
+            if self.includes is not None:
+                diagram_text = self.includes.inline(diagram_text)
+            return self.encode_plantuml(diagram_text)
         elif diagram_type == "mermaid":
             # Mermaid uses a special pako encoding
             state = {
@@ -159,12 +251,10 @@ class Kroki:
                 "autoSync": True,
                 "updateDiagram": True
             }
-            serialized_state = self.serialize_state(state)
-            return f"{base_playground}{serialized_state}"
+            return self.serialize_state(state)
         else:
             # Default: Just URI-encode the diagram text
-            encoded = base64.urlsafe_b64encode(diagram_text.encode('utf-8')).decode('utf-8')
-            return f"{base_playground}{encoded}"
+            return base64.urlsafe_b64encode(diagram_text.encode('utf-8')).decode('utf-8')
     
     def render_diagram(self, diagram_type: str, diagram_text: str, output_format: str = "svg") -> bytes:
         """
@@ -185,7 +275,8 @@ class Kroki:
         url = self.get_url(diagram_type, diagram_text, output_format)
         
         try:
-            response = self.client.get(url)
+            with phase("upstream"):
+                response = self.client.get(url, timeout=request_timeout(self.client))
             response.raise_for_status()
         except httpx.HTTPStatusError as e:
             raise KrokiHTTPError(e.response, e.response.content)
@@ -217,7 +308,8 @@ class Kroki:
         playground = self.get_playground_url(diagram_type, diagram_text)
         
         try:
-            response = self.client.get(url)
+            with phase("upstream"):
+                response = self.client.get(url, timeout=request_timeout(self.client))
             response.raise_for_status()
             content = response.content
         except httpx.HTTPStatusError as e:
@@ -231,113 +323,103 @@ class Kroki:
             "playground": playground
         }
     
-    def deflate_and_encode(self, text: str) -> str:
+    def deflate(self, text: str) -> bytes:
         """
-        Compress the text with zlib and encode it for the Kroki server.
+        Compress the text into a raw deflate stream (level 9, no zlib wrapper).
+        
+        The Kroki and PlantUML encodings only differ in the wrapper and the
+        alphabet around this stream, so the last result is kept: the URL and
+        the playground link of one source cost a single compression pass.
         
         Args:
-            text: The text to compress and encode
+            text: The text to compress
             
         Returns:
-            The compressed and encoded text
+            The raw deflate data
         """
-        if not text:
-            return ""
-        
-        try:
-            compress_obj = zlib.compressobj(level=9, method=zlib.DEFLATED, wbits=15,
-                                           memLevel=8, strategy=zlib.Z_DEFAULT_STRATEGY)
-            compressed_data = compress_obj.compress(text.encode('utf-8'))
-            compressed_data += compress_obj.flush()
-            
-            encoded = base64.urlsafe_b64encode(compressed_data).decode('ascii')
-            return encoded.replace('+', '-').replace('/', '_')
-        except Exception as e:
-            logger.error(f"Error compressing and encoding text: {str(e)}")
-            raise
-    
-    def encode_plantuml(self, text: str) -> str:
+        deflated = self._deflated
+        if deflated is not None and deflated[0] == text:
+            return deflated[1]
+        compress_obj = zlib.compressobj(level=9, method=zlib.DEFLATED, wbits=-15,
+                                       memLevel=8, strategy=zlib.Z_DEFAULT_STRATEGY)
+        data = compress_obj.compress(text.encode('utf-8')) + compress_obj.flush()
+        self._deflated = (text, data)
+        return data
+
+    def deflate_stream(self, chunks: Iterable[str], batch_size: int = 65536) -> Tuple[bytes, int]:
         """
-        Encode text for PlantUML server.
+        Compress text produced piece by piece, without joining it first.
+        
+        Pieces are gathered into batches of about ``batch_size`` characters
+        before they reach the compressor, so generators yielding one line at
+        a time stay cheap.
         
         Args:
-            text: The PlantUML diagram text
+            chunks: The text, in order
+            batch_size: Characters compressed per call
             
         Returns:
-            The encoded text suitable for PlantUML server URLs
+            The raw deflate data (as :meth:`deflate` would produce for the
+            joined text) and the Adler-32 checksum of the text
         """
-        zlibbed_str = zlib.compress(text.encode('utf-8'))
-        compressed_str = zlibbed_str[2:-4]  # Remove zlib header and checksum
-        
-        # PlantUML uses a custom encoding
-        res = ""
-        for i in range(0, len(compressed_str), 3):
-            if i + 2 == len(compressed_str):
-                res += self._encode_3bytes(
-                    compressed_str[i], 
-                    compressed_str[i + 1], 
-                    0
-                )
-            elif i + 1 == len(compressed_str):
-                res += self._encode_3bytes(
-                    compressed_str[i], 
-                    0, 
-                    0
-                )
-            else:
-                res += self._encode_3bytes(
-                    compressed_str[i], 
-                    compressed_str[i + 1], 
-                    compressed_str[i + 2]
-                )
-        return res
+        compress_obj = zlib.compressobj(level=9, method=zlib.DEFLATED, wbits=-15,
+                                       memLevel=8, strategy=zlib.Z_DEFAULT_STRATEGY)
+        output: List[bytes] = []
+        checksum = zlib.adler32(b"")
+        batch: List[str] = []
+        size = 0
+        for chunk in chunks:
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= batch_size:
+                data = "".join(batch).encode("utf-8")
+                checksum = zlib.adler32(data, checksum)
+                output.append(compress_obj.compress(data))
+                batch, size = [], 0
+        data = "".join(batch).encode("utf-8")
+        checksum = zlib.adler32(data, checksum)
+        output.append(compress_obj.compress(data))
+        output.append(compress_obj.flush())
+        return b"".join(output), checksum
     
-    def _encode_3bytes(self, b1: int, b2: int, b3: int) -> str:
+    def deflate_and_encode(self, text: str) -> str:
         """
-        Encode 3 bytes using PlantUML's encoding.
+        Compress the text with zlib and encode it for the Kroki server.
         
         Args:
-            b1: First byte
-            b2: Second byte
-            b3: Third byte
+            text: The text to compress and encode
             
         Returns:
-            Four encoded characters
+            The compressed and encoded text
         """
-        c1 = b1 >> 2
-        c2 = ((b1 & 0x3) << 4) | (b2 >> 4)
-        c3 = ((b2 & 0xF) << 2) | (b3 >> 6)
-        c4 = b3 & 0x3F
+        if not text:
+            return ""
         
-        res = ""
-        res += self._encode_6bit(c1 & 0x3F)
-        res += self._encode_6bit(c2 & 0x3F)
-        res += self._encode_6bit(c3 & 0x3F)
-        res += self._encode_6bit(c4 & 0x3F)
-        return res
+        try:
+            return self._encode_deflated(self.deflate(text), zlib.adler32(text.encode('utf-8')))
+        except Exception as e:
+            logger.error("Error compressing and encoding text: %s", e)
+            raise
+
+    @staticmethod
+    def _encode_deflated(data: bytes, checksum: int) -> str:
+        # Same bytes as a level 9 zlib stream, built around the raw deflate data
+        compressed_data = _ZLIB_HEADER + data + struct.pack(">I", checksum)
+        encoded = base64.urlsafe_b64encode(compressed_data).decode('ascii')
+        return encoded.replace('+', '-').replace('/', '_')
     
-    def _encode_6bit(self, b: int) -> str:
+    def encode_plantuml(self, text: str) -> str:
         """
-        Encode 6 bits using PlantUML's encoding.
+        Encode text for PlantUML server.
         
         Args:
-            b: The 6 bits to encode
+            text: The PlantUML diagram text
             
         Returns:
-            A single encoded character
+            The encoded text suitable for PlantUML server URLs
         """
-        if b < 10:
-            return chr(48 + b)
-        b -= 10
-        if b < 26:
-            return chr(65 + b)
-        b -= 26
-        if b < 26:
-            return chr(97 + b)
-        b -= 26
-        if b == 0:
-            return '-'
-        return '_' if b == 1 else '?'
+        # PlantUML takes the raw deflate data in its own base64 alphabet
+        return plantuml_encode(self.deflate(text))
     
     def serialize_state(self, state: Dict) -> str:
         """
@@ -372,11 +454,12 @@ def generate_kroki_url(diagram_type: str, diagram_source: str, output_format: st
     Returns:
         URL for the diagram
     """
-    kroki = Kroki()
+    kroki = Kroki(client=shared_client())
     return kroki.get_url(diagram_type, diagram_source, output_format)
 
 
-async def generate_diagram(diagram_type: str, diagram_source: str, output_format: str = "svg") -> Tuple[str, str, str]:
+async def generate_diagram(diagram_type: str, diagram_source: str, output_format: str = "svg",
+                           includes=None) -> Tuple[str, str, str]:
     """
     Generate a diagram using Kroki API
     
@@ -384,12 +467,13 @@ async def generate_diagram(diagram_type: str, diagram_source: str, output_format
         diagram_type: Type of diagram (e.g., "plantuml", "mermaid")
         diagram_source: Source code for the diagram
         output_format: Output format (e.g., "svg", "png")
+        includes: Optional :class:`plantuml.includes.IncludeResolver`
         
     Returns:
         Tuple of (url, content, playground_url)
     """
     try:
-        kroki = Kroki()
+        kroki = Kroki(client=shared_client(), includes=includes)
         url = kroki.get_url(diagram_type, diagram_source, output_format)
         playground = kroki.get_playground_url(diagram_type, diagram_source)
         
@@ -398,5 +482,5 @@ async def generate_diagram(diagram_type: str, diagram_source: str, output_format
         
         return url, content, playground or ""
     except Exception as e:
-        logger.error(f"Error generating {diagram_type} diagram: {str(e)}")
+        logger.error("Error generating %s diagram: %s", diagram_type, e)
         raise
@@ -4,6 +4,9 @@ import json
 from urllib.parse import quote, unquote
 import logging
 
+from server.inflate import check_encoded_size, inflate
+from server.timing import phase
+
 logger = logging.getLogger(__name__)
 
 def js_encode_uri_component(data):
@@ -52,6 +55,7 @@ class PakoSerde(Serde):
         return result + '=' * ((4 - len(result) % 4) % 4)
 
     def deserialize(self, state: str) -> str:
+        check_encoded_size(len(state), ratio=4 / 3)
         data = base64.urlsafe_b64decode(state)
         decompressed = self.pako_inflate(data)
         return decompressed.decode('utf-8')
@@ -63,11 +67,9 @@ class PakoSerde(Serde):
         compressed_data += compress.flush()
         return compressed_data
 
-    def pako_inflate(self, data):
-        decompress = zlib.decompressobj(15)
-        decompressed_data = decompress.decompress(data)
-        decompressed_data += decompress.flush()
-        return decompressed_data
+    def pako_inflate(self, data, max_length=None):
+        # Bounded: states come from untrusted links (see server/inflate.py)
+        return inflate(data, 15, max_length=max_length)
 
 SERDES = {
     "base64": Base64Serde(),
@@ -77,8 +79,9 @@ SERDES = {
 def serialize_state(state: dict, serde: str = "pako") -> str:
     if serde not in SERDES:
         raise ValueError(f"Unknown serde type: {serde}")
-    json_str = json.dumps(state)
-    serialized = SERDES[serde].serialize(json_str)
+    with phase("encode"):
+        json_str = json.dumps(state)
+        serialized = SERDES[serde].serialize(json_str)
     return f"{serde}:{serialized}"
 
 def deserialize_state(state: str) -> dict:
@@ -8,13 +8,42 @@ PlantUML markup into PNG images.
 
 from os import makedirs, path
 from io import open
-from typing import Optional, Tuple
-from zlib import compress
+from typing import List, Optional, Tuple
+from zlib import compress, MAX_WBITS
+import asyncio
+import base64
 import httpx
 import logging
 
+from plantuml.pages import count_pages, locate_documents, page_count, split_documents
+from server.inflate import check_encoded_size, inflate
+from server.pool import UNIX_MOUNT, UNIX_SCHEME, UnixSocketTransport, request_timeout, resolve_url
+from server.timing import phase
+
 logger = logging.getLogger(__name__)
 
+# PlantUML's base64 variant: same bit layout as RFC 4648, different alphabet.
+PLANTUML_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
+BASE64_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+_FROM_PLANTUML = str.maketrans(PLANTUML_ALPHABET, BASE64_ALPHABET)
+_TO_PLANTUML = str.maketrans(BASE64_ALPHABET, PLANTUML_ALPHABET)
+
+
+def plantuml_encode(data: bytes) -> str:
+    """Encode bytes (usually a raw deflate stream) in PlantUML's base64.
+
+    The last group is padded with zero bytes instead of ``=``, as the
+    server expects, so this is standard base64 of the padded data with the
+    alphabet swapped.
+
+    :param bytes data: The data to encode
+    :returns: The encoded data
+    """
+    padding = -len(data) % 3
+    if padding:
+        data += b"\0" * padding
+    return base64.b64encode(data).decode("ascii").translate(_TO_PLANTUML)
+
 """
 Exceptions for PlantUML.
 """
@@ -37,6 +66,10 @@ class PlantUMLConnectionError(PlantUMLError):
 class PlantUMLHTTPError(Exception):
     """
     Request to PlantUML server returned HTTP Error.
+
+    When the server rejected the diagram itself, ``diagram_error`` and
+    ``diagram_error_line`` hold the message and 1-based line it reported in
+    the ``X-PlantUML-Diagram-Error`` headers (None otherwise).
     """
     def __init__(self, response, content):
         self.response = response
@@ -44,9 +77,30 @@ class PlantUMLHTTPError(Exception):
         self.url = getattr(response, "request", None)
         self.url = self.url.url if self.url else "unknown URL"
         self.message = f"HTTP Error : {self.url} {response}"
+        self.diagram_error, self.diagram_error_line = _diagram_error(response)
         super(PlantUMLHTTPError, self).__init__(self.message)
 
 
+def _relocate(error: PlantUMLHTTPError, offset: Optional[int]) -> PlantUMLHTTPError:
+    """Shift the reported line by the ``offset`` of the text sent, or drop it when unknown (None)."""
+    if error.diagram_error_line is not None:
+        error.diagram_error_line = error.diagram_error_line + offset if offset is not None else None
+    return error
+
+
+def _diagram_error(response) -> Tuple[Optional[str], Optional[int]]:
+    """The syntax error reported by the server, from a response or an error wrapping one."""
+    if isinstance(response, PlantUMLHTTPError):
+        return response.diagram_error, response.diagram_error_line
+    if isinstance(response, httpx.HTTPStatusError):
+        response = response.response
+    headers = getattr(response, "headers", None)
+    if not isinstance(headers, httpx.Headers) or "X-PlantUML-Diagram-Error" not in headers:
+        return None, None
+    line = headers.get("X-PlantUML-Diagram-Error-Line", "")
+    return headers["X-PlantUML-Diagram-Error"], int(line) if line.isdigit() else None
+
+
 # Example usage
 diagram = """
 @startuml
@@ -66,6 +120,8 @@ class PlantUML:
 
     :param str url: URL to the PlantUML server image CGI. defaults to
                     http://www.plantuml.com/plantuml/img/
+                    A server on a Unix domain socket is given as
+                    ``unix:///path/to/server.sock/plantuml/png``.
     :param dict basic_auth: This is if the plantuml server requires basic HTTP
                     authentication. Dictionary containing two keys, 'username'
                     and 'password', set to appropriate values for basic HTTP
@@ -84,9 +140,15 @@ class PlantUML:
                     httplib2.Http() constructor.
     :param dict request_opts: Extra options to be passed off to the
                     httplib2.Http().request() call.
+    :param client: An existing ``httpx.Client`` to send requests with, e.g.
+                    the shared upstream pool; ``http_opts`` is ignored then.
+                    Do not combine a shared client with authentication.
+    :param includes: An :class:`~plantuml.includes.IncludeResolver` inlining
+                    local ``!include`` files before encoding.
 
     """
-    def __init__(self, url: str, basic_auth: dict = None, form_auth: dict = None, http_opts: dict = None, request_opts: dict = None) -> None:
+    def __init__(self, url: str, basic_auth: dict = None, form_auth: dict = None, http_opts: dict = None, request_opts: dict = None,
+                 client: Optional[httpx.Client] = None, includes=None) -> None:
 
         if basic_auth is None:
             basic_auth = {}
@@ -97,18 +159,25 @@ class PlantUML:
         if request_opts is None:
             request_opts = {}
 
-        self.url = url
+        self.url = resolve_url(url)
         self.request_opts = request_opts
+        self.includes = includes
 
         if auth_type := 'basic_auth' if basic_auth else ('form_auth' if form_auth else None):
             self.auth_type = auth_type
 
         self.auth = basic_auth or form_auth or None
-        client_opts = dict(http_opts)
-        proxies = client_opts.pop("proxies", None)
-        if proxies is not None:
-            client_opts["proxy"] = proxies
-        self.client = httpx.Client(**client_opts)
+        # Only a client created here is closed by close()
+        self._owns_client = client is None
+        if client is None:
+            client_opts = dict(http_opts)
+            proxies = client_opts.pop("proxies", None)
+            if proxies is not None:
+                client_opts["proxy"] = proxies
+            if url.startswith(UNIX_SCHEME):
+                client_opts["mounts"] = {UNIX_MOUNT: UnixSocketTransport(), **client_opts.get("mounts", {})}
+            client = httpx.Client(**client_opts)
+        self.client = client
 
         if auth_type == 'basic_auth':
             self.client.auth = (username := self.auth['username'], self.auth['password'])
@@ -128,6 +197,17 @@ class PlantUML:
                 f"{name}={value}" for name, value in response.cookies.items()
             )
 
+    def close(self) -> None:
+        """Close the HTTP client if this instance created it; a shared one is left open."""
+        if self._owns_client:
+            self.client.close()
+
+    def __enter__(self) -> "PlantUML":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
     def get_url(self, plantuml_text):
         """Return the server URL for the image.
         You can use this URL in an IMG HTML tag.
@@ -135,7 +215,73 @@ class PlantUML:
         :param str plantuml_text: The plantuml markup to render
         :returns: the plantuml server image URL
         """
-        return f'{self.url}/{self.deflate_and_encode(plantuml_text)}'
+        with phase("encode"):
+            encoded = self.deflate_and_encode(self._inline(plantuml_text))
+        return f'{self.url}/{encoded}'
+
+    def _inline(self, plantuml_text: str) -> str:
+        return self.includes.inline(plantuml_text) if self.includes is not None else plantuml_text
+
+    def get_page_urls(self, plantuml_text: str) -> List[str]:
+        """Return the server URL of every page of the markup, in order.
+
+        Each ``@start``/``@end`` diagram is encoded on its own, and each
+        ``newpage`` of a diagram is addressed by its page index
+        (``<url>/<index>/<encoded>``). A single-page source gets the same
+        URL as :meth:`get_url`.
+
+        :param str plantuml_text: The plantuml markup to render
+        :returns: the plantuml server image URLs
+        """
+        return [url for url, _ in self._page_requests(plantuml_text)]
+
+    def _page_requests(self, plantuml_text: str) -> List[Tuple[str, Optional[int]]]:
+        """Page URLs, each with the line offset of its diagram in ``plantuml_text``
+        (None when inlined includes moved the lines)."""
+        with phase("encode"):
+            sent = self._inline(plantuml_text)
+            requests = []
+            for document, start in locate_documents(sent):
+                offset = start if sent == plantuml_text else None
+                encoded = self.deflate_and_encode(document)
+                pages = count_pages(document)
+                if pages == 1:
+                    requests.append((f'{self.url}/{encoded}', offset))
+                else:
+                    requests.extend((f'{self.url}/{index}/{encoded}', offset) for index in range(pages))
+        return requests
+
+    async def render_pages(self, plantuml_text: str, client: httpx.AsyncClient,
+                           concurrency: int = 4) -> List[Tuple[str, bytes]]:
+        """Render every page of the markup concurrently.
+
+        Up to ``concurrency`` pages are requested at once, so a short document
+        takes about as long as its slowest page and a long one cannot take
+        over the connection pool. A line reported by the server is moved to
+        the line of ``plantuml_text`` it refers to, or dropped when includes
+        were inlined.
+
+        :param str plantuml_text: The plantuml markup to render
+        :param client: The ``httpx.AsyncClient`` to send the requests with
+        :param int concurrency: Pages requested at once
+        :returns: ``(url, image data)`` of each page, in page order
+        :raises: PlantUMLHTTPError if any page failed
+        """
+        requests = self._page_requests(plantuml_text)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(url: str, offset: Optional[int]) -> bytes:
+            async with semaphore:
+                try:
+                    response = await client.get(url, timeout=request_timeout(client))
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    raise _relocate(PlantUMLHTTPError(e, ""), offset) from e
+            return response.content
+
+        with phase("upstream"):
+            contents = await asyncio.gather(*(fetch(url, offset) for url, offset in requests))
+        return [(url, content) for (url, _), content in zip(requests, contents)]
 
     def process(self, plantuml_text: str):
         """Processes the plantuml text into the raw PNG image data.
@@ -143,23 +289,49 @@ class PlantUML:
         :returns: the raw image data
         """
         url = self.get_url(plantuml_text)
+        self._fetch(url)
+        return url, plantuml_text
+
+    def render(self, plantuml_text: str) -> bytes:
+        """Render the plantuml text and return the image bytes.
+
+        The image format is the one of the server URL (``.../png``,
+        ``.../svg``).
+
+        :param str plantuml_text: The plantuml markup to render
+        :returns: the raw image data
+        :raises: PlantUMLHTTPError if there was an error
+        """
+        with phase("encode"):
+            sent = self._inline(plantuml_text)
+            url = f'{self.url}/{self.deflate_and_encode(sent)}'
+        try:
+            return self._fetch(url)
+        except PlantUMLHTTPError as e:
+            raise _relocate(e, 0 if sent == plantuml_text else None)
+
+    def _fetch(self, url: str) -> bytes:
         try:
-            response = self.client.get(url)
+            with phase("upstream"):
+                response = self.client.get(url, timeout=request_timeout(self.client))
             response.raise_for_status()
         except httpx.HTTPError as e:
             raise PlantUMLHTTPError(e, "") from e
-        return url, plantuml_text
+        return response.content
 
     def process_file(self, filename, outfile=None, errorfile=None, directory=''):
         """Take a filename of a file containing plantuml text and processes
         it into a .png image.
         ...
         """
-        data = open(filename).read()
+        if outfile is None:
+            outfile = path.splitext(filename)[0] + '.png'
+        if errorfile is None:
+            errorfile = path.splitext(filename)[0] + '_error.html'
+        with open(filename) as f:
+            data = f.read()
         try:
-            content, url = self.process(data)
-            if not content:  # Add this check
-                raise PlantUMLHTTPError("Server returned an error", "")
+            content = self.render(data)
         except PlantUMLHTTPError as e:
             with open(path.join(directory, errorfile), 'w') as err:
                 err.write(e.content)
@@ -187,15 +359,46 @@ class PlantUML:
         :param bytes data: The data to encode
         :returns: The encoded data
         """
-        res = ""
-        for i in range(0, len(data), 3):
-            if i + 2 == len(data):
-                res += self._encode3bytes(data[i], data[i + 1], 0)
-            elif i + 1 == len(data):
-                res += self._encode3bytes(data[i], 0, 0)
-            else:
-                res += self._encode3bytes(data[i], data[i + 1], data[i + 2])
-        return res
+        return plantuml_encode(data)
+
+
+    def decode(self, data: str) -> bytes:
+        """decode data produced by :meth:`encode` back into raw bytes.
+
+        The encoder pads the last group with zero bytes, so the result may
+        carry one or two trailing ``\\x00`` bytes; deflate streams ignore them.
+
+        :param str data: The encoded data
+        :returns: The decoded bytes
+        :raises: ValueError if the data contains characters outside the
+                 PlantUML alphabet
+        """
+        b64 = data.translate(_FROM_PLANTUML)
+        b64 += "=" * (-len(b64) % 4)
+        try:
+            return base64.b64decode(b64, validate=True)
+        except ValueError as e:
+            raise ValueError(f"Invalid PlantUML encoded data: {e}") from e
+
+
+    def decode_and_inflate(self, encoded: str) -> str:
+        """Reverse :meth:`deflate_and_encode` and return the plantuml markup.
+
+        Also accepts the ``~h`` (hex) and ``~1`` (deflate) prefixes used by
+        the PlantUML server.
+
+        :param str encoded: The encoded plantuml markup, as found in a URL
+        :returns: The plantuml markup
+        """
+        if encoded.startswith("~h"):
+            check_encoded_size(len(encoded) - 2, ratio=2)
+            return bytes.fromhex(encoded[2:]).decode('utf-8')
+        if encoded.startswith("~1"):
+            encoded = encoded[2:]
+        check_encoded_size(len(encoded), ratio=4 / 3)
+        data = self.decode(encoded)
+        # The decoder's zero padding is ignored after the end of the stream
+        return inflate(data, -MAX_WBITS).decode('utf-8')
 
 
     def _encode3bytes(self, b1: int, b2: int, b3: int):
@@ -258,18 +461,17 @@ class PlantUML:
 
 
 def generate_plantuml(text: str):
-    logger.info(f"Generating PlantUML diagram from text: {text}")
+    logger.debug("Generating PlantUML diagram", extra={"code_size": len(text)})
     text = text.replace("\n", " \n ").replace("\\n", f"{chr(13)}{chr(10)}")
     text = text.replace("@startuml", f"{chr(13)}{chr(10)}@startuml{chr(13)}{chr(10)}")
     text = text.replace("@enduml", f"{chr(13)}{chr(10)}@enduml{chr(13)}{chr(10)}")
-    logger.info(f"Text after replacing newlines: {text}")
     try:
-        plantuml = PlantUML(url="https://www.plantuml.com/plantuml/dpng")
-        url, content = plantuml.generate_image_from_string(text)
+        with PlantUML(url="https://www.plantuml.com/plantuml/dpng") as plantuml:
+            url, content = plantuml.generate_image_from_string(text)
         # with open(output_file, "wb") as f:
         #     f.write(content)
         playground = f"https://www.plantuml.com/plantuml/uml/{url.split('/')[-1]}"
         return url, content, playground
     except Exception as e:
-        logger.error(f"Error generating PlantUML diagram: {str(e)}")
+        logger.error("Error generating PlantUML diagram: %s", e)
         return None, None, None
\ No newline at end of file
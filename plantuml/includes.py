@@ -0,0 +1,298 @@
+"""
+Local ``!include`` inlining for PlantUML sources.
+
+Resolves ``!include``, ``!include_once``, ``!include_many`` and
+``!includesub`` directives against allow-listed local directories and
+replaces them with the referenced content before the source is encoded, so
+the upstream server never has to fetch includes itself. Parsed fragments are
+cached in memory, keyed by path and invalidated on modification.
+
+An include of a file that is already being expanded is left in place, so
+the server reports the recursion as PlantUML does, and inlining gives up
+(sending the source unchanged) once the result would exceed
+``_MAX_INLINED`` characters.
+
+Only what is used is inlined: procedures, functions and macros coming from
+included fragments are dropped unless the diagram (transitively) refers to
+them, and comment lines of fragments are removed. Standard library
+(``<C4/C4_Container>``) and URL includes are left to the server.
+
+Configuration (environment):
+    PLANTUML_INCLUDE_DIRS: ``os.pathsep`` separated directories includes may
+        be read from (unset disables inlining).
+"""
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+INCLUDE_DIRECTIVE = re.compile(
+    r"^\s*!(include|include_once|include_many|includesub|includeurl|import)\s+(.+?)\s*$", re.MULTILINE
+)
+_START = re.compile(r"^\s*@start\w+(?:\s*\(\s*id\s*=\s*([^)\s]+)\s*\))?")
+_END = re.compile(r"^\s*@end\w+")
+_START_SUB = re.compile(r"^\s*!startsub\s+(\w+)")
+_END_SUB = re.compile(r"^\s*!endsub\b")
+_DEFINITION = re.compile(
+    r"^\s*!(?:unquoted\s+)?(?:(procedure|function)|(definelong)|(define))\s+(\$?\w+)"
+)
+_DEFINITION_END = {"procedure": re.compile(r"^\s*!end(?:procedure|function)\b"),
+                   "definelong": re.compile(r"^\s*!enddefinelong\b")}
+# Names built at runtime cannot be tracked, so nothing may be pruned then
+_DYNAMIC_CALL = re.compile(r"%(?:call_user_func|invoke_procedure)\b")
+_MAX_DEPTH = 32
+# Characters of inlined content per source; stops ``!include_many`` fan-out
+_MAX_INLINED = 1 << 20
+
+
+class _Expansion:
+    """State of one :meth:`IncludeResolver.inline` call."""
+
+    def __init__(self):
+        self.lines: List[Tuple[str, bool]] = []
+        self.included: Set[str] = set()
+        self.size = 0
+
+
+class _TooLarge(Exception):
+    pass
+
+
+def split_target(target: str) -> Tuple[str, Optional[str]]:
+    """Split ``path!selector`` (block index, block id or sub name) of an include target."""
+    target = target.strip().strip('"')
+    path, _, selector = target.partition("!")
+    return path.strip(), selector.strip() or None
+
+
+def is_local_target(target: str) -> bool:
+    """Whether an include target names a local file (not the stdlib or a URL)."""
+    return not (target.startswith("<") or "://" in target)
+
+
+class Fragment:
+    """A parsed include file: its diagram blocks and ``!startsub`` sections."""
+
+    def __init__(self, text: str):
+        self.blocks: List[List[str]] = []
+        self.block_ids: Dict[str, int] = {}
+        self.subs: Dict[str, List[str]] = {}
+        loose: List[str] = []
+        current: Optional[List[str]] = None
+        open_subs: List[str] = []
+        in_comment = False
+        for line in text.splitlines():
+            stripped = line.strip()
+            # Comments are never needed upstream
+            if in_comment:
+                in_comment = not stripped.endswith("'/")
+                continue
+            if stripped.startswith("/'"):
+                in_comment = not (len(stripped) > 3 and stripped.endswith("'/"))
+                continue
+            if stripped.startswith("'") or not stripped:
+                continue
+            start = _START.match(line)
+            if start:
+                current = []
+                if start.group(1):
+                    self.block_ids[start.group(1)] = len(self.blocks)
+                self.blocks.append(current)
+                continue
+            if _END.match(line):
+                current = None
+                continue
+            sub = _START_SUB.match(line)
+            if sub:
+                open_subs.append(sub.group(1))
+                self.subs.setdefault(sub.group(1), [])
+                continue
+            if _END_SUB.match(line):
+                if open_subs:
+                    open_subs.pop()
+                continue
+            for name in open_subs:
+                self.subs[name].append(line)
+            (current if current is not None else loose).append(line)
+        if not self.blocks:
+            self.blocks.append(loose)
+
+    def select(self, selector: Optional[str], sub: bool) -> Optional[List[str]]:
+        if sub:
+            return self.subs.get(selector or "")
+        if selector is None:
+            return self.blocks[0]
+        if selector.isdigit():
+            index = int(selector)
+            return self.blocks[index] if index < len(self.blocks) else None
+        index = self.block_ids.get(selector)
+        return self.blocks[index] if index is not None else None
+
+
+class IncludeResolver:
+    """Inline local includes from allow-listed directories.
+
+    :param include_dirs: Directories includes may be read from; targets
+                    resolving anywhere else are left untouched.
+    :param cache_size: Number of parsed fragments kept in memory.
+    :param prune: Drop procedures, functions and macros of included
+                    fragments that the diagram does not use.
+    """
+
+    def __init__(self, include_dirs: List[str], cache_size: int = 256, prune: bool = True):
+        self.include_dirs = [os.path.realpath(d) for d in include_dirs]
+        self.cache_size = cache_size
+        self.prune = prune
+        self._fragments: "OrderedDict[str, Tuple[int, int, Fragment]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["IncludeResolver"]:
+        """The resolver configured by ``PLANTUML_INCLUDE_DIRS``, or None."""
+        dirs = [d for d in os.environ.get("PLANTUML_INCLUDE_DIRS", "").split(os.pathsep) if d]
+        return cls(dirs) if dirs else None
+
+    def _allowed(self, path: str) -> bool:
+        return any(path == d or path.startswith(d + os.sep) for d in self.include_dirs)
+
+    def _locate(self, target: str, base: Optional[str]) -> Optional[str]:
+        for directory in ([base] if base else []) + self.include_dirs:
+            candidate = os.path.realpath(os.path.join(directory, target))
+            if self._allowed(candidate) and os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def _fragment(self, path: str) -> Fragment:
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._fragments.get(path)
+            if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._fragments.move_to_end(path)
+                return cached[2]
+        with open(path, encoding="utf-8") as f:
+            fragment = Fragment(f.read())
+        with self._lock:
+            self._fragments[path] = (stat.st_mtime_ns, stat.st_size, fragment)
+            if len(self._fragments) > self.cache_size:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def inline(self, plantuml_text: str) -> str:
+        """Return ``plantuml_text`` with its local includes replaced by their content.
+
+        :param str plantuml_text: The plantuml markup
+        :returns: The self-contained markup (unchanged when nothing resolves)
+        """
+        if "!include" not in plantuml_text:
+            return plantuml_text
+        expansion = _Expansion()
+        try:
+            if not self._expand(plantuml_text.splitlines(), None, False, expansion, ()):
+                return plantuml_text
+        except _TooLarge:
+            logger.warning("Includes expand to more than %d characters; leaving them to the server", _MAX_INLINED)
+            return plantuml_text
+        lines = expansion.lines
+        if self.prune and not any(_DYNAMIC_CALL.search(line) for line, _ in lines):
+            lines = _prune_definitions(lines)
+        return "\n".join(line for line, _ in lines)
+
+    def _expand(self, source: List[str], base: Optional[str], from_fragment: bool,
+                expansion: _Expansion, stack: Tuple[str, ...]) -> bool:
+        """Append ``(line, from_fragment)`` pairs to ``expansion.lines``; return whether anything was inlined.
+
+        :param stack: Files being expanded, outermost first
+        """
+        out = expansion.lines
+        inlined = False
+        for line in source:
+            match = INCLUDE_DIRECTIVE.match(line)
+            if not match or match.group(1) in ("includeurl", "import") or len(stack) >= _MAX_DEPTH:
+                out.append((line, from_fragment))
+                continue
+            kind = match.group(1)
+            path, selector = split_target(match.group(2))
+            located = self._locate(path, base) if is_local_target(path) else None
+            if located is None:
+                out.append((line, from_fragment))
+                continue
+            if located in stack:
+                # PlantUML refuses recursive includes; keep the directive so the server says so
+                logger.warning("Recursive include of %s", located)
+                out.append((line, from_fragment))
+                continue
+            key = f"{located}!{selector or ''}"
+            if kind == "include_once" and key in expansion.included:
+                continue
+            try:
+                body = self._fragment(located).select(selector, kind == "includesub")
+            except (OSError, ValueError) as e:
+                logger.warning("Could not read include %s: %s", located, e)
+                body = None
+            if body is None:
+                out.append((line, from_fragment))
+                continue
+            expansion.size += sum(len(part) + 1 for part in body)
+            if expansion.size > _MAX_INLINED:
+                raise _TooLarge()
+            expansion.included.add(key)
+            self._expand(body, os.path.dirname(located), True, expansion, stack + (located,))
+            inlined = True
+        return inlined
+
+
+def _prune_definitions(lines: List[Tuple[str, bool]]) -> List[Tuple[str, bool]]:
+    """Drop definitions of included fragments that nothing live refers to."""
+    # Split fragment lines into definition blocks and everything else
+    blocks: List[Tuple[Optional[str], List[int]]] = []
+    index = 0
+    while index < len(lines):
+        line, from_fragment = lines[index]
+        match = _DEFINITION.match(line) if from_fragment else None
+        if not match:
+            blocks.append((None, [index]))
+            index += 1
+            continue
+        kind = "procedure" if match.group(1) else "definelong" if match.group(2) else None
+        name = match.group(4)
+        members = [index]
+        # One-line forms: ``!define``, ``!function $f() !return ...``
+        if kind and "!return" not in line.split(name, 1)[1]:
+            end = _DEFINITION_END[kind]
+            while index + 1 < len(lines) and not end.match(lines[index + 1][0]):
+                index += 1
+                members.append(index)
+            if index + 1 < len(lines):
+                index += 1
+                members.append(index)
+        blocks.append((name, members))
+        index += 1
+
+    names = {name for name, _ in blocks if name}
+    if not names:
+        return lines
+    reference = re.compile(r"(?<![\w$])(" + "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True)) + r")(?!\w)")
+
+    def referenced(members: List[int], skip_header: bool) -> Set[str]:
+        text = "\n".join(lines[i][0] for i in (members[1:] if skip_header else members))
+        return set(reference.findall(text))
+
+    definitions: Dict[str, List[List[int]]] = {}
+    live: Set[str] = set()
+    for name, members in blocks:
+        if name is None:
+            live |= referenced(members, False)
+        else:
+            definitions.setdefault(name, []).append(members)
+    pending = list(live)
+    while pending:
+        for members in definitions.get(pending.pop(), ()):
+            for found in referenced(members, True) - live:
+                live.add(found)
+                pending.append(found)
+    return [lines[i] for name, members in blocks if name is None or name in live for i in members]
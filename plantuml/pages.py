@@ -0,0 +1,86 @@
+"""
+Page splitting of multi-page PlantUML documents.
+
+A source may hold several diagrams (``@startuml`` ... ``@enduml`` blocks one
+after the other) and each diagram may span several pages separated by
+``newpage``. The PlantUML server renders one page per request: the first
+page of the first diagram unless the URL carries a page index
+(``/png/1/<encoded>``). :func:`split_documents` and :func:`count_pages`
+give the requests needed to get every page, in reading order;
+:func:`page_count` their number.
+"""
+
+import re
+from typing import List, Tuple
+
+_START = re.compile(r"^\s*@start\w+")
+_END = re.compile(r"^\s*@end\w+")
+_NEWPAGE = re.compile(r"^\s*newpage\b", re.IGNORECASE)
+
+
+def split_documents(plantuml_text: str) -> List[str]:
+    """Split the markup into its ``@start``/``@end`` diagrams.
+
+    Text outside the blocks is dropped. A source with at most one block is
+    returned unchanged.
+
+    :param str plantuml_text: The plantuml markup
+    :returns: One markup string per diagram
+    """
+    return [document for document, _ in locate_documents(plantuml_text)]
+
+
+def locate_documents(plantuml_text: str) -> List[Tuple[str, int]]:
+    """:func:`split_documents`, each diagram with the 0-based line of the markup it starts on.
+
+    :param str plantuml_text: The plantuml markup
+    :returns: ``(diagram markup, first line index)`` pairs
+    """
+    documents: List[Tuple[str, int]] = []
+    current: List[str] = []
+    start = 0
+    inside = False
+    for index, line in enumerate(plantuml_text.splitlines()):
+        if not inside and _START.match(line):
+            inside = True
+            current = [line]
+            start = index
+        elif inside:
+            current.append(line)
+            if _END.match(line):
+                documents.append(("\n".join(current), start))
+                inside = False
+    if inside:
+        # Unterminated last block: the server still renders it
+        documents.append(("\n".join(current), start))
+    return documents if len(documents) > 1 else [(plantuml_text, 0)]
+
+
+def count_pages(document: str) -> int:
+    """Number of pages of one diagram: its ``newpage`` separators plus one.
+
+    Separators inside block comments do not count.
+
+    :param str document: The markup of a single diagram
+    """
+    pages = 1
+    in_comment = False
+    for line in document.splitlines():
+        stripped = line.strip()
+        if in_comment:
+            in_comment = not stripped.endswith("'/")
+            continue
+        if stripped.startswith("/'"):
+            in_comment = not (len(stripped) > 3 and stripped.endswith("'/"))
+            continue
+        if _NEWPAGE.match(line):
+            pages += 1
+    return pages
+
+
+def page_count(plantuml_text: str) -> int:
+    """Number of server requests needed for every page of the markup.
+
+    :param str plantuml_text: The plantuml markup
+    """
+    return sum(count_pages(document) for document in split_documents(plantuml_text))
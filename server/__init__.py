@@ -0,0 +1,3 @@
+"""
+Server infrastructure for D2COpenAIPlugin (logging, profiling, admission control, ...).
+"""
@@ -0,0 +1,376 @@
+"""
+Post-processing of rendered artifacts fetched from Kroki or PlantUML.
+
+SVG documents are minified in a single streaming pass with expat: comments,
+processing instructions, the XML declaration, ``<metadata>`` blocks and
+whitespace between elements are dropped and decimals in geometry attributes
+are rounded to ``SVG_PRECISION`` places. PNG images are re-compressed
+losslessly: the IDAT stream is re-deflated at level 9 with the best of a few
+zlib strategies and ancillary chunks that do not affect rendering (text,
+timestamps) are removed.
+
+Formats the upstream cannot produce are converted locally from its SVG:
+PNG and PDF with cairosvg, JPEG with cairosvg and Pillow. Both libraries are
+optional; without them :func:`can_convert` is false.
+
+All of this runs in a bounded process pool and results are kept in an LRU
+cache keyed by the SHA-256 of the input, so every artifact is optimized or
+converted once per process.
+
+Configuration (environment):
+    ARTIFACT_WORKERS: Size of the process pool (default ``min(4, cpu count)``).
+    ARTIFACT_CACHE_SIZE: Optimized artifacts kept in memory (default 256).
+"""
+
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+try:
+    import cairosvg
+except (ImportError, OSError):  # OSError: the cairo shared library is missing
+    cairosvg = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SVG_PRECISION = 3
+
+# Elements whose character data is content, whitespace included
+_TEXT_ELEMENTS = {"text", "tspan", "textPath", "title", "desc", "style", "script", "foreignObject"}
+_DROPPED_ELEMENTS = {"metadata"}
+_NUMERIC_ATTRIBUTES = {
+    "d", "points", "transform", "viewBox", "x", "y", "x1", "y1", "x2", "y2", "cx", "cy", "r", "rx", "ry",
+    "width", "height", "dx", "dy", "stroke-width", "font-size", "textLength", "offset", "opacity",
+}
+_DECIMAL = re.compile(r"(?<![\w.])(-?)(\d*)\.(\d+)(?![\d.eE])")
+_ATTR_ESCAPES = {'"': "&quot;", "\n": "&#10;", "\t": "&#9;"}
+
+
+def _round_decimals(value: str, precision: int) -> str:
+    def shorten(match):
+        sign, whole, fraction = match.groups()
+        if len(fraction) <= precision and whole != "0":
+            return match.group(0)
+        text = f"{float(f'{whole or 0}.{fraction}'):.{precision}f}".rstrip("0").rstrip(".")
+        if text.startswith("0."):
+            text = text[1:]
+        if text in ("", "0"):
+            return "0"
+        return sign + text
+    return _DECIMAL.sub(shorten, value)
+
+
+class _SVGMinifier:
+    """expat handlers writing the minified document into ``self.out``."""
+
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.out: List[str] = []
+        self._stack: List[str] = []
+        self._text: List[str] = []
+        self._open = False  # start tag written without its closing ">"
+        self._skip = 0  # depth inside a dropped element
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+
+    def _flush_text(self) -> None:
+        if not self._text:
+            return
+        text = "".join(self._text)
+        self._text = []
+        in_text = any(name in _TEXT_ELEMENTS for name in self._stack)
+        if not in_text and not text.strip():
+            return
+        self._close_start()
+        self.out.append(escape(text))
+
+    def _close_start(self) -> None:
+        if self._open:
+            self.out.append(">")
+            self._open = False
+
+    def start(self, name: str, attrs: Dict[str, str]) -> None:
+        if self._skip or name in _DROPPED_ELEMENTS:
+            self._skip += 1
+            return
+        self._flush_text()
+        self._close_start()
+        parts = [f"<{name}"]
+        for key, value in attrs.items():
+            if key in _NUMERIC_ATTRIBUTES:
+                value = _round_decimals(value, self.precision)
+            parts.append(f' {key}="{escape(value, _ATTR_ESCAPES)}"')
+        self.out.append("".join(parts))
+        self._open = True
+        self._stack.append(name)
+
+    def end(self, name: str) -> None:
+        if self._skip:
+            self._skip -= 1
+            return
+        self._flush_text()
+        self._stack.pop()
+        if self._open:
+            self.out.append("/>")
+            self._open = False
+        else:
+            self.out.append(f"</{name}>")
+
+    def data(self, text: str) -> None:
+        if not self._skip:
+            self._text.append(text)
+
+
+def minify_svg_stream(chunks: Iterable[bytes], precision: int = SVG_PRECISION) -> Iterator[bytes]:
+    """
+    Minify an SVG document given as a stream of byte chunks.
+
+    Output is yielded as soon as each input chunk has been parsed, so memory
+    use is bounded by the chunk size rather than the document size.
+
+    Raises:
+        expat.ExpatError: If the input is not well-formed XML
+    """
+    minifier = _SVGMinifier(precision)
+    for chunk in chunks:
+        minifier.parser.Parse(chunk, False)
+        if minifier.out:
+            yield "".join(minifier.out).encode("utf-8")
+            minifier.out.clear()
+    minifier.parser.Parse(b"", True)
+    if minifier.out:
+        yield "".join(minifier.out).encode("utf-8")
+
+
+def minify_svg(data: bytes, precision: int = SVG_PRECISION, chunk_size: int = 65536) -> bytes:
+    """Minify a complete SVG document, see :func:`minify_svg_stream`."""
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    return b"".join(minify_svg_stream(chunks, precision))
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Ancillary chunks that carry no rendering information
+_DROPPED_PNG_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+
+
+def _png_chunks(data: bytes) -> Iterator[tuple]:
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG image")
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        body = data[offset + 8:offset + 8 + length]
+        if len(body) != length:
+            raise ValueError("Truncated PNG chunk")
+        yield kind, body
+        offset += 12 + length
+        if kind == b"IEND":
+            return
+    raise ValueError("PNG image without IEND chunk")
+
+
+def _png_chunk(kind: bytes, body: bytes) -> bytes:
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+
+def optimize_png(data: bytes, keep_text: bool = False) -> bytes:
+    """
+    Losslessly re-compress a PNG image.
+
+    The filtered scanlines are left untouched; only their deflate stream is
+    redone, so the decoded pixels are identical. The original image is
+    returned when the result would not be smaller.
+
+    Args:
+        data: The PNG image
+        keep_text: Keep ``tEXt``/``zTXt``/``iTXt`` chunks (PlantUML stores
+            the diagram source there)
+
+    Raises:
+        ValueError: If ``data`` is not a well-formed PNG image
+    """
+    chunks = list(_png_chunks(data))
+    idat = b"".join(body for kind, body in chunks if kind == b"IDAT")
+    raw = zlib.decompress(idat)
+    best = idat
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidate = compressor.compress(raw) + compressor.flush()
+        if len(candidate) < len(best):
+            best = candidate
+
+    out = [PNG_SIGNATURE]
+    idat_written = False
+    for kind, body in chunks:
+        if kind == b"IDAT":
+            if not idat_written:
+                out.append(_png_chunk(b"IDAT", best))
+                idat_written = True
+        elif kind in _DROPPED_PNG_CHUNKS and not keep_text:
+            continue
+        else:
+            out.append(_png_chunk(kind, body))
+    result = b"".join(out)
+    return result if len(result) < len(data) else data
+
+
+def optimize_artifact(output_format: str, data: bytes) -> bytes:
+    """Optimize ``data`` for its format; formats without an optimizer pass through."""
+    if output_format == "svg":
+        return minify_svg(data)
+    if output_format == "png":
+        return optimize_png(data)
+    return data
+
+
+class ConversionUnavailable(Exception):
+    """The optional libraries needed to convert SVG to a format are missing."""
+    def __init__(self, output_format: str):
+        self.output_format = output_format
+        super(ConversionUnavailable, self).__init__(f"Local conversion from SVG to {output_format} is not available")
+
+
+def can_convert(output_format: str) -> bool:
+    """Whether :func:`convert_svg` can produce ``output_format`` here."""
+    if cairosvg is None:
+        return False
+    if output_format == "jpeg":
+        return Image is not None
+    return output_format in ("png", "pdf")
+
+
+def convert_svg(data: bytes, output_format: str) -> bytes:
+    """
+    Rasterize (or print) an SVG document with cairosvg.
+
+    External resources referenced by the SVG are not fetched.
+
+    Raises:
+        ConversionUnavailable: If cairosvg (or Pillow for JPEG) is missing
+    """
+    if not can_convert(output_format):
+        raise ConversionUnavailable(output_format)
+    if output_format == "pdf":
+        return cairosvg.svg2pdf(bytestring=data, unsafe=False)
+    png = cairosvg.svg2png(bytestring=data, unsafe=False)
+    if output_format == "png":
+        return optimize_png(png)
+    with Image.open(io.BytesIO(png)) as image:
+        # JPEG has no alpha channel: flatten onto white like a browser page
+        image = image.convert("RGBA")
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel("A"))
+    out = io.BytesIO()
+    flattened.save(out, format="JPEG", quality=90, optimize=True)
+    return out.getvalue()
+
+
+class ArtifactOptimizer:
+    """Process pool for artifact optimization and conversion, with an LRU cache.
+
+    The cache holds both per-input results of :meth:`optimize`/:meth:`convert`
+    and finished artifacts stored by the caller with :meth:`put`.
+
+    Args:
+        max_workers: Size of the process pool, created on first use.
+        cache_size: Number of artifacts kept.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, cache_size: int = 256):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._pending: Dict[bytes, asyncio.Task] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def from_env(cls) -> "ArtifactOptimizer":
+        workers = os.environ.get("ARTIFACT_WORKERS")
+        return cls(
+            max_workers=int(workers) if workers else None,
+            cache_size=int(os.environ.get("ARTIFACT_CACHE_SIZE", "256")),
+        )
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+        return data
+
+    def put(self, key: bytes, data: bytes) -> None:
+        self._cache[key] = data
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def optimize(self, data: bytes, output_format: str) -> bytes:
+        """
+        Return the optimized artifact, computing it at most once per input.
+
+        Inputs the optimizer cannot parse are returned unchanged.
+        """
+        key = hashlib.sha256(b"optimize\0" + output_format.encode() + b"\0" + data).digest()
+        try:
+            return await self._run(key, optimize_artifact, output_format, data)
+        except (ValueError, zlib.error, expat.ExpatError):
+            self.put(key, data)
+            return data
+
+    async def convert(self, svg: bytes, output_format: str) -> bytes:
+        """
+        Convert an SVG document to ``output_format`` once per input.
+
+        Raises:
+            ConversionUnavailable: If the format cannot be produced locally
+        """
+        if not can_convert(output_format):
+            raise ConversionUnavailable(output_format)
+        key = hashlib.sha256(b"convert\0" + output_format.encode() + b"\0" + svg).digest()
+        return await self._run(key, convert_svg, svg, output_format)
+
+    async def _run(self, key: bytes, func, *args) -> bytes:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        task = self._pending.get(key)
+        if task is None:
+            # The work runs in its own task, so a caller that goes away does not cancel it for the others
+            task = self._pending[key] = asyncio.get_running_loop().create_task(self._compute(key, func, *args))
+            # Errors reach every waiter; mark them retrieved in case all of them left
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: bytes, func, *args) -> bytes:
+        try:
+            if self._pool is None:
+                # Forking a process that already runs threads (log writer, to_thread workers) can
+                # leave locks held in the children; start them from a clean server process instead
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context(method))
+            result = await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+            self.put(key, result)
+            return result
+        finally:
+            del self._pending[key]
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,180 @@
+"""
+Render cache shared by every worker process of the host.
+
+The cache is a fixed-size hash table laid out in a memory mapped file, so a
+diagram rendered by one uvicorn worker is a hit for all the others. Each
+slot holds a 16 byte key digest, the value length, a CRC32 of the value and
+the value itself; keys hash to a group of ``WAYS`` consecutive slots and a
+full group evicts one of its slots. Writers take an exclusive ``flock``,
+readers a shared one. Values that do not fit in a slot are not cached.
+
+Without a path the table lives in anonymous memory of the current process.
+
+Configuration (environment):
+    RENDER_CACHE_PATH: File backing the shared table (set by ``app.main`` in
+        multi-worker mode; unset means a per-process table).
+    RENDER_CACHE_SLOTS: Number of slots (default 4096).
+    RENDER_CACHE_SLOT_SIZE: Bytes per slot, header included (default 8192).
+    NEGATIVE_CACHE_TTL: Seconds a source rejected by the upstream is answered
+        from :class:`NegativeCache` (default 60, 0 disables).
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: per-process cache only
+    fcntl = None
+
+_SLOT_HEADER = struct.Struct("<16sII")  # key digest, value length, crc32
+WAYS = 4
+
+
+def cache_key(*parts: str) -> bytes:
+    """Digest identifying a render from its inputs."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.digest()
+
+
+class SharedCache:
+    """Memory mapped table of JSON values keyed by :func:`cache_key` digests.
+
+    Args:
+        path: File backing the table, or None for anonymous memory.
+        slots: Number of slots, rounded up to a multiple of ``WAYS``.
+        slot_size: Bytes per slot, including the 24 byte header.
+    """
+
+    def __init__(self, path: Optional[str] = None, slots: int = 4096, slot_size: int = 8192):
+        self.path = path
+        self.slots = -(-slots // WAYS) * WAYS
+        self.slot_size = slot_size
+        self.hits = 0
+        self.misses = 0
+        size = self.slots * slot_size
+        self._lock = threading.Lock()
+        self._fd = None
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size != size:
+                with self._locked(exclusive=True):
+                    os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+
+    @classmethod
+    def from_env(cls) -> "SharedCache":
+        return cls(
+            path=os.environ.get("RENDER_CACHE_PATH") or None,
+            slots=int(os.environ.get("RENDER_CACHE_SLOTS", "4096")),
+            slot_size=int(os.environ.get("RENDER_CACHE_SLOT_SIZE", "8192")),
+        )
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        with self._lock:
+            if self._fd is None or fcntl is None:
+                yield
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _group(self, key: bytes) -> range:
+        first = int.from_bytes(key[:8], "little") % (self.slots // WAYS) * WAYS
+        return range(first, first + WAYS)
+
+    def _read_slot(self, slot: int):
+        offset = slot * self.slot_size
+        digest, length, crc = _SLOT_HEADER.unpack_from(self._map, offset)
+        return digest, length, crc, offset + _SLOT_HEADER.size
+
+    def get(self, key: bytes) -> Optional[Dict]:
+        with self._locked(exclusive=False):
+            for slot in self._group(key):
+                digest, length, crc, start = self._read_slot(slot)
+                if digest == key:
+                    value = self._map[start:start + length]
+                    if zlib.crc32(value) == crc:
+                        self.hits += 1
+                        return json.loads(value)
+        self.misses += 1
+        return None
+
+    def set(self, key: bytes, value: Dict) -> bool:
+        """Store ``value``; returns False when it does not fit in a slot."""
+        data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        if len(data) > self.slot_size - _SLOT_HEADER.size:
+            return False
+        with self._locked(exclusive=True):
+            group = self._group(key)
+            target = None
+            for slot in group:
+                digest, _, _, _ = self._read_slot(slot)
+                if digest == key or digest == bytes(16):
+                    target = slot
+                    break
+            if target is None:
+                # Pseudo-random victim, derived from the key so workers agree
+                target = group[key[8] % WAYS]
+            offset = target * self.slot_size
+            _SLOT_HEADER.pack_into(self._map, offset, key, len(data), zlib.crc32(data))
+            start = offset + _SLOT_HEADER.size
+            self._map[start:start + len(data)] = data
+        return True
+
+    def close(self) -> None:
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class NegativeCache:
+    """Recent upstream rejections, stored with an expiry in a :class:`SharedCache`.
+
+    Retries of a source the upstream just rejected are answered from here
+    instead of being sent again.
+
+    Args:
+        cache: The table holding the entries (usually the render cache).
+        ttl: Seconds an entry is served.
+    """
+
+    def __init__(self, cache: SharedCache, ttl: float = 60.0):
+        self.cache = cache
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls, cache: SharedCache) -> Optional["NegativeCache"]:
+        ttl = float(os.environ.get("NEGATIVE_CACHE_TTL", "60"))
+        return cls(cache, ttl) if ttl > 0 else None
+
+    @staticmethod
+    def _key(key: bytes) -> bytes:
+        return cache_key("failure", key.hex())
+
+    def get(self, key: bytes) -> Optional[Dict]:
+        """The error recorded for ``key``, unless it expired."""
+        entry = self.cache.get(self._key(key))
+        if entry is None or entry.get("expires", 0) < time.time():
+            return None
+        return entry["error"]
+
+    def set(self, key: bytes, error: Dict) -> bool:
+        return self.cache.set(self._key(key), {"error": error, "expires": time.time() + self.ttl})
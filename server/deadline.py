@@ -0,0 +1,114 @@
+"""
+Per-request deadlines and cancellation on client disconnect.
+
+:class:`DeadlineMiddleware` gives every HTTP request a deadline, from the
+``X-Request-Timeout`` header (seconds) capped by ``REQUEST_DEADLINE``, and
+keeps it in a context variable. Code below it asks :func:`remaining` how much
+time is left: upstream calls shorten their timeouts with it
+(:func:`server.pool.request_timeout`) and subprocesses are killed when it runs
+out. The request task itself is cancelled when the deadline passes (the
+client gets a ``504`` if nothing was sent yet) or when the client
+disconnects, so abandoned requests free their scheduler and pool slots.
+
+Configuration (environment):
+    REQUEST_DEADLINE: Longest time, in seconds, a request may take (default
+        30, 0 disables deadlines unless a request sets one).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current request's deadline, or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def request_deadline(header: Optional[str], default: float) -> Optional[float]:
+    """Seconds allowed for a request: the header value, capped by ``default``."""
+    try:
+        requested = float(header) if header else None
+    except ValueError:
+        requested = None
+    if requested is not None and requested > 0:
+        return min(requested, default) if default > 0 else requested
+    return default if default > 0 else None
+
+
+class DeadlineMiddleware:
+    """ASGI middleware enforcing request deadlines and stopping work on disconnect."""
+
+    def __init__(self, app, default: Optional[float] = None):
+        self.app = app
+        self.default = float(os.environ.get("REQUEST_DEADLINE", "30")) if default is None else default
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or ())
+        seconds = request_deadline(headers.get(b"x-request-timeout", b"").decode("latin-1"), self.default)
+        token = _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+        try:
+            await self._run(scope, receive, send, seconds)
+        finally:
+            _deadline.reset(token)
+
+    async def _run(self, scope, receive, send, seconds: Optional[float]) -> None:
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = asyncio.Event()
+        started = False
+
+        async def pump() -> None:
+            # Read ahead so a disconnect is seen while the endpoint works
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+
+        async def tracked_send(message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        reader = asyncio.create_task(pump())
+        request = asyncio.create_task(self.app(scope, messages.get, tracked_send))
+        watcher = asyncio.create_task(disconnected.wait())
+        try:
+            done, _ = await asyncio.wait({request, watcher}, timeout=seconds, return_when=asyncio.FIRST_COMPLETED)
+            if request in done:
+                request.result()
+                return
+            request.cancel()
+            try:
+                await request
+            except asyncio.CancelledError:
+                pass
+            if watcher in done:
+                logger.info("Client disconnected; request cancelled", extra={"path": scope.get("path")})
+                return
+            logger.warning("Request deadline exceeded", extra={"path": scope.get("path"), "deadline_s": seconds})
+            if not started:
+                body = json.dumps({"detail": "Deadline exceeded."}).encode()
+                await send({"type": "http.response.start", "status": 504,
+                            "headers": [(b"content-type", b"application/json"),
+                                        (b"content-length", str(len(body)).encode())]})
+                await send({"type": "http.response.body", "body": body})
+        finally:
+            for task in (reader, watcher, request):
+                task.cancel()
@@ -0,0 +1,168 @@
+"""
+Fast JSON request/response path for simple endpoints.
+
+:class:`FastJSONRoute` is a drop-in ``APIRoute`` for endpoints that take one
+pydantic body model made of ``str`` fields (plus optionally the ``Request``
+and ``str`` query parameters). For such requests it
+
+* decodes the body with a compiled msgspec decoder (or orjson/json),
+* runs the model's own ``field_validator`` functions and builds the model
+  with ``model_construct``, skipping pydantic's validation machinery,
+* serialises the returned dict with orjson (or msgspec/json) instead of
+  ``jsonable_encoder`` + ``JSONResponse``.
+
+Anything the fast path does not recognise as valid (malformed JSON, a wrong
+type, a validator raising) is handed to the regular FastAPI handler, so
+error responses and the OpenAPI schema are exactly those of ``APIRoute``.
+
+msgspec and orjson are optional; without them the stdlib ``json`` is used.
+"""
+
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_dumps(value) -> bytes:
+    # Same output as starlette's JSONResponse.render
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+if orjson is not None:
+    dumps: Callable[[object], bytes] = orjson.dumps
+elif msgspec is not None:
+    dumps = msgspec.json.encode
+else:
+    dumps = _stdlib_dumps
+
+
+class _FastPlan:
+    """What the fast handler needs to know about one endpoint."""
+
+    def __init__(self, model, body_name: str, request_name: Optional[str],
+                 query_params: List[Tuple[str, str, Optional[str]]]):
+        self.model = model
+        self.body_name = body_name
+        self.request_name = request_name
+        self.query_params = query_params
+        self.required = [name for name, field in model.model_fields.items() if field.is_required()]
+        self.defaults = {name: field.default for name, field in model.model_fields.items()
+                         if not field.is_required()}
+        self.validators = [
+            (decorator.info.fields, decorator.func)
+            for decorator in model.__pydantic_decorators__.field_validators.values()
+        ]
+        if msgspec is not None:
+            struct = msgspec.defstruct(
+                f"{model.__name__}Struct",
+                [(name, str) if field.is_required() else (name, str, field.default)
+                 for name, field in model.model_fields.items()],
+                forbid_unknown_fields=False,
+            )
+            self._decoder = msgspec.json.Decoder(struct)
+        else:
+            self._decoder = None
+
+    @classmethod
+    def build(cls, route: APIRoute) -> Optional["_FastPlan"]:
+        dependant = route.dependant
+        if (not asyncio.iscoroutinefunction(route.endpoint) or dependant.dependencies
+                or dependant.path_params or dependant.header_params or dependant.cookie_params
+                or dependant.response_param_name or dependant.background_tasks_param_name
+                or len(dependant.body_params) != 1):
+            return None
+        body = dependant.body_params[0]
+        model = body.field_info.annotation
+        if not (isinstance(model, type) and issubclass(model, BaseModel)):
+            return None
+        if model.model_config.get("extra") == "forbid":
+            return None
+        for field in model.model_fields.values():
+            if field.annotation is not str or field.alias or (not field.is_required() and not isinstance(field.default, str)):
+                return None
+        if any(decorator.info.mode != "after" for decorator in model.__pydantic_decorators__.field_validators.values()):
+            return None
+        if model.__pydantic_decorators__.model_validators:
+            return None
+        query_params = []
+        for param in dependant.query_params:
+            if param.field_info.annotation not in (str, Optional[str]):
+                return None
+            default = None if param.field_info.is_required() else param.field_info.default
+            query_params.append((param.name, param.alias, default))
+        return cls(model, body.name, dependant.request_param_name, query_params)
+
+    def decode(self, body: bytes) -> Optional[Dict[str, str]]:
+        """Return validated field values, or None to defer to pydantic."""
+        try:
+            if self._decoder is not None:
+                decoded = self._decoder.decode(body)
+                values = {name: getattr(decoded, name) for name in self.model.model_fields}
+            else:
+                data = orjson.loads(body) if orjson is not None else json.loads(body)
+                if not isinstance(data, dict):
+                    return None
+                values = dict(self.defaults)
+                for name in self.model.model_fields:
+                    if name in data:
+                        values[name] = data[name]
+                if any(name not in values for name in self.required):
+                    return None
+                if any(type(value) is not str for value in values.values()):
+                    return None
+            for fields, validator in self.validators:
+                for name in fields:
+                    values[name] = validator(values[name])
+        except Exception:
+            return None
+        return values
+
+
+class FastJSONRoute(APIRoute):
+    """``APIRoute`` with a fast path for simple JSON bodies (see module docstring)."""
+
+    def get_route_handler(self):
+        default_handler = super().get_route_handler()
+        plan = _FastPlan.build(self)
+        if plan is None:
+            return default_handler
+        endpoint = self.endpoint
+        status_code = self.status_code or 200
+
+        async def handler(request: Request) -> Response:
+            if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+                return await default_handler(request)
+            values = plan.decode(await request.body())
+            if values is None:
+                return await default_handler(request)
+            kwargs = {plan.body_name: plan.model.model_construct(**values)}
+            if plan.request_name:
+                kwargs[plan.request_name] = request
+            for name, alias, default in plan.query_params:
+                kwargs[name] = request.query_params.get(alias, default)
+            result = await endpoint(**kwargs)
+            if isinstance(result, Response):
+                return result
+            try:
+                content = dumps(result)
+            except TypeError:
+                content = _stdlib_dumps(jsonable_encoder(result))
+            return Response(content=content, status_code=status_code, media_type="application/json")
+
+        return handler
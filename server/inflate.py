@@ -0,0 +1,77 @@
+"""
+Bounded decompression of untrusted diagram state.
+
+Playground URLs (Mermaid ``pako:`` states, D2 scripts, PlantUML links) carry
+deflate streams chosen by whoever wrote the link, and a few hundred bytes can
+inflate into gigabytes. :func:`inflate` decompresses with an output cap and
+stops as soon as it is crossed, so a hostile link costs at most the budget
+in memory and CPU. Inputs too large to possibly fit are rejected before any
+work.
+
+Configuration (environment):
+    DECODE_MAX_BYTES: Largest decoded state accepted (default 1048576).
+"""
+
+import os
+import zlib
+from typing import Optional
+
+# Bytes deflate may add to incompressible data, generously rounded up
+_STORED_OVERHEAD = 1024
+
+
+class DecodeLimitExceeded(ValueError):
+    """The decoded data would be larger than the allowed budget."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        super(DecodeLimitExceeded, self).__init__(f"Decoded data exceeds {limit} bytes")
+
+
+def max_decoded_bytes() -> int:
+    return int(os.environ.get("DECODE_MAX_BYTES", "1048576"))
+
+
+def check_encoded_size(size: int, max_length: Optional[int] = None, ratio: float = 1.0) -> None:
+    """
+    Reject encoded input that cannot decode within the budget.
+
+    Args:
+        size: Length of the encoded input
+        max_length: Output budget (default ``DECODE_MAX_BYTES``)
+        ratio: Encoded bytes per compressed byte (4/3 for base64)
+
+    Raises:
+        DecodeLimitExceeded: If even incompressible content would not fit
+    """
+    limit = max_decoded_bytes() if max_length is None else max_length
+    if size > (limit + _STORED_OVERHEAD) * ratio:
+        raise DecodeLimitExceeded(limit)
+
+
+def inflate(data: bytes, wbits: int = zlib.MAX_WBITS, zdict: Optional[bytes] = None,
+            max_length: Optional[int] = None) -> bytes:
+    """
+    Decompress ``data`` without producing more than ``max_length`` bytes.
+
+    Args:
+        data: The compressed data
+        wbits: Window bits as for :func:`zlib.decompressobj` (negative for
+            raw deflate, 15 for a zlib stream)
+        zdict: Preset dictionary, if the stream was made with one
+        max_length: Output budget (default ``DECODE_MAX_BYTES``)
+
+    Raises:
+        DecodeLimitExceeded: If the output would be larger than the budget
+        zlib.error: If the data is not a valid stream
+    """
+    limit = max_decoded_bytes() if max_length is None else max_length
+    check_encoded_size(len(data), limit)
+    decompressor = zlib.decompressobj(wbits, zdict=zdict) if zdict else zlib.decompressobj(wbits)
+    output = decompressor.decompress(data, limit + 1)
+    if len(output) > limit or decompressor.unconsumed_tail:
+        raise DecodeLimitExceeded(limit)
+    output += decompressor.flush()
+    if len(output) > limit:
+        raise DecodeLimitExceeded(limit)
+    return output
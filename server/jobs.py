@@ -0,0 +1,305 @@
+"""
+Asynchronous render jobs for diagrams slower than a caller can wait.
+
+``POST /jobs`` stores the request in a SQLite job table and answers at once
+with the job id; :class:`JobRunner` tasks claim queued jobs, render them and
+store the result (and the rendered image) in the table, where
+``GET /jobs/{id}`` finds it. Jobs are keyed by a content hash: submitting a
+diagram that is already queued, running or done returns that job instead of
+rendering it again.
+
+The table lives in a local file, so every uvicorn worker of the host serves
+and runs the same jobs (claims are atomic), and queued jobs survive a
+restart. A runner renews the lease of its job while rendering it, so a job
+left ``running`` is only queued again once the worker running it died and
+the lease expired.
+
+Configuration (environment):
+    JOBS_DB: SQLite file of the job table (default ``diagram-jobs.db`` in the
+        temporary directory).
+    JOBS_WORKERS: Jobs rendered at once per worker process (default 4, 0 only
+        queues jobs for other processes).
+    JOBS_LEASE: Seconds after which a running job is considered abandoned
+        (default 600).
+    JOBS_TTL: Seconds finished jobs are kept (default 86400).
+    JOBS_TIMEOUT: Upstream timeout, in seconds, of the fetches of a job
+        (default 120; requests use the shorter ``UPSTREAM_TIMEOUT``).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from server.pool import upstream_timeout
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+_COLUMNS = "id, hash, status, request, result, error, created, updated"
+
+
+class JobFailed(Exception):
+    """A job failed for a reason worth reporting to its submitter (e.g. a syntax error)."""
+
+    def __init__(self, detail: Dict):
+        self.detail = detail
+        super(JobFailed, self).__init__(detail.get("message", "Job failed"))
+
+
+class JobStore:
+    """Job table in a SQLite file shared by the processes of one host.
+
+    Args:
+        path: The SQLite file
+        lease: Seconds a running job may go without finishing before it is
+            handed to another worker
+        ttl: Seconds finished jobs are kept
+    """
+
+    def __init__(self, path: str, lease: float = 600.0, ttl: float = 86400.0):
+        self.path = path
+        self.lease = lease
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, hash TEXT, status TEXT, request TEXT,"
+            " result TEXT, error TEXT, created REAL, updated REAL, artifact BLOB)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_hash ON jobs (hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    @classmethod
+    def from_env(cls) -> "JobStore":
+        return cls(
+            os.environ.get("JOBS_DB") or os.path.join(tempfile.gettempdir(), "diagram-jobs.db"),
+            lease=float(os.environ.get("JOBS_LEASE", "600")),
+            ttl=float(os.environ.get("JOBS_TTL", "86400")),
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _job(row) -> Optional[Dict]:
+        if row is None:
+            return None
+        job_id, content_hash, status, request, result, error, created, updated = row
+        return {
+            "id": job_id, "hash": content_hash, "status": status, "request": json.loads(request),
+            "result": json.loads(result) if result else None, "error": json.loads(error) if error else None,
+            "created": created, "updated": updated,
+        }
+
+    def _transaction(self, work: Callable[[sqlite3.Connection], object]):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = work(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def submit(self, content_hash: str, request: Dict) -> Tuple[Dict, bool]:
+        """
+        Queue a job for ``request``, unless one with the same hash is pending or done.
+
+        Returns:
+            The job and whether it was created by this call
+        """
+        def work(conn):
+            row = conn.execute(
+                f"SELECT {_COLUMNS} FROM jobs WHERE hash = ? AND status != ? ORDER BY created DESC LIMIT 1",
+                (content_hash, FAILED),
+            ).fetchone()
+            if row is not None:
+                return self._job(row), False
+            now = time.time()
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, hash, status, request, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, content_hash, QUEUED, json.dumps(request), now, now),
+            )
+            return self._job((job_id, content_hash, QUEUED, json.dumps(request), None, None, now, now)), True
+
+        return self._transaction(work)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._connect().execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row)
+
+    def artifact(self, job_id: str) -> Optional[bytes]:
+        row = self._connect().execute("SELECT artifact FROM jobs WHERE id = ? AND status = ?",
+                                      (job_id, DONE)).fetchone()
+        return row[0] if row else None
+
+    def claim(self) -> Optional[Dict]:
+        """Mark the oldest queued (or abandoned) job as running and return it."""
+        def work(conn):
+            now = time.time()
+            row = conn.execute(
+                f"SELECT {_COLUMNS} FROM jobs WHERE status = ? OR (status = ? AND updated < ?)"
+                " ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now - self.lease),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (RUNNING, now, row[0]))
+            return self._job(row[:2] + (RUNNING,) + row[3:7] + (now,))
+
+        return self._transaction(work)
+
+    def touch(self, job_id: str) -> None:
+        """Renew the lease of a running job."""
+        self._connect().execute(
+            "UPDATE jobs SET updated = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING)
+        )
+
+    def requeue(self, job_id: str) -> None:
+        """Hand a running job back to the queue (its runner stopped before finishing it)."""
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?",
+            (QUEUED, time.time(), job_id, RUNNING),
+        )
+
+    def finish(self, job_id: str, result: Dict, artifact: Optional[bytes] = None) -> None:
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, artifact = ?, updated = ? WHERE id = ?",
+            (DONE, json.dumps(result), artifact, time.time(), job_id),
+        )
+
+    def fail(self, job_id: str, error: Dict) -> None:
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+            (FAILED, json.dumps(error), time.time(), job_id),
+        )
+
+    def purge(self) -> int:
+        """Delete finished jobs older than ``ttl``; returns how many."""
+        cursor = self._connect().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (DONE, FAILED, time.time() - self.ttl)
+        )
+        return cursor.rowcount
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class JobRunner:
+    """Background tasks rendering the jobs of a :class:`JobStore`.
+
+    Args:
+        store: The job table
+        render: Coroutine function turning a job request into
+            ``(result, artifact bytes or None)``
+        workers: Jobs rendered at once
+        poll: Seconds between looks at the table when idle (jobs submitted
+            to this process wake the runner at once)
+        timeout: Upstream timeout of the fetches made while rendering a job
+    """
+
+    def __init__(self, store: JobStore, render: Callable[[Dict], Awaitable[Tuple[Dict, Optional[bytes]]]],
+                 workers: int = 4, poll: float = 1.0, timeout: float = 120.0):
+        self.store = store
+        self.render = render
+        self.workers = workers
+        self.poll = poll
+        self.timeout = timeout
+        self._tasks: List[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_env(cls, store: JobStore,
+                 render: Callable[[Dict], Awaitable[Tuple[Dict, Optional[bytes]]]]) -> Optional["JobRunner"]:
+        workers = int(os.environ.get("JOBS_WORKERS", "4"))
+        if workers <= 0:
+            return None
+        return cls(store, render, workers, timeout=float(os.environ.get("JOBS_TIMEOUT", "120")))
+
+    def start(self) -> None:
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def wake(self) -> None:
+        if self._wake is not None:
+            self._wake.set()
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self) -> None:
+        try:
+            await asyncio.to_thread(self.store.purge)
+        except sqlite3.Error as e:
+            logger.warning("Could not purge old jobs: %s", e)
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim)
+            except sqlite3.Error as e:
+                logger.warning("Could not claim a job: %s", e)
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _keep_leased(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.store.lease / 3)
+            try:
+                await asyncio.to_thread(self.store.touch, job_id)
+            except sqlite3.Error as e:
+                logger.warning("Could not renew the lease of a job: %s", e)
+
+    async def _run(self, job: Dict) -> None:
+        lease = asyncio.create_task(self._keep_leased(job["id"]))
+        try:
+            await self._render(job)
+        finally:
+            lease.cancel()
+
+    async def _render(self, job: Dict) -> None:
+        started = time.perf_counter()
+        try:
+            with upstream_timeout(self.timeout):
+                result, artifact = await self.render(job["request"])
+        except asyncio.CancelledError:
+            # Shutting down: another worker (or the next start) picks the job up again
+            await asyncio.to_thread(self.store.requeue, job["id"])
+            raise
+        except JobFailed as e:
+            await asyncio.to_thread(self.store.fail, job["id"], e.detail)
+        except Exception as e:
+            logger.error("Render job failed", extra={"job": job["id"], "error": type(e).__name__})
+            await asyncio.to_thread(self.store.fail, job["id"],
+                                    {"message": "An error occurred while rendering the diagram."})
+        else:
+            await asyncio.to_thread(self.store.finish, job["id"], result, artifact)
+            logger.info("Render job done", extra={
+                "job": job["id"], "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            })
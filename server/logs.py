@@ -0,0 +1,141 @@
+"""
+Non-blocking structured logging.
+
+Request handlers only render the message and traceback of a ``LogRecord``
+(:class:`StructuredQueueHandler`) and push it onto a queue; a
+``QueueListener`` thread encodes it as one JSON object per line, with the
+traceback in its own ``exc`` field, and writes it to stderr. Records can be
+sampled per level before they are enqueued.
+
+Configuration (environment):
+    LOG_LEVEL: Root log level (default ``INFO``).
+    LOG_SAMPLE_RATES: Comma separated ``LEVEL=rate`` pairs, e.g.
+        ``DEBUG=0.01,INFO=0.1``. Levels that are not listed are always kept.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+_TRACEBACKS = logging.Formatter()
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as a single JSON object including its ``extra`` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """Enqueue records with their message and traceback rendered but kept apart.
+
+    ``QueueHandler.prepare`` formats the whole record into ``msg`` and drops
+    ``exc_info``; here the traceback goes to ``exc_text`` instead, so the
+    listener can still report it as a field of its own.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks hold frames of this thread; render them before the record leaves it
+            record.exc_text = _TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of each level.
+
+    Args:
+        rates: Mapping of level number to the fraction of records to keep.
+    """
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+def parse_sample_rates(spec: str) -> Dict[int, float]:
+    """Parse ``"DEBUG=0.01,INFO=0.1"`` into ``{10: 0.01, 20: 0.1}``."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        level, _, rate = item.partition("=")
+        levelno = logging.getLevelName(level.strip().upper())
+        if not isinstance(levelno, int):
+            raise ValueError(f"Unknown log level: {level}")
+        rates[levelno] = float(rate)
+    return rates
+
+
+def configure_logging(level: Optional[str] = None, sample_rates: Optional[str] = None) -> QueueListener:
+    """
+    Route the root logger through a queue and start the JSON writer thread.
+
+    Calling it again returns the running listener.
+
+    Args:
+        level: Root log level, defaults to ``LOG_LEVEL``
+        sample_rates: Sampling spec, defaults to ``LOG_SAMPLE_RATES``
+
+    Returns:
+        The running ``QueueListener``
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    sample_rates = sample_rates if sample_rates is not None else os.environ.get("LOG_SAMPLE_RATES", "")
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(sample_rates)))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Flush pending records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
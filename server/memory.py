@@ -0,0 +1,115 @@
+"""
+Allocation tracing per backend with :mod:`tracemalloc`.
+
+An admin starts tracing, takes named snapshots and compares them, all through
+the ``/admin/memory`` endpoints (``X-Admin-Token`` as for profiling). Every
+traced allocation is charged to the innermost frame of its traceback that
+belongs to this repository, so memory allocated inside httpx or zlib on
+behalf of the Kroki client counts as ``kroki``. Groups are the backend
+packages (``plantuml``, ``kroki``, ``mermaid``, ``D2``) and ``app`` for the
+rest of the service; allocations with no frame of ours are ``other``.
+
+Tracing slows allocations down and stores a traceback per live block; run it
+on one worker for as long as a comparison needs.
+"""
+
+import os
+import tracemalloc
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+BACKENDS = ("plantuml", "kroki", "mermaid", "D2")
+# Snapshots kept for comparisons; the oldest are dropped first
+MAX_SNAPSHOTS = 4
+
+
+def _site(traceback: tracemalloc.Traceback) -> Tuple[str, str]:
+    """(group, ``file:line``) of the innermost frame of ours in ``traceback``."""
+    for frame in reversed(traceback):
+        if frame.filename.startswith(ROOT) and os.sep + "site-packages" + os.sep not in frame.filename:
+            relative = frame.filename[len(ROOT):]
+            package = relative.split(os.sep, 1)[0]
+            return (package if package in BACKENDS else "app"), f"{relative}:{frame.lineno}"
+    frame = traceback[-1] if len(traceback) else None
+    return "other", f"{frame.filename}:{frame.lineno}" if frame else "?"
+
+
+def summarize(stats: List, top: int = 20) -> Dict:
+    """
+    Group traceback statistics (or differences) by backend and allocation site.
+
+    Args:
+        stats: ``Snapshot.statistics("traceback")`` or ``Snapshot.compare_to(..., "traceback")``
+        top: Number of allocation sites to list
+
+    Returns:
+        ``{"groups": {group: {"size", "count"}}, "top": [{"group", "site", "size", "count"}]}``;
+        sizes and counts are differences when ``stats`` is a comparison
+    """
+    groups: Dict[str, Dict[str, int]] = {}
+    sites: Dict[Tuple[str, str], Dict[str, int]] = {}
+    for stat in stats:
+        size = getattr(stat, "size_diff", stat.size)
+        count = getattr(stat, "count_diff", stat.count)
+        group, site = _site(stat.traceback)
+        for totals in (groups.setdefault(group, {"size": 0, "count": 0}),
+                       sites.setdefault((group, site), {"size": 0, "count": 0})):
+            totals["size"] += size
+            totals["count"] += count
+    ranked = sorted(sites.items(), key=lambda item: abs(item[1]["size"]), reverse=True)[:top]
+    return {
+        "groups": dict(sorted(groups.items(), key=lambda item: item[1]["size"], reverse=True)),
+        "top": [{"group": group, "site": site, **totals} for (group, site), totals in ranked],
+    }
+
+
+class MemoryTracer:
+    """Start and stop tracing and keep named snapshots for comparison."""
+
+    def __init__(self):
+        self.snapshots: "OrderedDict[str, tracemalloc.Snapshot]" = OrderedDict()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 25) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.snapshots.clear()
+
+    def _take(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Memory tracing is not running.")
+        # Leave out the tracer's own bookkeeping
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    def snapshot(self, name: str) -> None:
+        """Keep the current allocations as ``name`` for later comparisons."""
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = self._take()
+        while len(self.snapshots) > MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+
+    def report(self, top: int = 20, since: Optional[str] = None, until: Optional[str] = None) -> Dict:
+        """
+        Allocations now (or at snapshot ``until``), or their growth since snapshot ``since``.
+
+        Raises:
+            KeyError: If a named snapshot does not exist
+            RuntimeError: If a snapshot is needed and tracing is off
+        """
+        current = self.snapshots[until] if until is not None else self._take()
+        if since is None:
+            stats = current.statistics("traceback")
+        else:
+            stats = current.compare_to(self.snapshots[since], "traceback")
+        traced, peak = tracemalloc.get_traced_memory()
+        return {"traced": traced, "peak": peak, "since": since, **summarize(stats, top)}
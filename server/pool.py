@@ -0,0 +1,271 @@
+"""
+Shared HTTP connection pool for the upstream diagram servers.
+
+Every PlantUML/Kroki call of the process goes through one ``httpx.Client``,
+so TCP and TLS connections to plantuml.com and kroki.io are kept alive and
+reused instead of being opened per request. :func:`preconnect` resolves an
+upstream and opens a few pooled connections ahead of the first request;
+:func:`apreconnect` does the same for the async client of the running loop.
+Coroutines fanning out several requests at once (e.g. the pages of a
+multi-page PlantUML document) use :func:`shared_async_client`, one per event
+loop, with the same limits. Calls made for a request pass
+:func:`request_timeout` so they never outlive its deadline; work with more
+patience than a request (render jobs) raises the timeout for its context with
+:func:`upstream_timeout`.
+
+Upstreams running as sidecars on the same host can be reached over a Unix
+domain socket: a ``unix:///run/kroki.sock`` base URL (optionally followed by
+an HTTP path, ``unix:///run/plantuml.sock/plantuml/png``) is turned by
+:func:`resolve_url` into an HTTP URL on a reserved host. Clients send those
+hosts to their socket through a transport mounted for them alone
+(:data:`UNIX_MOUNT`), so every other upstream keeps the default transport and
+with it ``HTTP(S)_PROXY``/``NO_PROXY`` from the environment.
+
+Configuration (environment):
+    UPSTREAM_URLS: Comma separated upstream base URLs to pre-connect
+        (default: ``PLANTUML_URL`` and ``KROKI_URL``, i.e. plantuml.com and
+        kroki.io unless a sidecar is configured).
+    UPSTREAM_POOL_SIZE: Keep-alive connections per process (default 20).
+    UPSTREAM_TIMEOUT: Upstream request timeout in seconds (default 10).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from server import deadline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLANTUML_URL = "https://www.plantuml.com/plantuml"
+DEFAULT_KROKI_URL = "https://kroki.io"
+UNIX_SCHEME = "unix://"
+# Hosts standing for Unix sockets end in this suffix
+_UNIX_HOST_SUFFIX = ".sock.localhost"
+# Mount pattern of the socket hosts, for the ``mounts`` of an httpx client
+UNIX_MOUNT = "all://*" + _UNIX_HOST_SUFFIX
+
+_client: Optional[httpx.Client] = None
+_lock = threading.Lock()
+# Async clients are bound to the loop they were first used on
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+# Timeout replacing the client's in the current context (see upstream_timeout())
+_timeout_override: ContextVar[Optional[float]] = ContextVar("upstream_timeout", default=None)
+# Socket path of every host handed out by resolve_url()
+_unix_sockets: Dict[str, str] = {}
+
+
+def resolve_url(url: str) -> str:
+    """
+    The HTTP URL to request for ``url``.
+
+    ``unix:///path/to/server.sock[/http/path]`` becomes
+    ``http://<id>.sock.localhost[/http/path]``, a host the transports of this
+    module send to the socket; other URLs are returned unchanged.
+
+    Raises:
+        ValueError: If a ``unix://`` URL does not name a ``.sock`` file
+    """
+    if not url.startswith(UNIX_SCHEME):
+        return url
+    path = url[len(UNIX_SCHEME):]
+    # The socket is the first path component naming a .sock file, so
+    # directories like /run/my.socket/ are not cut in the middle
+    components = path.split("/")
+    end = next((i for i, component in enumerate(components) if component.endswith(".sock")), None)
+    if not path.startswith("/") or end is None:
+        raise ValueError(f"Expected unix:///absolute/path.sock[/http/path], got {url}")
+    socket_path = "/".join(components[:end + 1])
+    rest = "/".join([""] + components[end + 1:]) if end + 1 < len(components) else ""
+    host = hashlib.sha1(socket_path.encode()).hexdigest()[:16] + _UNIX_HOST_SUFFIX
+    _unix_sockets[host] = socket_path
+    return f"http://{host}{rest}"
+
+
+class UnixSocketTransport(httpx.BaseTransport):
+    """Sends requests for :func:`resolve_url` hosts to their socket.
+
+    Mount it on :data:`UNIX_MOUNT` rather than passing it as the client's
+    ``transport``, which would turn off the proxies from the environment.
+
+    Args:
+        **transport_opts: Options of every underlying ``httpx.HTTPTransport``
+            (``limits``, ``retries``, ...)
+    """
+
+    def __init__(self, **transport_opts):
+        self.transport_opts = transport_opts
+        self._sockets: Dict[str, httpx.HTTPTransport] = {}
+        self._lock = threading.Lock()
+
+    def _for(self, host: str) -> httpx.HTTPTransport:
+        with self._lock:
+            transport = self._sockets.get(host)
+            if transport is None:
+                if host not in _unix_sockets:
+                    raise httpx.ConnectError(f"No Unix socket is known for {host}")
+                transport = self._sockets[host] = httpx.HTTPTransport(uds=_unix_sockets[host], **self.transport_opts)
+            return transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self._for(request.url.host).handle_request(request)
+
+    def close(self) -> None:
+        for transport in self._sockets.values():
+            transport.close()
+
+
+class AsyncUnixSocketTransport(httpx.AsyncBaseTransport):
+    """Asynchronous :class:`UnixSocketTransport`."""
+
+    def __init__(self, **transport_opts):
+        self.transport_opts = transport_opts
+        self._sockets: Dict[str, httpx.AsyncHTTPTransport] = {}
+
+    def _for(self, host: str) -> httpx.AsyncHTTPTransport:
+        transport = self._sockets.get(host)
+        if transport is None:
+            if host not in _unix_sockets:
+                raise httpx.ConnectError(f"No Unix socket is known for {host}")
+            transport = self._sockets[host] = httpx.AsyncHTTPTransport(uds=_unix_sockets[host], **self.transport_opts)
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._for(request.url.host).handle_async_request(request)
+
+    async def aclose(self) -> None:
+        for transport in self._sockets.values():
+            await transport.aclose()
+
+
+def _pool_limits() -> httpx.Limits:
+    size = int(os.environ.get("UPSTREAM_POOL_SIZE", "20"))
+    return httpx.Limits(max_connections=size * 2, max_keepalive_connections=size)
+
+
+def _timeout() -> float:
+    return float(os.environ.get("UPSTREAM_TIMEOUT", "10"))
+
+
+def shared_client() -> httpx.Client:
+    """The process-wide upstream client, created (again) on demand."""
+    global _client
+    with _lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(limits=_pool_limits(), timeout=_timeout(),
+                                   mounts={UNIX_MOUNT: UnixSocketTransport(limits=_pool_limits())})
+        return _client
+
+
+def shared_async_client() -> httpx.AsyncClient:
+    """The upstream client of the running event loop, created (again) on demand."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            limits=_pool_limits(), timeout=_timeout(),
+            mounts={UNIX_MOUNT: AsyncUnixSocketTransport(limits=_pool_limits())})
+    return client
+
+
+async def close_shared_async_client() -> None:
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def close_shared_client() -> None:
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+@contextmanager
+def upstream_timeout(seconds: float) -> Iterator[None]:
+    """Give upstream calls made in this context ``seconds`` instead of ``UPSTREAM_TIMEOUT``."""
+    token = _timeout_override.set(seconds)
+    try:
+        yield
+    finally:
+        _timeout_override.reset(token)
+
+
+def request_timeout(client: Union[httpx.Client, httpx.AsyncClient]):
+    """The client's timeouts (or those of :func:`upstream_timeout`) shortened to what
+    is left of the request deadline (see :mod:`server.deadline`), or
+    ``httpx.USE_CLIENT_DEFAULT`` when neither applies."""
+    override = _timeout_override.get()
+    timeout = httpx.Timeout(override) if override is not None else client.timeout
+    left = deadline.remaining()
+    if left is None:
+        return timeout if override is not None else httpx.USE_CLIENT_DEFAULT
+    left = max(left, 0.001)
+    return httpx.Timeout(
+        connect=min(timeout.connect or left, left),
+        read=min(timeout.read or left, left),
+        write=min(timeout.write or left, left),
+        pool=min(timeout.pool or left, left),
+    )
+
+
+def upstream_urls() -> List[str]:
+    """Base URLs to pre-connect: ``UPSTREAM_URLS``, or the configured PlantUML and Kroki servers."""
+    configured = os.environ.get("UPSTREAM_URLS")
+    if configured is None:
+        configured = ",".join((os.environ.get("PLANTUML_URL", DEFAULT_PLANTUML_URL),
+                               os.environ.get("KROKI_URL", DEFAULT_KROKI_URL)))
+    return [url.strip() for url in configured.split(",") if url.strip()]
+
+
+def _origin(url: str):
+    parts = urlsplit(resolve_url(url))
+    return parts, f"{parts.scheme}://{parts.netloc}/"
+
+
+def preconnect(url: str, connections: int = 2) -> bool:
+    """
+    Resolve ``url`` and open ``connections`` pooled connections to it.
+
+    Concurrent ``HEAD`` requests make the pool open one connection each; the
+    response status does not matter, only the connection left behind.
+
+    Returns:
+        Whether every connection could be opened
+    """
+    parts, origin = _origin(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    client = shared_client()
+    try:
+        if not parts.hostname.endswith(_UNIX_HOST_SUFFIX):
+            socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(lambda _: client.head(origin), range(connections)))
+    except (OSError, httpx.HTTPError) as e:
+        logger.warning("Could not pre-connect to %s: %s", origin, e)
+        return False
+    return True
+
+
+async def apreconnect(url: str, connections: int = 2) -> bool:
+    """:func:`preconnect` for :func:`shared_async_client` of the running loop."""
+    _, origin = _origin(url)
+    client = shared_async_client()
+    try:
+        await asyncio.gather(*(client.head(origin) for _ in range(connections)))
+    except (OSError, httpx.HTTPError) as e:
+        logger.warning("Could not pre-connect to %s: %s", origin, e)
+        return False
+    return True
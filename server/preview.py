@@ -0,0 +1,123 @@
+"""
+Live-preview sessions over a WebSocket.
+
+An editor streams its buffer as JSON messages ``{"lang", "code", "theme"}``.
+The session waits until the buffer has been quiet for the debounce delay,
+canonicalises the source (line endings, trailing whitespace) and skips the
+render when nothing meaningful changed. A new edit cancels the render still
+in flight, so only the newest result is pushed back:
+
+    {"seq": 3, "url": "...", "playground": "..."}
+    {"seq": 4, "error": {"message": "...", "line": 2, "column": 5}}
+
+A binary frame or a message that is not JSON is answered with ``{"error": {...}}`` (no
+``seq``) and otherwise ignored; the session stays open.
+
+Rendering only runs the local encoders; no upstream server is contacted.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from validation import DiagramSyntaxError, validate_source
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEBOUNCE = 0.15
+
+
+def canonical_source(code: str) -> str:
+    """Drop differences that cannot change the rendered diagram."""
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class PreviewSession:
+    """Debounced, cancellable re-rendering for one connected editor.
+
+    Args:
+        websocket: The accepted connection.
+        encode: ``encode(lang, code, theme)`` returning the URLs to push; it
+            runs in a worker thread.
+        accepts: Predicate for supported languages.
+        debounce: Quiet period in seconds before rendering.
+    """
+
+    def __init__(self, websocket: WebSocket, encode: Callable[[str, str, str], Dict],
+                 accepts: Callable[[str], bool], debounce: float = DEFAULT_DEBOUNCE):
+        self.websocket = websocket
+        self.encode = encode
+        self.accepts = accepts
+        self.debounce = debounce
+        self.seq = 0
+        self._last: Optional[Tuple[str, str, str]] = None
+        self._render_task: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        pending = None
+        try:
+            while True:
+                try:
+                    timeout = self.debounce if pending is not None else None
+                    message = await asyncio.wait_for(self.websocket.receive(), timeout)
+                    if message["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
+                    if message.get("text") is None:
+                        await self.websocket.send_json({"error": {"message": "Expected a text frame."}})
+                        continue
+                    try:
+                        pending = json.loads(message["text"])
+                    except ValueError as e:
+                        await self.websocket.send_json({"error": {"message": f"Invalid JSON: {e}"}})
+                        continue
+                    # The newest edit supersedes whatever is still rendering
+                    self._cancel_render()
+                except asyncio.TimeoutError:
+                    edit, pending = pending, None
+                    self._schedule(edit)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self._cancel_render()
+
+    def _cancel_render(self) -> None:
+        if self._render_task is not None and not self._render_task.done():
+            self._render_task.cancel()
+            # The cancelled source was never delivered, so it must not be skipped
+            self._last = None
+
+    def _schedule(self, edit) -> None:
+        if not isinstance(edit, dict):
+            edit = {}
+        lang = str(edit.get("lang", ""))
+        theme = str(edit.get("theme", "") or "")
+        code = canonical_source(str(edit.get("code", "")))
+        key = (lang, theme, code)
+        if key == self._last:
+            return
+        self._last = key
+        self.seq += 1
+        self._render_task = asyncio.create_task(self._render(self.seq, lang, code, theme))
+
+    def _encode(self, lang: str, code: str, theme: str) -> Dict:
+        if not self.accepts(lang):
+            return {"error": {"message": f"Invalid diagram language: {lang}"}}
+        if not code:
+            return {"error": {"message": "No diagram code provided."}}
+        try:
+            validate_source(lang, code)
+        except DiagramSyntaxError as e:
+            return {"error": e.to_dict()}
+        return self.encode(lang, code, theme)
+
+    async def _render(self, seq: int, lang: str, code: str, theme: str) -> None:
+        try:
+            result = await asyncio.to_thread(self._encode, lang, code, theme)
+        except Exception as e:
+            logger.error("Preview render failed", extra={"lang": lang, "error": type(e).__name__})
+            result = {"error": {"message": "An error occurred while generating the diagram."}}
+        await self.websocket.send_json({"seq": seq, **result})
@@ -0,0 +1,141 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when it carries ``X-Profile: pstats|collapsed`` (or the
+``?profile=`` query parameter) together with ``X-Admin-Token`` matching the
+``ADMIN_TOKEN`` environment variable. Results are written to ``PROFILE_DIR``
+(default ``./profiles``) and the file name is returned in ``X-Profile-File``.
+
+Modes:
+    pstats: deterministic ``cProfile`` output, open with ``pstats`` or snakeviz.
+    collapsed: stack samples of the event loop thread in the collapsed
+        ``frame;frame;frame count`` format read by flamegraph.pl/speedscope.
+
+Both profilers observe the whole event loop thread, so work of concurrent
+requests shows up as well; profile on a quiet instance.
+"""
+
+import cProfile
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+from urllib.parse import parse_qs
+
+PROFILE_MODES = ("pstats", "collapsed")
+
+
+def check_admin_token(token: Optional[str]) -> bool:
+    """Whether ``token`` matches ``ADMIN_TOKEN`` (always false when it is unset)."""
+    expected = os.environ.get("ADMIN_TOKEN")
+    return bool(expected and token) and hmac.compare_digest(token, expected)
+
+
+class StackSampler:
+    """Sample the stack of one thread at a fixed interval into collapsed stacks."""
+
+    def __init__(self, thread_id: int, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _requested_mode(scope) -> Optional[str]:
+    for name, value in scope.get("headers", []):
+        if name == b"x-profile":
+            return value.decode("latin-1").strip().lower() or "pstats"
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if "profile" in query:
+        return query["profile"][0].strip().lower() or "pstats"
+    return None
+
+
+def _admin_token(scope) -> Optional[str]:
+    for name, value in scope.get("headers", []):
+        if name == b"x-admin-token":
+            return value.decode("latin-1")
+    return None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware running flagged requests under a profiler."""
+
+    def __init__(self, app, directory: Optional[str] = None):
+        self.app = app
+        self.directory = directory
+
+    async def __call__(self, scope, receive, send):
+        mode = _requested_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        if mode not in PROFILE_MODES or not check_admin_token(_admin_token(scope)):
+            await self._reject(send, mode)
+            return
+
+        directory = self.directory or os.environ.get("PROFILE_DIR", "profiles")
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        filename = f"{name}.prof" if mode == "pstats" else f"{name}.folded"
+
+        async def send_with_name(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-file", filename.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        if mode == "pstats":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_name)
+            finally:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(directory, filename))
+        else:
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_with_name)
+            finally:
+                sampler.stop()
+                sampler.dump(os.path.join(directory, filename))
+
+    async def _reject(self, send, mode: str) -> None:
+        if mode not in PROFILE_MODES:
+            status, body = 400, f'{{"detail":"Unknown profile mode. Use one of: {", ".join(PROFILE_MODES)}"}}'
+        else:
+            status, body = 403, '{"detail":"A valid admin token is required."}'
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body.encode()})
@@ -0,0 +1,212 @@
+"""
+Token-bucket admission control.
+
+Each key (an API key, a client IP or an upstream name) owns a bucket that
+refills at ``rate`` tokens per second up to ``burst`` tokens. A request that
+finds the bucket empty reserves a future token and waits for it, as long as
+the wait stays under ``max_wait``; beyond that it is rejected and told when
+to retry. Reservations bound the queue to roughly ``rate * max_wait``
+waiters per key.
+
+Buckets live in memory by default. The SQLite store keeps them in a local
+file so every uvicorn worker on the host shares the same limits.
+
+Configuration (environment):
+    RATE_LIMIT_CLIENT: ``rate/burst`` per API key or IP (default ``20/40``, ``off`` disables).
+    RATE_LIMIT_UPSTREAM: ``rate/burst`` per upstream service (default ``50/100``).
+    RATE_LIMIT_MAX_WAIT: Longest queueing delay in seconds (default ``2``).
+    RATE_LIMIT_BACKEND: ``memory`` or ``sqlite:///path/to/buckets.db``.
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class RateLimitExceeded(Exception):
+    """The bucket is empty and the wait would exceed ``max_wait``."""
+    def __init__(self, key: str, retry_after: float):
+        self.key = key
+        self.retry_after = retry_after
+        super(RateLimitExceeded, self).__init__(f"Rate limit exceeded for {key}, retry in {retry_after:.2f}s")
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def _reserve(tokens: float, rate: float, max_wait: float, cost: float = 1.0) -> Tuple[bool, float, float]:
+    """Return (granted, wait, tokens after reserving ``cost`` tokens)."""
+    if tokens >= cost:
+        return True, 0.0, tokens - cost
+    wait = (cost - tokens) / rate
+    if wait > max_wait:
+        return False, wait, tokens
+    return True, wait, tokens - cost
+
+
+class MemoryBucketStore:
+    """Buckets of the current process.
+
+    Args:
+        max_keys: Number of buckets above which full buckets are forgotten.
+    """
+
+    # reserve() never waits on I/O, so it runs on the event loop
+    blocking = False
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, rate: float, burst: float, max_wait: float,
+                cost: float = 1.0) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) > self.max_keys:
+                # A full bucket is indistinguishable from a missing one
+                self._buckets = {
+                    k: v for k, v in self._buckets.items() if _refill(*v, now, rate, burst) < burst
+                }
+            tokens, updated = self._buckets.get(key, (burst, now))
+            granted, wait, tokens = _reserve(_refill(tokens, updated, now, rate, burst), rate, max_wait, cost)
+            self._buckets[key] = (tokens, now)
+        return granted, wait
+
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file shared by the processes of one host."""
+
+    # reserve() may wait for the file lock of another process
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, key: str, rate: float, burst: float, max_wait: float,
+                cost: float = 1.0) -> Tuple[bool, float]:
+        conn = self._connect()
+        # Wall clock, since monotonic clocks are not comparable across processes
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            granted, wait, tokens = _reserve(_refill(tokens, updated, now, rate, burst), rate, max_wait, cost)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return granted, wait
+
+
+class CostExceedsCapacity(Exception):
+    """A request needs more tokens than the bucket can ever grant within ``max_wait``; retrying cannot help."""
+    def __init__(self, key: str, cost: float, capacity: float):
+        self.key = key
+        self.cost = cost
+        self.capacity = capacity
+        super(CostExceedsCapacity, self).__init__(f"{cost:g} tokens requested for {key}, at most {capacity:g} can be granted")
+
+
+class RateLimiter:
+    """Token buckets with one shared rate and burst size.
+
+    Args:
+        rate: Tokens added per second.
+        burst: Bucket capacity.
+        max_wait: Longest time a request may wait for a token.
+        store: Bucket storage, a new :class:`MemoryBucketStore` by default.
+    """
+
+    def __init__(self, rate: float, burst: float, max_wait: float = 2.0, store=None):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.store = store or MemoryBucketStore()
+
+    @property
+    def capacity(self) -> float:
+        """Most tokens one request can get: a full bucket plus what refills within ``max_wait``."""
+        return self.burst + self.rate * self.max_wait
+
+    async def acquire(self, key: str, cost: float = 1.0) -> float:
+        """
+        Take ``cost`` tokens for ``key``, waiting for them if needed.
+
+        Returns:
+            The time spent waiting, in seconds
+
+        Raises:
+            RateLimitExceeded: If the tokens are not available within ``max_wait``
+            CostExceedsCapacity: If ``cost`` is above :attr:`capacity`
+        """
+        if cost > self.capacity:
+            raise CostExceedsCapacity(key, cost, self.capacity)
+        if getattr(self.store, "blocking", True):
+            granted, wait = await asyncio.to_thread(self.store.reserve, key, self.rate, self.burst, self.max_wait, cost)
+        else:
+            granted, wait = self.store.reserve(key, self.rate, self.burst, self.max_wait, cost)
+        if not granted:
+            raise RateLimitExceeded(key, wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def parse_limit(spec: str) -> Optional[Tuple[float, float]]:
+    """Parse ``"rate/burst"`` (or just ``"rate"``); ``off``/``0`` disables the limit."""
+    spec = spec.strip().lower()
+    if spec in ("", "0", "off", "none"):
+        return None
+    rate, _, burst = spec.partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else max(1.0, rate)
+
+
+def create_store(backend: Optional[str] = None):
+    """Build the bucket store named by ``backend`` (default ``RATE_LIMIT_BACKEND``)."""
+    backend = backend or os.environ.get("RATE_LIMIT_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryBucketStore()
+    if backend.startswith("sqlite:///"):
+        return SQLiteBucketStore(backend[len("sqlite:///"):])
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+def limiter_from_env(name: str, default: str, store=None) -> Optional[RateLimiter]:
+    """Build the limiter configured by ``RATE_LIMIT_<NAME>``, or None when disabled."""
+    limit = parse_limit(os.environ.get(f"RATE_LIMIT_{name.upper()}", default))
+    if limit is None:
+        return None
+    max_wait = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "2"))
+    return RateLimiter(*limit, max_wait=max_wait, store=store or create_store())
+
+
+def client_key(headers, client_host: Optional[str]) -> str:
+    """Bucket key for a caller: its API key when it sends one, else its IP."""
+    api_key = headers.get("x-api-key")
+    if api_key:
+        # Never keep raw API keys in the (possibly on-disk) bucket table
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+    return f"ip:{client_host or 'unknown'}"
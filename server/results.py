@@ -0,0 +1,85 @@
+"""
+Render results with fields computed on first access.
+
+Building a playground link can cost more than the image URL itself (the
+Mermaid state is JSON-dumped and deflated again, PlantUML sources go through
+the pure-Python encoder), and most API consumers never use it. A
+:class:`DiagramResult` holds each field either as its value or as a
+zero-argument callable producing it, so a response limited with
+``fields=url`` never computes the playground.
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Selectable fields, in response order
+RESULT_FIELDS = ("url", "content", "playground")
+
+Field = Union[str, Callable[[], str]]
+
+
+def parse_fields(fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    Parse a ``fields=url,playground`` selection.
+
+    Returns:
+        The selected fields in response order, or None for all of them
+
+    Raises:
+        ValueError: If the selection is empty or names an unknown field
+    """
+    if fields is None:
+        return None
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected.difference(RESULT_FIELDS)
+    if unknown or not selected:
+        raise ValueError(f"Unknown result fields: {', '.join(sorted(unknown)) or '(none)'}. "
+                         f"Choose from {', '.join(RESULT_FIELDS)}.")
+    return tuple(field for field in RESULT_FIELDS if field in selected)
+
+
+class DiagramResult:
+    """URL, content and playground of a render, each resolved at most once.
+
+    Args:
+        url: The image URL, or a callable returning it
+        content: The diagram source echoed back, or a callable returning it
+        playground: The editor URL, or a callable returning it
+        pages: Per-page results of a multi-page diagram (url and playground)
+    """
+
+    __slots__ = ("_url", "_content", "_playground", "pages")
+
+    def __init__(self, url: Field, content: Field, playground: Field,
+                 pages: Optional[List["DiagramResult"]] = None):
+        self._url = url
+        self._content = content
+        self._playground = playground
+        self.pages = pages
+
+    def _resolve(self, slot: str) -> str:
+        value = getattr(self, slot)
+        if callable(value):
+            value = value()
+            setattr(self, slot, value)
+        return value
+
+    @property
+    def url(self) -> str:
+        return self._resolve("_url")
+
+    @property
+    def content(self) -> str:
+        return self._resolve("_content")
+
+    @property
+    def playground(self) -> str:
+        return self._resolve("_playground")
+
+    def to_dict(self, fields: Optional[Sequence[str]] = None) -> Dict:
+        """The response body with only ``fields`` (all of them by default) computed."""
+        fields = RESULT_FIELDS if fields is None else fields
+        body = {field: getattr(self, field) for field in fields}
+        page_fields = [field for field in fields if field != "content"]
+        if self.pages and page_fields:
+            body["pages"] = [page.to_dict(page_fields) for page in self.pages]
+        return body
@@ -0,0 +1,150 @@
+"""
+Size-aware scheduling of render jobs.
+
+Renders that miss the cache take a slot of a :class:`Scheduler` before they
+reach a backend. At most ``concurrency`` jobs run at once; the others wait in
+a priority queue ordered shortest job first, so a burst of huge generated
+diagrams cannot hold every upstream connection while small ones queue behind
+them. A job's cost is estimated from its code length, language and output
+format (:func:`estimate_cost`).
+
+Aging keeps big jobs from starving: a job is ordered by its arrival time
+plus ``cost / aging`` seconds, so every second spent waiting is worth
+``aging`` cost units and a large job is eventually ahead of any newcomer.
+
+The time jobs waited for their slot is reported as the ``queue`` phase of
+``Server-Timing`` and as a histogram on ``GET /metrics``.
+
+Configuration (environment):
+    SCHEDULER_CONCURRENCY: Jobs running at once per worker (default 32,
+        0 disables scheduling).
+    SCHEDULER_AGING: Cost units a waiting job gains per second (default 20000).
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple
+
+from server.timing import phase
+
+# Relative cost of one source byte per language and per output format
+LANG_WEIGHTS = {
+    "plantuml": 2.0,
+    "c4plantuml": 2.5,
+    "structurizr": 2.5,
+    "d2": 1.5,
+    "graphviz": 1.5,
+    "tikz": 3.0,
+    # Mermaid links are built locally, nothing is rendered upstream
+    "mermaid": 0.2,
+    "mermaidjs": 0.2,
+}
+FORMAT_WEIGHTS = {"svg": 1.0, "txt": 0.5, "png": 1.5, "jpeg": 1.5, "pdf": 2.0}
+# Fixed per-job overhead, in source bytes
+JOB_OVERHEAD = 1024
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def estimate_cost(lang: str, code_length: int, output_format: str = "svg") -> float:
+    """Estimated relative cost of rendering ``code_length`` bytes of ``lang`` as ``output_format``."""
+    return (JOB_OVERHEAD + code_length) * LANG_WEIGHTS.get(lang, 1.0) * FORMAT_WEIGHTS.get(output_format, 1.0)
+
+
+class Scheduler:
+    """Shortest-job-first admission with aging under a concurrency cap.
+
+    Args:
+        concurrency: Maximum number of jobs holding a slot at once
+        aging: Cost units a waiting job is credited per second of waiting
+    """
+
+    def __init__(self, concurrency: int = 32, aging: float = 20000.0):
+        self.concurrency = concurrency
+        self.aging = aging
+        self.running = 0
+        self._queue: List[Tuple[float, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+
+    @classmethod
+    def from_env(cls) -> Optional["Scheduler"]:
+        concurrency = int(os.environ.get("SCHEDULER_CONCURRENCY", "32"))
+        if concurrency <= 0:
+            return None
+        return cls(concurrency, float(os.environ.get("SCHEDULER_AGING", "20000")))
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._queue if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, cost: float) -> AsyncIterator[None]:
+        """Hold one of the ``concurrency`` slots for the body of the block."""
+        arrived = time.monotonic()
+        with phase("queue"):
+            await self._acquire(arrived, cost)
+        self._observe(time.monotonic() - arrived)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, arrived: float, cost: float) -> None:
+        # Drop jobs cancelled while waiting at the head of the queue
+        while self._queue and self._queue[0][2].done():
+            heapq.heappop(self._queue)
+        if self.running < self.concurrency and not self._queue:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (arrived + cost / self.aging, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                # Hand the slot over: ``running`` stays the same
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def _observe(self, waited: float) -> None:
+        self.wait_counts[bisect_left(WAIT_BUCKETS, waited)] += 1
+        self.wait_sum += waited
+
+    def metrics(self) -> str:
+        """Queue wait histogram and gauges in the Prometheus text format."""
+        lines = [
+            "# HELP diagram_queue_wait_seconds Time render jobs waited for a scheduler slot.",
+            "# TYPE diagram_queue_wait_seconds histogram",
+        ]
+        total = 0
+        for bound, count in zip(WAIT_BUCKETS, self.wait_counts):
+            total += count
+            lines.append(f'diagram_queue_wait_seconds_bucket{{le="{bound}"}} {total}')
+        total += self.wait_counts[-1]
+        lines += [
+            f'diagram_queue_wait_seconds_bucket{{le="+Inf"}} {total}',
+            f"diagram_queue_wait_seconds_sum {self.wait_sum:.6f}",
+            f"diagram_queue_wait_seconds_count {total}",
+            "# HELP diagram_jobs_queued Render jobs waiting for a slot.",
+            "# TYPE diagram_jobs_queued gauge",
+            f"diagram_jobs_queued {self.queued}",
+            "# HELP diagram_jobs_running Render jobs holding a slot.",
+            "# TYPE diagram_jobs_running gauge",
+            f"diagram_jobs_running {self.running}",
+        ]
+        return "\n".join(lines) + "\n"
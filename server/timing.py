@@ -0,0 +1,108 @@
+"""
+Per-request phase timings exposed as a ``Server-Timing`` header.
+
+The middleware opens a :class:`Timings` recorder for each HTTP request and
+keeps it in a context variable; code anywhere below it (endpoint, backends)
+adds to a phase with :func:`phase`. Outside a request ``phase`` is a no-op.
+
+Phases reported:
+    validation: body parsing, pydantic and offline source checks
+    encode: deflate/base64 work done by the backends
+    upstream: time spent waiting on PlantUML/Kroki servers
+    serialization: from the endpoint returning to the response start
+"""
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, Iterator, Optional
+
+_current: ContextVar[Optional["Timings"]] = ContextVar("server_timings", default=None)
+_noop = nullcontext()
+
+
+class Timings:
+    """Accumulated phase durations (seconds) and named instants of one request."""
+
+    __slots__ = ("started", "phases", "marks")
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def mark(self, name: str) -> None:
+        self.marks[name] = perf_counter()
+
+    def header(self) -> str:
+        """Render the phases as a ``Server-Timing`` header value (milliseconds)."""
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={(perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(entries)
+
+
+def current() -> Optional[Timings]:
+    return _current.get()
+
+
+def mark(name: str) -> None:
+    """Record an instant for the current request, if any."""
+    timings = _current.get()
+    if timings is not None:
+        timings.mark(name)
+
+
+def phase(name: str):
+    """Context manager adding the time spent in its block to phase ``name``."""
+    timings = _current.get()
+    if timings is None:
+        return _noop
+    return _timed(timings, name)
+
+
+@contextmanager
+def _timed(timings: Timings, name: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - start)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware recording phases and adding the ``Server-Timing`` header.
+
+    Endpoints call ``mark("endpoint")`` on entry and ``mark("endpoint_done")``
+    on exit; the time before and after them is reported as ``validation`` and
+    ``serialization``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = Timings()
+        token = _current.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                marks = timings.marks
+                if "endpoint" in marks:
+                    timings.add("validation", marks["endpoint"] - timings.started)
+                if "endpoint_done" in marks:
+                    timings.add("serialization", perf_counter() - marks["endpoint_done"])
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.header().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
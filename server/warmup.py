@@ -0,0 +1,132 @@
+"""
+Hot-diagram manifest used to warm a fresh instance.
+
+While serving, :class:`HotDiagrams` counts ``/generate_diagram`` requests per
+diagram. At shutdown the counts are merged into the manifest file, which
+keeps the ``WARMUP_KEEP`` most requested diagrams, one JSON object per line::
+
+    {"count": 42, "lang": "mermaid", "type": "sequence", "code": "...", "theme": ""}
+
+At startup the top ``WARMUP_TOP_N`` entries are rendered into the caches
+before the instance reports ready; keeping more than are primed lets a
+diagram that is only warm today climb into the top over several restarts.
+The file can also be written by hand or generated from other sources; only
+``lang``, ``type`` and ``code`` are required.
+
+Configuration (environment):
+    WARMUP_MANIFEST: Path of the manifest (unset disables recording and priming).
+    WARMUP_TOP_N: Diagrams primed at startup (default 50).
+    WARMUP_KEEP: Diagrams counted while serving and kept in the manifest
+        (default 1000).
+    WARMUP_CONNECTIONS: Connections pre-opened per upstream (default 2).
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: single worker only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("lang", "type", "code", "theme")
+
+
+def _key(entry: Dict) -> Tuple[str, str, str]:
+    return entry["lang"], entry.get("theme", ""), entry["code"]
+
+
+def load_manifest(path: str, limit: int) -> List[Dict]:
+    """Return the ``limit`` most requested entries of the manifest at ``path``."""
+    entries = []
+    try:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    _key(entry)
+                    entry["type"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Skipping invalid manifest line %d of %s", number, path)
+                    continue
+                entries.append(entry)
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.get("count", 0), reverse=True)
+    return [{field: entry[field] for field in _FIELDS if field in entry} for entry in entries[:limit]]
+
+
+class HotDiagrams:
+    """Request counts per diagram, bounded to ``max_entries`` diagrams."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._counts: Counter = Counter()
+        self._entries: Dict[Tuple[str, str, str], Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, lang: str, diagram_type: str, code: str, theme: str = "") -> None:
+        entry = {"lang": lang, "type": diagram_type, "code": code, "theme": theme}
+        key = _key(entry)
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Forget the colder half so newly popular diagrams can get in
+                for cold, _ in self._counts.most_common()[self.max_entries // 2:]:
+                    del self._counts[cold]
+                    del self._entries[cold]
+            self._entries.setdefault(key, entry)
+            self._counts[key] += 1
+
+    @classmethod
+    def from_env(cls) -> "HotDiagrams":
+        return cls(int(os.environ.get("WARMUP_KEEP", "1000")))
+
+    def save(self, path: str, limit: Optional[int] = None) -> int:
+        """
+        Merge the counts into the manifest at ``path`` and keep its top ``limit``
+        entries (``max_entries`` by default).
+
+        Workers of one host serialise their updates with a lock file.
+
+        Returns:
+            The number of entries written
+        """
+        with open(f"{path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._merge_into(path, self.max_entries if limit is None else limit)
+
+    def _merge_into(self, path: str, limit: int) -> int:
+        merged: Dict[Tuple[str, str, str], Dict] = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        merged[_key(entry)] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            for key, count in self._counts.items():
+                entry = merged.setdefault(key, {**self._entries[key], "count": 0})
+                entry["count"] = entry.get("count", 0) + count
+            # Counted once: a later save only adds what was recorded since
+            self._counts.clear()
+            self._entries.clear()
+        top = sorted(merged.values(), key=lambda entry: entry.get("count", 0), reverse=True)[:limit]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            for entry in top:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, path)
+        return len(top)
@@ -1,4 +1,5 @@
 import sys
+import time
 
 from fastapi.testclient import TestClient
 import pytest
@@ -146,3 +147,1101 @@ async def test_run_go_script():
     assert url is not None
     assert content is not None
     assert playground is not None
+
+@pytest.mark.asyncio
+async def test_run_go_script_times_out_instead_of_failing(monkeypatch):
+    import asyncio
+    from D2 import run_d2
+    from server import deadline
+
+    killed = []
+    class SlowProcess:
+        returncode = None
+        async def communicate(self):
+            await asyncio.sleep(60)
+        def kill(self):
+            killed.append(True)
+        async def wait(self):
+            return -9
+    async def spawn(*args, **kwargs):
+        return SlowProcess()
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spawn)
+    monkeypatch.setattr(run_d2, "DEFAULT_TIMEOUT", 0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        await run_go_script("a -> b")
+    assert killed == [True]
+
+    # With the deadline already gone no encoder is started
+    async def unexpected(*args, **kwargs):
+        raise AssertionError("encoder started")
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", unexpected)
+    token = deadline._deadline.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await run_go_script("a -> b")
+    finally:
+        deadline._deadline.reset(token)
+
+def test_plantuml_decode_and_inflate():
+    plantuml = PlantUML(url="https://www.plantuml.com/plantuml/dpng")
+    text = "@startuml\nAlice -> Bob: Authentication Request\n@enduml"
+    assert plantuml.decode_and_inflate(plantuml.deflate_and_encode(text)) == text
+    assert plantuml.decode_and_inflate("~h" + text.encode().hex()) == text
+
+def test_migrate_decode_url():
+    from D2.d2 import generate_d2graphviz_url
+    from cli.migrate import decode_url
+
+    plantuml = PlantUML(url="https://www.plantuml.com/plantuml/dpng")
+    text = "@startuml\nAlice -> Bob: hi\n@enduml"
+    assert decode_url(plantuml.get_url(text)) == ("plantuml", text)
+
+    url, code, playground = generate_mermaid_live_editor_url(generate_diagram_state("graph TD; A-->B;"))
+    assert decode_url(url) == ("mermaid", code)
+    assert decode_url(playground) == ("mermaid", code)
+
+    assert decode_url(generate_d2graphviz_url("a -> b")) == ("d2", "a -> b")
+
+    with pytest.raises(ValueError):
+        decode_url("https://example.com/diagram.png")
+
+def test_migrate_resumes_from_checkpoint(tmp_path):
+    import json
+    from cli.migrate import migrate
+
+    state = generate_diagram_state("graph TD; A-->B;")
+    url, _, _ = generate_mermaid_live_editor_url(state)
+    source = tmp_path / "urls.txt"
+    source.write_text(f"{url}\nhttps://example.com/unknown\n")
+    output = tmp_path / "mapping.jsonl"
+
+    counters = migrate(str(source), str(output), workers=1, batch_size=1)
+    assert (counters["lines"], counters["ok"], counters["failed"]) == (2, 1, 1)
+    rows = [json.loads(line) for line in output.read_text().splitlines()]
+    assert rows[0]["kroki"].startswith("https://kroki.io/mermaid/svg/")
+    assert "error" in rows[1]
+
+    # A second run resumes after the last checkpoint and adds nothing
+    migrate(str(source), str(output), workers=1, batch_size=1)
+    assert len(output.read_text().splitlines()) == 2
+
+@pytest.mark.parametrize("lang, code, line, column", [
+    ("plantuml", "Alice -> Bob: hi", None, None),
+    ("plantuml", "@startuml\nAlice -> Bob: hi\n", 1, 1),
+    ("mermaid", "graph TD\nA-->B", None, None),
+    ("mermaid", "%% comment\ngrph TD\nA-->B", 2, 1),
+    ("d2", "a: {\n  b -> c\n", 1, 4),
+    ("d2", "a: {\n  style: {\n    fil: red\n  }\n}", 3, 5),
+    ("d2", "a.style.fill: \"#fff\"\n# } not a brace", None, None),
+    ("graphviz", "digraph { a -> b [label=\"}\"]", 1, 9),
+])
+def test_validate_source(lang, code, line, column):
+    from validation import DiagramSyntaxError, validate_source
+
+    if line is None:
+        validate_source(lang, code)
+        return
+    with pytest.raises(DiagramSyntaxError) as excinfo:
+        validate_source(lang, code)
+    assert (excinfo.value.line, excinfo.value.column) == (line, column)
+
+def test_generate_diagram_endpoint_rejects_invalid_source():
+    response = client.post("/generate_diagram", json={
+        "lang": "d2",
+        "type": "class",
+        "code": "a -> b\nc: {\n"
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == {"message": "'{' is never closed", "line": 2, "column": 4}
+
+def test_structured_logging_helpers():
+    import json
+    import logging
+    import queue
+    import sys
+    from server.logs import JSONFormatter, SamplingFilter, StructuredQueueHandler, parse_sample_rates
+
+    assert parse_sample_rates("DEBUG=0, info=0.5") == {logging.DEBUG: 0.0, logging.INFO: 0.5}
+    with pytest.raises(ValueError):
+        parse_sample_rates("LOUD=1")
+
+    record = logging.LogRecord("app", logging.INFO, __file__, 1, "handled %s", ("x",), None)
+    record.lang = "d2"
+    record.duration_ms = 1.5
+    payload = json.loads(JSONFormatter().format(record))
+    assert payload["msg"] == "handled x"
+    assert (payload["lang"], payload["duration_ms"]) == ("d2", 1.5)
+
+    # Tracebacks are rendered before enqueueing and still land in their own field
+    log_queue = queue.SimpleQueue()
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        error = logging.LogRecord("app", logging.ERROR, __file__, 1, "failed %s", ("x",), sys.exc_info())
+    StructuredQueueHandler(log_queue).handle(error)
+    payload = json.loads(JSONFormatter().format(log_queue.get_nowait()))
+    assert payload["msg"] == "failed x"
+    assert payload["exc"].startswith("Traceback") and "ValueError: boom" in payload["exc"]
+
+    sampler = SamplingFilter({logging.INFO: 0.0})
+    assert not sampler.filter(record)
+    record.levelno = logging.ERROR
+    assert sampler.filter(record)
+
+def test_server_timing_header():
+    response = client.post("/generate_diagram", json={
+        "lang": "mermaid",
+        "type": "sequence",
+        "code": "graph TD; Timing-->Header;"
+    })
+    assert response.status_code == 200
+    phases = {entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")}
+    assert {"validation", "encode", "serialization", "total"} <= phases
+
+@pytest.mark.parametrize("mode, suffix", [("pstats", ".prof"), ("collapsed", ".folded")])
+def test_profiling_requires_admin_token(monkeypatch, tmp_path, mode, suffix):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    body = {"lang": "mermaid", "type": "sequence", "code": "graph TD; A-->B;"}
+
+    response = client.post("/generate_diagram", json=body, headers={"X-Profile": mode, "X-Admin-Token": "wrong"})
+    assert response.status_code == 403
+
+    response = client.post(f"/generate_diagram?profile={mode}", json=body, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    filename = response.headers["x-profile-file"]
+    assert filename.endswith(suffix)
+    assert (tmp_path / filename).exists()
+
+def test_rate_limiter_returns_429_with_retry_after():
+    from server.ratelimit import RateLimiter
+
+    previous = app.state.client_limiter
+    app.state.client_limiter = RateLimiter(rate=0.5, burst=1, max_wait=0.1)
+    try:
+        body = {"lang": "mermaid", "type": "sequence", "code": "graph TD; A-->B;"}
+        assert client.post("/generate_diagram", json=body).status_code == 200
+        response = client.post("/generate_diagram", json=body)
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "2"
+        # Another API key has its own bucket
+        assert client.post("/generate_diagram", json=body, headers={"X-API-Key": "other"}).status_code == 200
+    finally:
+        app.state.client_limiter = previous
+
+def test_sqlite_bucket_store_is_shared(tmp_path):
+    from server.ratelimit import SQLiteBucketStore
+
+    path = str(tmp_path / "buckets.db")
+    first, second = SQLiteBucketStore(path), SQLiteBucketStore(path)
+    assert first.reserve("ip:1", rate=1, burst=1, max_wait=0) == (True, 0.0)
+    granted, wait = second.reserve("ip:1", rate=1, burst=1, max_wait=0)
+    assert not granted and wait > 0.9
+
+@pytest.mark.asyncio
+async def test_sqlite_limiter_reserves_off_the_event_loop(tmp_path):
+    import threading
+    from server.ratelimit import RateLimiter, SQLiteBucketStore
+
+    threads = []
+    class Store(SQLiteBucketStore):
+        def reserve(self, *args):
+            threads.append(threading.current_thread())
+            return super().reserve(*args)
+    await RateLimiter(rate=1, burst=1, store=Store(str(tmp_path / "buckets.db"))).acquire("ip:1")
+    assert threads and threads[0] is not threading.main_thread()
+
+def test_shared_cache_is_visible_across_instances(tmp_path):
+    from server.cache import SharedCache, cache_key
+
+    path = str(tmp_path / "render-cache")
+    writer, reader = SharedCache(path, slots=8, slot_size=256), SharedCache(path, slots=8, slot_size=256)
+    key = cache_key("mermaid", "", "graph TD; A-->B;")
+    assert reader.get(key) is None
+    assert writer.set(key, {"url": "https://mermaid.ink/svg/x"})
+    assert reader.get(key) == {"url": "https://mermaid.ink/svg/x"}
+    # Values larger than a slot are skipped instead of truncated
+    assert not writer.set(cache_key("big"), {"content": "x" * 1024})
+    # A full group evicts instead of failing
+    for i in range(32):
+        assert writer.set(cache_key(str(i)), {"i": i})
+    assert reader.get(cache_key("31")) == {"i": 31}
+
+def test_generate_diagram_uses_render_cache():
+    body = {"lang": "d2", "type": "class", "code": "cached -> twice"}
+    first = client.post("/generate_diagram", json=body).json()
+    hits = app.state.render_cache.hits
+    assert client.post("/generate_diagram", json=body).json() == first
+    assert app.state.render_cache.hits == hits + 1
+
+def test_preview_websocket_debounces_and_skips_unchanged_sources():
+    with client.websocket_connect("/ws/preview?debounce=0.05") as websocket:
+        websocket.send_json({"lang": "d2", "code": "a -> "})
+        websocket.send_json({"lang": "d2", "code": "a -> b"})
+        message = websocket.receive_json()
+        assert message["seq"] == 1
+        assert message["url"].startswith("https://kroki.io/d2/svg/")
+        assert message["playground"].startswith("https://play.d2lang.com/?script=")
+
+        # Whitespace-only edits are not re-rendered
+        websocket.send_json({"lang": "d2", "code": "a -> b   \r\n"})
+        time.sleep(0.2)
+        websocket.send_json({"lang": "mermaid", "code": "grph TD"})
+        message = websocket.receive_json()
+        assert message["seq"] == 2
+        assert message["error"]["line"] == 1
+
+        # Malformed messages are answered without closing the session
+        websocket.send_text("{not json")
+        assert "Invalid JSON" in websocket.receive_json()["error"]["message"]
+        websocket.send_bytes(b'{"lang": "d2", "code": "x -> y"}')
+        assert websocket.receive_json() == {"error": {"message": "Expected a text frame."}}
+        websocket.send_json({"lang": "d2", "code": "x -> y"})
+        assert websocket.receive_json()["seq"] == 3
+
+@pytest.mark.parametrize("body", [
+    {"lang": "mermaid", "type": "class", "code": "graph TD; Fast-->Path;"},
+    {"lang": "nope", "type": "class", "code": "graph TD; A-->B;"},
+    {"lang": 1, "type": "class", "code": "graph TD; A-->B;"},
+    {"type": "class"},
+])
+def test_fast_json_route_matches_default_route(body):
+    from fastapi import FastAPI
+    from fastapi.routing import APIRoute
+    from server.fastjson import FastJSONRoute
+    from .app import generate_diagram_endpoint
+
+    responses = []
+    for route_class in (APIRoute, FastJSONRoute):
+        other = FastAPI()
+        other.state.client_limiter = other.state.upstream_limiter = other.state.hot_diagrams = None
+        other.state.scheduler = app.state.scheduler
+        other.state.failures = app.state.failures
+        other.state.render_cache = app.state.render_cache
+        other.router.add_api_route("/generate_diagram", generate_diagram_endpoint, methods=["POST"],
+                                   route_class_override=route_class)
+        response = TestClient(other).post("/generate_diagram", json=body)
+        responses.append((response.status_code, response.json(), other.openapi()))
+    assert responses[0] == responses[1]
+
+def test_minify_svg_and_optimize_png():
+    import struct
+    import zlib
+    from server.artifacts import PNG_SIGNATURE, minify_svg, optimize_png
+
+    svg = (b'<?xml version="1.0"?>\n<!-- x -->\n<svg xmlns="http://www.w3.org/2000/svg" width="10.123456">\n'
+           b'  <metadata>m</metadata>\n  <path d="M 0.500001 1.25 L 2e-5 3"/>\n  <text> a &lt; b </text>\n</svg>')
+    assert minify_svg(svg, chunk_size=5) == (b'<svg xmlns="http://www.w3.org/2000/svg" width="10.123">'
+                                            b'<path d="M .5 1.25 L 2e-5 3"/><text> a &lt; b </text></svg>')
+
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    raw = b"".join(b"\0" + bytes((x * y) % 7 for x in range(32)) for y in range(32))
+    png = (PNG_SIGNATURE + chunk(b"IHDR", struct.pack(">IIBBBBB", 32, 32, 8, 0, 0, 0, 0))
+           + chunk(b"tEXt", b"plantuml\0source") + chunk(b"IDAT", zlib.compress(raw, 0)) + chunk(b"IEND", b""))
+    optimized = optimize_png(png)
+    assert len(optimized) < len(png)
+    assert b"tEXt" not in optimized
+    assert zlib.decompress(optimized[8 + 25 + 8:-12 - 4]) == raw
+
+def test_render_diagram_returns_optimized_artifact(monkeypatch):
+    from . import app as app_module
+
+    calls = []
+    def fake_fetch(diagram, output_format):
+        calls.append(output_format)
+        return b'<svg xmlns="http://www.w3.org/2000/svg">\n  <!-- c -->\n  <rect width="1.00001"/>\n</svg>'
+    monkeypatch.setattr(app_module, "fetch_artifact", fake_fetch)
+    test_client = TestClient(app_module.app)
+    body = {"lang": "graphviz", "type": "class", "code": "digraph { a -> b }"}
+    for _ in range(2):
+        response = test_client.post("/render_diagram?format=svg", json=body)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/svg+xml"
+        assert response.content == b'<svg xmlns="http://www.w3.org/2000/svg"><rect width="1"/></svg>'
+    # The second request is served from the artifact cache
+    assert calls == ["svg"]
+    assert test_client.post("/render_diagram?format=gif", json=body).status_code == 422
+
+def test_render_diagram_converts_missing_formats_locally(monkeypatch):
+    from . import app as app_module
+
+    calls = []
+    def fake_fetch(diagram, output_format):
+        calls.append(output_format)
+        return b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+    async def fake_convert(svg, output_format):
+        return b"%s:" % output_format.encode() + svg
+    monkeypatch.setattr(app_module, "fetch_artifact", fake_fetch)
+    body = {"lang": "wavedrom", "type": "class", "code": '{ signal: [{ name: "clk", wave: "p..." }] }'}
+
+    monkeypatch.setattr(app_module, "can_convert", lambda output_format: False)
+    assert client.post("/render_diagram?format=png", json=body).status_code == 501
+
+    monkeypatch.setattr(app_module, "can_convert", lambda output_format: True)
+    monkeypatch.setattr(app.state.artifacts, "convert", fake_convert)
+    for output_format, media_type in (("png", "image/png"), ("pdf", "application/pdf")):
+        response = client.post(f"/render_diagram?format={output_format}", json=body)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == media_type
+        assert response.content == output_format.encode() + b':<svg xmlns="http://www.w3.org/2000/svg"/>'
+    assert calls == ["svg"]
+
+def test_artifacts_follow_changes_of_included_files(monkeypatch, tmp_path):
+    import os
+    from plantuml.includes import IncludeResolver
+    from . import app as app_module
+
+    (tmp_path / "style.iuml").write_text("skinparam monochrome true")
+    monkeypatch.setattr(app_module, "plantuml_includes", IncludeResolver([str(tmp_path)]))
+    def fake_fetch(diagram, output_format):
+        return app_module.plantuml_includes.inline(diagram.code).encode()
+    monkeypatch.setattr(app_module, "fetch_artifact", fake_fetch)
+    body = {"lang": "plantuml", "type": "class", "code": "@startuml\n!include style.iuml\nA -> B\n@enduml"}
+    assert b"monochrome" in client.post("/render_diagram?format=txt", json=body).content
+    (tmp_path / "style.iuml").write_text("skinparam shadowing false")
+    os.utime(tmp_path / "style.iuml", ns=(1, 1))
+    assert b"shadowing" in client.post("/render_diagram?format=txt", json=body).content
+
+def test_startup_warm_up_primes_cache_and_records_manifest(monkeypatch, tmp_path):
+    import json
+    from server.cache import SharedCache, cache_key
+    from server.warmup import HotDiagrams, load_manifest
+
+    manifest = tmp_path / "hot.jsonl"
+    hot = {"count": 9, "lang": "mermaid", "type": "sequence", "code": "graph TD; Warm-->Up;", "theme": ""}
+    manifest.write_text(json.dumps(hot) + "\n" + json.dumps({**hot, "count": 1, "code": "graph TD; Cold;"}) + "\nnot json\n")
+    assert [entry["code"] for entry in load_manifest(str(manifest), 1)] == ["graph TD; Warm-->Up;"]
+
+    monkeypatch.setenv("WARMUP_MANIFEST", str(manifest))
+    monkeypatch.setenv("WARMUP_TOP_N", "1")
+    monkeypatch.setenv("UPSTREAM_URLS", "")
+    monkeypatch.setattr(app.state, "render_cache", SharedCache(slots=16))
+    monkeypatch.setattr(app.state, "hot_diagrams", HotDiagrams())
+    assert client.get("/ready").status_code == 503
+    with TestClient(app) as warm_client:
+        for _ in range(50):
+            if warm_client.get("/ready").status_code == 200:
+                break
+            time.sleep(0.02)
+        assert warm_client.get("/ready").json() == {"status": "ready"}
+        assert app.state.render_cache.get(cache_key("mermaid", "", "graph TD; Warm-->Up;")) is not None
+        body = {"lang": "mermaid", "type": "class", "code": "graph TD; Newly-->Hot;"}
+        assert warm_client.post("/generate_diagram", json=body).status_code == 200
+    # Shutdown merged the served request into the manifest, which keeps more than is primed
+    codes = {entry["code"]: entry["count"] for entry in map(json.loads, manifest.read_text().splitlines())}
+    assert codes == {"graph TD; Warm-->Up;": 9, "graph TD; Cold;": 1, "graph TD; Newly-->Hot;": 1}
+
+    recorded = HotDiagrams()
+    for _ in range(2):
+        recorded.record("d2", "class", "a -> b")
+    assert recorded.save(str(tmp_path / "other.jsonl"), 5) == 1
+    assert recorded.save(str(tmp_path / "other.jsonl"), 5) == 1
+    assert json.loads((tmp_path / "other.jsonl").read_text())["count"] == 2
+
+def test_batch_renderer_skips_unchanged_files(tmp_path):
+    from cli.render import MANIFEST_NAME, Renderer, render_tree
+
+    class FakeRenderer(Renderer):
+        def __init__(self):
+            super().__init__("svg")
+            self.calls = []
+
+        def render(self, lang, source):
+            self.calls.append(lang)
+            return f"<svg>{lang}</svg>".encode()
+
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "flow.mmd").write_text("graph TD; A-->B;")
+    (tmp_path / "docs" / "seq.puml").write_text("@startuml\nA -> B\n@enduml")
+    (tmp_path / "arch.d2").write_text("a -> b")
+    (tmp_path / "notes.txt").write_text("not a diagram")
+
+    renderer = FakeRenderer()
+    assert render_tree(str(tmp_path), renderer=renderer) == {"rendered": 3, "skipped": 0, "failed": 0}
+    assert sorted(renderer.calls) == ["d2", "mermaid", "plantuml"]
+    assert (tmp_path / "docs" / "flow.svg").read_bytes() == b"<svg>mermaid</svg>"
+    assert (tmp_path / MANIFEST_NAME).exists()
+
+    (tmp_path / "arch.d2").write_text("a -> c")
+    renderer.calls.clear()
+    assert render_tree(str(tmp_path), renderer=renderer) == {"rendered": 1, "skipped": 2, "failed": 0}
+    assert renderer.calls == ["d2"]
+
+    # An interrupted run keeps the entries it did not get to; deleted sources are dropped
+    import json
+    before = json.loads((tmp_path / MANIFEST_NAME).read_text())
+    (tmp_path / "arch.d2").unlink()
+    (tmp_path / "docs" / "flow.mmd").write_text("graph TD; A-->C;")
+    def interrupted(lang, source):
+        raise KeyboardInterrupt()
+    renderer.render = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        render_tree(str(tmp_path), renderer=renderer, workers=1)
+    after = json.loads((tmp_path / MANIFEST_NAME).read_text())
+    assert after == {relpath: entry for relpath, entry in before.items() if relpath != "arch.d2"}
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch_rerenders_only_dependents_of_a_change(tmp_path, polling):
+    import threading
+    from cli.render import Renderer
+    from cli.watch import DependencyGraph, watch
+
+    (tmp_path / "styles").mkdir()
+    (tmp_path / "styles" / "theme.iuml").write_text("skinparam monochrome true")
+    (tmp_path / "a.puml").write_text("@startuml\n!include styles/theme.iuml\nA -> B\n@enduml")
+    (tmp_path / "b.puml").write_text("@startuml\n!include <C4/C4_Container>\nB -> C\n@enduml")
+    (tmp_path / "shared.d2").write_text("x")
+    (tmp_path / "c.d2").write_text("...@shared\nc -> d")
+
+    graph = DependencyGraph(str(tmp_path))
+    graph.scan()
+    assert graph.affected(["styles/theme.iuml"]) == {"a.puml"}
+    assert graph.affected(["shared.d2"]) == {"shared.d2", "c.d2"}
+
+    class FakeRenderer(Renderer):
+        def __init__(self):
+            super().__init__("svg")
+            self.calls = []
+
+        def render(self, lang, source):
+            self.calls.append(source)
+            return b"<svg/>"
+
+    renderer = FakeRenderer()
+    stop = threading.Event()
+    thread = threading.Thread(target=watch, args=(str(tmp_path), renderer),
+                              kwargs={"debounce": 0.1, "polling": polling, "stop": stop})
+    thread.start()
+    try:
+        time.sleep(0.3)
+        for i in range(3):  # rapid saves are coalesced
+            (tmp_path / "styles" / "theme.iuml").write_text(f"skinparam monochrome {i}")
+            time.sleep(0.02)
+        for _ in range(100):
+            if renderer.calls:
+                break
+            time.sleep(0.02)
+        time.sleep(0.3)
+    finally:
+        stop.set()
+        thread.join()
+    assert renderer.calls == ["@startuml\n!include styles/theme.iuml\nA -> B\n@enduml"]
+    assert (tmp_path / "a.svg").exists() and not (tmp_path / "b.svg").exists()
+
+def test_include_resolver_inlines_only_used_definitions(tmp_path):
+    import os
+    from plantuml.includes import IncludeResolver
+
+    lib = tmp_path / "lib"
+    lib.mkdir()
+    (lib / "macros.iuml").write_text(
+        "' library header\n"
+        "!procedure $box($name)\n  rectangle $name\n  $note()\n!endprocedure\n"
+        "!procedure $note()\n  note \"n\"\n!endprocedure\n"
+        "!procedure $unused()\n  rectangle U\n!endprocedure\n"
+        "!define UNUSED_MACRO 1\n"
+        "!startsub STYLE\nskinparam monochrome true\n!endsub\n"
+    )
+    (tmp_path / "secret.iuml").write_text("skinparam secret true")
+    resolver = IncludeResolver([str(lib)])
+    source = ("@startuml\n!include macros.iuml\n!includesub macros.iuml!STYLE\n"
+              "!include ../secret.iuml\n!include <C4/C4_Container>\n$box(A)\n@enduml")
+    assert resolver.inline(source).splitlines() == [
+        "@startuml",
+        "!procedure $box($name)", "  rectangle $name", "  $note()", "!endprocedure",
+        "!procedure $note()", "  note \"n\"", "!endprocedure",
+        "skinparam monochrome true",
+        "skinparam monochrome true",
+        "!include ../secret.iuml",
+        "!include <C4/C4_Container>",
+        "$box(A)",
+        "@enduml",
+    ]
+    # Fragments are re-read once modified
+    (lib / "macros.iuml").write_text("skinparam shadowing false")
+    os.utime(lib / "macros.iuml", ns=(1, 1))
+    assert "skinparam shadowing false" in resolver.inline("@startuml\n!include macros.iuml\n@enduml")
+    assert PlantUML("http://example.com/svg", includes=resolver).get_url("@startuml\n!include macros.iuml\n@enduml") == \
+        PlantUML("http://example.com/svg").get_url("@startuml\nskinparam shadowing false\n@enduml")
+
+def test_include_resolver_refuses_recursion_and_caps_size(tmp_path, monkeypatch):
+    from plantuml import includes
+
+    (tmp_path / "self.iuml").write_text("A -> B\n!include_many self.iuml\n!include_many self.iuml")
+    (tmp_path / "a.iuml").write_text("!include b.iuml\nA -> B")
+    (tmp_path / "b.iuml").write_text("!include a.iuml\nB -> C")
+    resolver = includes.IncludeResolver([str(tmp_path)])
+    assert resolver.inline("@startuml\n!include_many self.iuml\n@enduml").splitlines() == [
+        "@startuml", "A -> B", "!include_many self.iuml", "!include_many self.iuml", "@enduml",
+    ]
+    assert resolver.inline("@startuml\n!include a.iuml\n@enduml").splitlines() == [
+        "@startuml", "!include a.iuml", "B -> C", "A -> B", "@enduml",
+    ]
+
+    (tmp_path / "wide.iuml").write_text("\n".join(["!include_many leaf.iuml"] * 100))
+    (tmp_path / "leaf.iuml").write_text("X -> Y")
+    monkeypatch.setattr(includes, "_MAX_INLINED", 500)
+    source = "@startuml\n!include wide.iuml\n@enduml"
+    assert resolver.inline(source) == source
+
+@pytest.mark.asyncio
+async def test_plantuml_renders_pages_concurrently():
+    import asyncio
+    import httpx
+
+    in_flight = peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return httpx.Response(200, content=request.url.path.encode())
+
+    plantuml = PlantUML("http://example.com/svg")
+    source = ("@startuml\nA -> B\nnewpage\nB -> C\n/'\nnewpage\n'/\n@enduml\n"
+              "@startmindmap\n* root\n@endmindmap")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        pages = await plantuml.render_pages(source, client)
+    first = plantuml.deflate_and_encode("@startuml\nA -> B\nnewpage\nB -> C\n/'\nnewpage\n'/\n@enduml")
+    second = plantuml.deflate_and_encode("@startmindmap\n* root\n@endmindmap")
+    assert [url for url, _ in pages] == [
+        f"http://example.com/svg/0/{first}", f"http://example.com/svg/1/{first}", f"http://example.com/svg/{second}",
+    ]
+    assert [content for _, content in pages] == [f"/svg/0/{first}".encode(), f"/svg/1/{first}".encode(),
+                                                 f"/svg/{second}".encode()]
+    assert peak == 3
+    # The fan-out is bounded
+    peak = 0
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        await plantuml.render_pages(source, client, concurrency=2)
+    assert peak == 2
+    # Single-page sources keep their usual URL
+    assert plantuml.get_page_urls("@startuml\nA -> B\n@enduml") == [plantuml.get_url("@startuml\nA -> B\n@enduml")]
+
+def test_multi_page_documents_are_charged_per_page(monkeypatch):
+    from . import app as app_module
+    from server.ratelimit import RateLimiter
+    from server.scheduler import Scheduler, estimate_cost
+
+    costs = []
+    class RecordingScheduler(Scheduler):
+        def slot(self, cost):
+            costs.append(cost)
+            return super().slot(cost)
+
+    async def fake_render(diagram):
+        return app_module.DiagramResult("u", diagram.code, lambda: "p")
+    monkeypatch.setattr(app_module, "render_diagram", fake_render)
+    monkeypatch.setattr(app.state, "scheduler", RecordingScheduler())
+    monkeypatch.setattr(app.state, "upstream_limiter", RateLimiter(rate=0.01, burst=3, max_wait=0))
+    code = "@startuml\nA -> B\nnewpage\nB -> C\nnewpage\nC -> D\n@enduml"
+    body = {"lang": "plantuml", "type": "sequence", "code": code}
+    assert client.post("/generate_diagram", json=body).status_code == 200
+    assert costs == [estimate_cost("plantuml", len(code)) * 3]
+    # The three pages used up the upstream burst
+    body["code"] = "@startuml\nX -> Y\n@enduml"
+    assert client.post("/generate_diagram", json=body).status_code == 429
+
+    # Links built locally take no upstream token
+    for local in ("graph TD; Local-->One;", "graph TD; Local-->Two;"):
+        assert client.post("/generate_diagram", json={"lang": "mermaid", "type": "class", "code": local}).status_code == 200
+    assert client.post("/generate_diagram", json={"lang": "d2", "type": "class", "code": "local -> link"}).status_code == 200
+
+    # Documents the limiter could never admit are refused for good, not told to retry
+    body["code"] = "@startuml\nA -> B\nnewpage\nB -> C\nnewpage\nC -> D\nnewpage\nD\n@enduml"
+    response = client.post("/generate_diagram", json=body)
+    assert response.status_code == 413 and "retry-after" not in response.headers
+    monkeypatch.setattr(app_module, "PLANTUML_MAX_PAGES", 2)
+    body["code"] = code.replace("A -> B", "A -> Z")
+    assert client.post("/generate_diagram", json=body).status_code == 413
+
+def test_generate_diagram_fields_skip_unrequested_playground(monkeypatch):
+    from kroki.kroki import Kroki
+
+    def unexpected(*args, **kwargs):
+        raise AssertionError("playground computed")
+
+    body = {"lang": "graphviz", "type": "class", "code": "digraph { only -> url }"}
+    with monkeypatch.context() as patched:
+        patched.setattr(Kroki, "get_playground_url", unexpected)
+        response = client.post("/generate_diagram?fields=url", json=body)
+    assert response.status_code == 200
+    assert list(response.json()) == ["url"]
+    full = client.post("/generate_diagram", json=body).json()
+    assert full["url"] == response.json()["url"] and set(full) == {"url", "content", "playground"}
+    assert client.post("/generate_diagram?fields=playground,content", json=body).json() == {
+        "content": full["content"], "playground": full["playground"],
+    }
+    assert client.post("/generate_diagram?fields=size", json=body).status_code == 422
+
+def test_kroki_url_and_plantuml_playground_share_one_deflate(monkeypatch):
+    import base64
+    import zlib
+    from kroki.kroki import Kroki
+
+    compressions = []
+    compressobj = zlib.compressobj
+    monkeypatch.setattr(zlib, "compressobj", lambda *args, **kwargs: compressions.append(1) or compressobj(*args, **kwargs))
+    text = "@startuml\n!include <C4/C4_Container>\n" + "Container(api, \"API\", \"Python\")\n" * 50 + "@enduml"
+    kroki = Kroki()
+    url = kroki.get_url("plantuml", text)
+    playground = kroki.get_playground_url("plantuml", text)
+    assert len(compressions) == 1
+    assert zlib.decompress(base64.urlsafe_b64decode(url.rsplit("/", 1)[1])).decode() == text
+    assert PlantUML("http://example.com/svg").decode_and_inflate(playground.rsplit("/", 1)[1]) == text
+
+@pytest.mark.asyncio
+async def test_scheduler_runs_small_jobs_first_and_ages_large_ones():
+    import asyncio
+    from server.scheduler import Scheduler, estimate_cost
+
+    assert estimate_cost("plantuml", 90000) > estimate_cost("plantuml", 200) > estimate_cost("mermaid", 200)
+    scheduler = Scheduler(concurrency=1, aging=1000)
+    order = []
+
+    async def job(name, cost):
+        async with scheduler.slot(cost):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async with scheduler.slot(1):
+        large = asyncio.create_task(job("large", 90000))
+        await asyncio.sleep(0)
+        small = asyncio.create_task(job("small", 100))
+        cancelled = asyncio.create_task(job("cancelled", 1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+    await asyncio.gather(large, small, return_exceptions=True)
+    assert order == ["small", "large"]
+
+    # A job that waited long enough goes before newer, smaller ones
+    order.clear()
+    async with scheduler.slot(1):
+        large = asyncio.create_task(job("large", 200))
+        await asyncio.sleep(0.3)
+        small = asyncio.create_task(job("small", 50))
+        await asyncio.sleep(0)
+    await asyncio.gather(large, small)
+    assert order == ["large", "small"]
+    assert scheduler.running == 0 and scheduler.queued == 0
+    assert 'diagram_queue_wait_seconds_count 6' in scheduler.metrics()
+
+def test_metrics_endpoint_reports_queue_wait():
+    client.post("/generate_diagram", json={"lang": "d2", "type": "class", "code": "metrics -> queue"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "diagram_queue_wait_seconds_count" in response.text
+
+def test_upstream_rejections_are_parsed_and_negatively_cached(monkeypatch):
+    import httpx
+    from kroki.kroki import KrokiHTTPError
+    from . import app as app_module
+
+    calls = []
+    def rejecting_fetch(diagram, output_format):
+        calls.append(output_format)
+        response = httpx.Response(400, content=b"Error 400: Syntax Error? (line: 2)\n",
+                                  request=httpx.Request("GET", "https://kroki.io/graphviz/svg/x"))
+        raise KrokiHTTPError(response, response.content)
+    monkeypatch.setattr(app_module, "fetch_artifact", rejecting_fetch)
+    body = {"lang": "graphviz", "type": "class", "code": "digraph {\n a -> -> b }"}
+    for _ in range(3):
+        response = client.post("/render_diagram?format=svg", json=body)
+        assert response.status_code == 400
+        assert response.json()["detail"] == {"message": "Syntax Error? (line: 2)", "line": 2, "column": 1}
+    # Retries of the same source are answered without the upstream
+    assert calls == ["svg"]
+
+    headers = {"X-PlantUML-Diagram-Error": "Syntax Error?", "X-PlantUML-Diagram-Error-Line": "3"}
+    response = httpx.Response(400, headers=headers, request=httpx.Request("GET", "https://www.plantuml.com/plantuml/png/x"))
+    error = PlantUMLHTTPError(httpx.HTTPStatusError("400", request=response.request, response=response), "")
+    assert (error.diagram_error, error.diagram_error_line) == ("Syntax Error?", 3)
+    assert PlantUMLHTTPError(error, "").diagram_error_line == 3
+
+@pytest.mark.asyncio
+async def test_plantuml_error_lines_point_into_the_submitted_source(tmp_path):
+    import httpx
+    from kroki.kroki import KrokiHTTPError
+    from plantuml.includes import IncludeResolver
+    from .app import upstream_syntax_error
+
+    response = httpx.Response(400, content=b"Error 400: Syntax Error?\n",
+                              request=httpx.Request("GET", "https://kroki.io/graphviz/svg/x"))
+    # No line is made up when the upstream gives none
+    assert upstream_syntax_error(KrokiHTTPError(response, response.content)).to_dict() == \
+        {"message": "Syntax Error?", "line": None, "column": None}
+
+    def handler(request):
+        if request.url.path.count("/") > 2:
+            # Only the second diagram is rejected, on its second line
+            return httpx.Response(400, headers={"X-PlantUML-Diagram-Error": "Syntax Error?",
+                                                "X-PlantUML-Diagram-Error-Line": "2"})
+        return httpx.Response(200, content=b"ok")
+    plantuml = PlantUML("http://example.com/svg")
+    source = "@startuml\nA -> B\n@enduml\n\n@startuml\nB -> -> C\nnewpage\nD\n@enduml"
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(PlantUMLHTTPError) as excinfo:
+            await plantuml.render_pages(source, client)
+        assert excinfo.value.diagram_error_line == 6
+
+        # Inlined includes move the lines, so none is reported
+        (tmp_path / "style.iuml").write_text("skinparam a b\nskinparam c d")
+        with_includes = PlantUML("http://example.com/svg", includes=IncludeResolver([str(tmp_path)]))
+        with pytest.raises(PlantUMLHTTPError) as excinfo:
+            await with_includes.render_pages(source.replace("A -> B", "!include style.iuml"), client)
+        assert excinfo.value.diagram_error_line is None
+
+@pytest.mark.asyncio
+async def test_deadline_middleware_cancels_on_timeout_and_disconnect():
+    import asyncio
+    from fastapi import FastAPI
+    from server import deadline
+    from server.deadline import DeadlineMiddleware
+
+    events = []
+    slow = FastAPI()
+
+    @slow.post("/slow")
+    async def slow_endpoint():
+        events.append(round(deadline.remaining()))
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+
+    async def call(headers, disconnect_after):
+        sent = []
+        messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.sleep(disconnect_after)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/slow", "raw_path": b"/slow", "root_path": "",
+                 "query_string": b"", "headers": headers, "http_version": "1.1", "scheme": "http",
+                 "server": ("testserver", 80), "client": ("127.0.0.1", 1)}
+        await DeadlineMiddleware(slow, default=30)(scope, receive, send)
+        return sent
+
+    # The header shortens the configured deadline; the client gets a 504
+    sent = await call([(b"x-request-timeout", b"0.05")], disconnect_after=10)
+    assert sent[0]["status"] == 504 and events == [0, "cancelled"]
+    # A disconnect stops the work without a response
+    events.clear()
+    assert await call([], disconnect_after=0.05) == []
+    assert events == [30, "cancelled"]
+    assert deadline.request_deadline("120", 30) == 30 and deadline.request_deadline("oops", 0) is None
+
+def test_decode_endpoint_rejects_decompression_bombs(monkeypatch):
+    import base64
+    import zlib
+    from D2.d2 import decode as d2_decode, encode as d2_encode
+    from server.inflate import DecodeLimitExceeded
+
+    state = serialize_state(generate_diagram_state("graph TD; Decode-->Me;"))
+    response = client.get("/decode", params={"url": f"https://mermaid.live/edit#{state}"})
+    assert response.json() == {"lang": "mermaid", "code": "graph TD; Decode-->Me;"}
+
+    monkeypatch.setenv("DECODE_MAX_BYTES", "65536")
+    bomb = base64.urlsafe_b64encode(zlib.compress(b"{" + b" " * 10_000_000, 9)).decode()
+    response = client.get("/decode", params={"url": f"https://mermaid.live/edit#pako:{bomb}"})
+    assert response.status_code == 413
+    assert client.get("/decode", params={"url": "https://example.com/x"}).status_code == 400
+    with pytest.raises(DecodeLimitExceeded):
+        d2_decode(d2_encode("x -> y\n" * 20000))
+    assert d2_decode(d2_encode("x -> y"), max_length=6) == "x -> y"
+    with pytest.raises(DecodeLimitExceeded):
+        PlantUML("http://example.com/svg").decode_and_inflate("~h" + "41" * 70000)
+
+def test_render_jobs_run_in_background_and_deduplicate(monkeypatch, tmp_path):
+    from server.jobs import JobStore
+    from . import app as app_module
+
+    calls = []
+    def fake_fetch(diagram, output_format):
+        calls.append(output_format)
+        return b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+    monkeypatch.setattr(app_module, "fetch_artifact", fake_fetch)
+    monkeypatch.setattr(app.state, "jobs", JobStore(str(tmp_path / "jobs.db")))
+    body = {"lang": "graphviz", "type": "class", "code": "digraph { job -> done }"}
+    with TestClient(app) as jobs_client:
+        response = jobs_client.post("/jobs?format=svg", json=body)
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+        for _ in range(200):
+            job = jobs_client.get(f"/jobs/{job_id}").json()
+            if job["status"] == "done":
+                break
+            time.sleep(0.01)
+        assert job["result"]["url"].startswith("https://kroki.io/graphviz/svg/")
+        assert jobs_client.get(job["artifact"]).content == b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+        # The same diagram is answered by the finished job
+        again = jobs_client.post("/jobs?format=svg", json=body)
+        assert again.status_code == 200 and again.json()["id"] == job_id
+        assert jobs_client.get("/jobs/unknown").status_code == 404
+    assert calls == ["svg"]
+
+@pytest.mark.asyncio
+async def test_running_jobs_keep_their_lease_and_throttling_is_bounded(tmp_path, monkeypatch):
+    import asyncio
+    from fastapi import HTTPException
+    from server.jobs import DONE, JobFailed, JobRunner, JobStore
+    from . import app as app_module
+
+    store = JobStore(str(tmp_path / "jobs.db"), lease=0.15)
+    async def slow(job_request):
+        await asyncio.sleep(0.5)
+        return {"url": "u"}, None
+    runner = JobRunner(store, slow, workers=1, poll=0.01)
+    job, _ = store.submit("hash", {"diagram": {}, "format": "svg"})
+    runner.start()
+    try:
+        await asyncio.sleep(0.35)
+        # Past the lease, but the runner renewed it: nobody else may take the job
+        assert await asyncio.to_thread(store.claim) is None
+        for _ in range(100):
+            if store.get(job["id"])["status"] == DONE:
+                break
+            await asyncio.sleep(0.02)
+        assert store.get(job["id"])["status"] == DONE
+    finally:
+        await runner.close()
+
+    sleeps = []
+    async def throttled(diagram, output_format):
+        raise HTTPException(status_code=429, detail="Too many requests.", headers={"Retry-After": "2"})
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+    monkeypatch.setattr(app_module, "render_job_once", throttled)
+    monkeypatch.setattr(app_module, "JOBS_MAX_THROTTLED", 5)
+    monkeypatch.setattr(app_module.asyncio, "sleep", fake_sleep)
+    with pytest.raises(JobFailed):
+        await app_module.render_job({"diagram": {"lang": "d2", "type": "class", "code": "a -> b"}, "format": "svg"})
+    assert sleeps == [2.0, 2.0]
+
+@pytest.mark.asyncio
+async def test_cancelled_render_jobs_go_back_to_the_queue(tmp_path):
+    import asyncio
+    import httpx
+    from server.jobs import QUEUED, JobRunner, JobStore
+    from server.pool import request_timeout
+
+    store = JobStore(str(tmp_path / "jobs.db"))
+    started = asyncio.Event()
+    timeouts = []
+    async def render(job_request):
+        timeouts.append(request_timeout(httpx.Client(timeout=10)))
+        started.set()
+        await asyncio.sleep(60)
+    runner = JobRunner(store, render, workers=1, poll=0.01, timeout=90)
+    job, _ = store.submit("hash", {"diagram": {}, "format": "svg"})
+    runner.start()
+    await asyncio.wait_for(started.wait(), 5)
+    await runner.close()
+    assert store.get(job["id"])["status"] == QUEUED
+    # Job fetches get the jobs' timeout, not the request one
+    assert timeouts[0].read == 90
+
+def test_memory_endpoints_attribute_growth_to_backends(monkeypatch):
+    from kroki.kroki import Kroki
+
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+    assert client.post("/admin/memory/start").status_code == 403
+    assert client.post("/admin/memory/start", headers=headers).json() == {"tracing": True}
+    try:
+        assert client.post("/admin/memory/snapshots/before", headers=headers).status_code == 200
+        kroki = Kroki(client=client)
+        retained = [kroki.deflate_and_encode("a -> b %d" % i * 50) for i in range(200)]
+        assert client.post("/admin/memory/snapshots/after", headers=headers).status_code == 200
+        report = client.get("/admin/memory?since=before&until=after", headers=headers).json()
+        assert report["groups"]["kroki"]["size"] > 0
+        assert report["top"][0]["group"] == "kroki"
+        assert client.get("/admin/memory?since=missing", headers=headers).status_code == 404
+    finally:
+        client.post("/admin/memory/stop", headers=headers)
+    assert client.get("/admin/memory", headers=headers).status_code == 409
+    assert retained
+
+def test_clients_close_only_their_own_http_client():
+    import httpx
+    from kroki.kroki import Kroki
+
+    shared = httpx.Client()
+    with Kroki(client=shared), PlantUML("http://localhost/plantuml/png", client=shared):
+        pass
+    assert not shared.is_closed
+    with Kroki() as kroki, PlantUML("http://localhost/plantuml/png") as plantuml:
+        pass
+    assert kroki.client.is_closed and plantuml.client.is_closed
+    shared.close()
+
+def test_clients_reach_renderers_on_unix_sockets(tmp_path):
+    import socketserver
+    import threading
+    from http.server import BaseHTTPRequestHandler
+    from kroki.kroki import Kroki
+    from server.pool import resolve_url, shared_client
+
+    paths = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_GET(self):
+            paths.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", "6")
+            self.end_headers()
+            self.wfile.write(b"<svg/>")
+        def address_string(self):
+            return "local"
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        # Pooled connections stay open after the test
+        daemon_threads = True
+        block_on_close = False
+
+    path = str(tmp_path / "renderer.sock")
+    server = Server(path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert Kroki(f"unix://{path}", client=shared_client()).render_diagram("graphviz", "digraph { a }") == b"<svg/>"
+        with PlantUML(f"unix://{path}/plantuml/svg") as plantuml:
+            assert plantuml.render("@startuml\nA -> B\n@enduml") == b"<svg/>"
+        assert paths[0].startswith("/graphviz/svg/") and paths[1].startswith("/plantuml/svg/")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert resolve_url("https://kroki.io") == "https://kroki.io"
+    with pytest.raises(ValueError):
+        resolve_url("unix://relative.sock")
+
+@pytest.mark.asyncio
+async def test_warm_up_targets_configured_upstreams_on_both_pools(monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from server import pool
+
+    monkeypatch.delenv("UPSTREAM_URLS", raising=False)
+    monkeypatch.setenv("PLANTUML_URL", "unix:///run/plantuml.sock/plantuml")
+    monkeypatch.delenv("KROKI_URL", raising=False)
+    assert pool.upstream_urls() == ["unix:///run/plantuml.sock/plantuml", "https://kroki.io"]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert await pool.apreconnect(f"http://127.0.0.1:{server.server_address[1]}", 2)
+        assert len(pool.shared_async_client()._transport._pool.connections) == 2
+    finally:
+        await pool.close_shared_async_client()
+        server.shutdown()
+        server.server_close()
+
+def test_unix_socket_urls_keep_proxies_from_the_environment(monkeypatch):
+    import httpx
+    from server import pool
+
+    nested = pool.resolve_url("unix:///run/my.socket/kroki.sock/plantuml/png")
+    host = httpx.URL(nested).host
+    assert pool._unix_sockets[host] == "/run/my.socket/kroki.sock"
+    assert nested == f"http://{host}/plantuml/png"
+    assert httpx.URL(pool.resolve_url("unix:///run/kroki.sock")).path == "/"
+
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy.internal:3128")
+    pool.close_shared_client()
+    try:
+        client = pool.shared_client()
+        # Sockets go to their own transport, everything else through the proxy
+        assert isinstance(client._transport_for_url(httpx.URL(nested)), pool.UnixSocketTransport)
+        proxied = client._transport_for_url(httpx.URL("https://kroki.io/graphviz/svg/x"))
+        assert proxied._pool._proxy_url.host == b"proxy.internal"
+    finally:
+        pool.close_shared_client()
+
+@pytest.mark.parametrize("lang", ["d2", "mermaid", "plantuml"])
+def test_compile_graph_streams_source_into_kroki_url(lang):
+    import base64
+    import zlib
+    from validation import validate_source
+
+    graph = {
+        "direction": "down",
+        "groups": [{"id": "backend", "label": "Back end", "style": {"fill": "#ffdef1"}},
+                   {"id": "data.stores", "parent": "backend"}],
+        "nodes": [{"id": "web app", "label": 'Web "app"', "shape": "person"},
+                  {"id": "api", "group": "backend", "style": {"stroke": "#000E3D", "bold": True}},
+                  {"id": "db", "group": "data.stores", "shape": "cylinder"}],
+        "edges": [{"source": "web app", "target": "api", "label": "HTTPS"},
+                  {"source": "api", "target": "db", "style": {"stroke-dash": 4}}],
+    }
+    response = client.post(f"/compile_graph?lang={lang}", json=graph)
+    assert response.status_code == 200
+    result = response.json()
+    validate_source(lang, result["content"])
+    encoded = result["url"].rsplit("/", 1)[1]
+    assert zlib.decompress(base64.urlsafe_b64decode(encoded)).decode() == result["content"]
+    assert result["playground"]
+    if lang == "d2":
+        assert 'web app: "Web \\"app\\"" {\n  shape: person\n}\n' in result["content"]
+        assert 'backend.api -> backend."data.stores".db: {\n  style.stroke-dash: 4\n}\n' in result["content"]
+
+    bad = {**graph, "nodes": graph["nodes"] + [{"id": "x", "style": {"colour": "red"}}]}
+    assert client.post(f"/compile_graph?lang={lang}", json=bad).json()["detail"] == "Unknown style keyword 'colour' on node 'x'"
+    reserved = {**graph, "nodes": [{"id": "label"}]}
+    assert client.post(f"/compile_graph?lang={lang}", json=reserved).status_code == 400
+    assert client.post("/compile_graph?lang=graphviz", json=graph).status_code == 422
+
+@pytest.mark.asyncio
+async def test_artifact_work_survives_a_cancelled_caller():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from server.artifacts import ArtifactOptimizer
+
+    optimizer = ArtifactOptimizer()
+    optimizer._pool = ThreadPoolExecutor(max_workers=1)
+    calls = []
+    def slow(data):
+        calls.append(data)
+        time.sleep(0.1)
+        return data.upper()
+    try:
+        first = asyncio.create_task(optimizer._run(b"key", slow, b"svg"))
+        second = asyncio.create_task(optimizer._run(b"key", slow, b"svg"))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        assert await second == b"SVG"
+        assert first.cancelled() and calls == [b"svg"]
+        assert optimizer.get(b"key") == b"SVG"
+    finally:
+        optimizer.close()
+
+@pytest.mark.asyncio
+async def test_artifact_workers_are_not_forked():
+    from server.artifacts import ArtifactOptimizer
+
+    optimizer = ArtifactOptimizer(max_workers=1)
+    try:
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg">  <g> </g>  </svg>'
+        assert len(await optimizer.optimize(svg, "svg")) < len(svg)
+        assert optimizer._pool._mp_context.get_start_method() in ("forkserver", "spawn")
+    finally:
+        optimizer.close()
@@ -0,0 +1,5 @@
+"""
+Offline structural validation of diagram sources.
+"""
+
+from .validation import DiagramSyntaxError, validate_source, VALIDATORS
@@ -0,0 +1,348 @@
+"""
+Offline structural checks for diagram sources.
+
+These checks are deliberately shallow: they catch the mistakes that make an
+upstream renderer fail outright (unbalanced blocks, missing headers, unknown
+style keys) without parsing the full grammar, so they cost microseconds and
+let the API answer with a 400 before any upstream round trip.
+"""
+
+import json
+import re
+from bisect import bisect_right
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.parsers import expat
+
+from D2.d2 import reserved_keywords, style_keywords
+
+
+class DiagramSyntaxError(ValueError):
+    """The diagram source is structurally invalid.
+
+    Attributes:
+        message: Human readable description of the problem.
+        line: 1-based line of the problem, None when unknown.
+        column: 1-based column of the problem, None when unknown.
+    """
+    def __init__(self, message: str, line: Optional[int], column: Optional[int]):
+        self.message = message
+        self.line = line
+        self.column = column
+        super(DiagramSyntaxError, self).__init__(
+            f"{message} (line {line}, column {column})" if line is not None else message)
+
+    def to_dict(self) -> Dict:
+        return {"message": self.message, "line": self.line, "column": self.column}
+
+
+def _error_at(code: str, pos: int, message: str) -> DiagramSyntaxError:
+    line_start = code.rfind("\n", 0, pos) + 1
+    return DiagramSyntaxError(message, code.count("\n", 0, pos) + 1, pos - line_start + 1)
+
+
+# PlantUML
+
+_PLANTUML_MARKER = re.compile(r"^[ \t]*@(start|end)(\w+)", re.MULTILINE)
+
+
+def validate_plantuml(code: str) -> None:
+    """Check that every ``@startX`` has a matching ``@endX``.
+
+    A source without any marker is fine: PlantUML treats it as one
+    ``@startuml`` diagram.
+    """
+    opened = None
+    for match in _PLANTUML_MARKER.finditer(code):
+        kind, name = match.group(1), match.group(2)
+        pos = match.start(1) - 1
+        if kind == "start":
+            if opened is not None:
+                raise _error_at(code, pos, f"@start{name} before @end{opened.group(2)}")
+            opened = match
+        elif opened is None:
+            raise _error_at(code, pos, f"@end{name} without @start{name}")
+        elif opened.group(2) != name:
+            raise _error_at(code, pos, f"@end{name} does not close @start{opened.group(2)}")
+        else:
+            opened = None
+    if opened is not None:
+        raise _error_at(code, opened.start(1) - 1, f"@start{opened.group(2)} is never closed")
+
+
+# Mermaid
+
+MERMAID_DIAGRAM_TYPES = {
+    "graph", "flowchart", "flowchart-elk", "sequenceDiagram", "classDiagram", "classDiagram-v2",
+    "stateDiagram", "stateDiagram-v2", "erDiagram", "journey", "gantt", "pie", "quadrantChart",
+    "requirementDiagram", "gitGraph", "C4Context", "C4Container", "C4Component", "C4Dynamic",
+    "C4Deployment", "mindmap", "timeline", "zenuml", "sankey-beta", "xychart-beta", "block-beta",
+    "packet-beta", "kanban", "architecture-beta", "radar-beta", "treemap-beta",
+}
+
+_MERMAID_HEADER = re.compile(r"[ \t]*([^\s;:]+)")
+
+
+def validate_mermaid(code: str) -> None:
+    """Check that the first statement names a known Mermaid diagram type."""
+    lines = code.split("\n")
+    index = 0
+    # Optional YAML front matter
+    if lines and lines[0].strip() == "---":
+        index = 1
+        while index < len(lines) and lines[index].strip() != "---":
+            index += 1
+        if index == len(lines):
+            raise DiagramSyntaxError("Front matter is never closed", 1, 1)
+        index += 1
+    for lineno in range(index, len(lines)):
+        line = lines[lineno]
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%"):
+            continue
+        header = _MERMAID_HEADER.match(line).group(1)
+        if header not in MERMAID_DIAGRAM_TYPES:
+            column = line.index(header) + 1
+            raise DiagramSyntaxError(f"Unknown Mermaid diagram type '{header}'", lineno + 1, column)
+        return
+    raise DiagramSyntaxError("Missing Mermaid diagram type", 1, 1)
+
+
+# Shared helpers for brace based languages
+
+_CLOSERS = {"}": "{", "]": "["}
+
+
+def _check_bracket(code: str, pos: int, stack: List[Tuple[str, int]]) -> None:
+    char = code[pos]
+    if char in "{[":
+        stack.append((char, pos))
+        return
+    if not stack:
+        raise _error_at(code, pos, f"Unexpected '{char}'")
+    opener, _ = stack.pop()
+    if opener != _CLOSERS[char]:
+        raise _error_at(code, pos, f"'{char}' does not close '{opener}'")
+
+
+def _check_closed(code: str, stack: List[Tuple[str, int]]) -> None:
+    if stack:
+        opener, pos = stack[-1]
+        raise _error_at(code, pos, f"'{opener}' is never closed")
+
+
+def _starts_token(code: str, pos: int) -> bool:
+    """Whether ``code[pos]`` is the first character of a D2 value or key."""
+    i = pos - 1
+    while i >= 0 and code[i] in " \t":
+        i -= 1
+    return i < 0 or code[i] in "\n:{[;,>-"
+
+
+# D2
+
+_D2_SPECIAL = re.compile(r"[\"'#|{}\[\]\n]")
+_D2_DOUBLE_QUOTED = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+_D2_SINGLE_QUOTED = re.compile(r"'(?:[^'\\\n]|\\.)*'")
+_D2_STYLE_OPEN = re.compile(r"(?:^|[\s.{;])style\s*:\s*$")
+_D2_STYLE_KEY = re.compile(r"[ \t]*([A-Za-z0-9_-]+)[ \t]*:")
+# Literal-first on purpose: a leading lookbehind makes the scan several times slower
+_D2_HOLDER = re.compile(r"(s(?:tyle|ource-arrowhead)|target-arrowhead)(?:\.([\w-]+)|[ \t]*:[ \t]*(?=[^\s{]))")
+
+
+def validate_d2(code: str) -> None:
+    """Check brace balance, quoting and the style/arrowhead keywords of ``D2/d2.py``."""
+    stack = []  # (bracket, position)
+    style_depths = set()  # stack depths of ``style: {`` blocks
+    ignored = []  # (start, end) of strings and comments
+    pos = 0
+    while True:
+        match = _D2_SPECIAL.search(code, pos)
+        if not match:
+            break
+        i = match.start()
+        char = code[i]
+        pos = i + 1
+        if char == "\n":
+            if len(stack) in style_depths:
+                key = _D2_STYLE_KEY.match(code, pos)
+                if key and key.group(1) not in style_keywords:
+                    raise _error_at(code, key.start(1), f"Unknown style keyword '{key.group(1)}'")
+        elif char == "#":
+            end = code.find("\n", i)
+            pos = len(code) if end < 0 else end
+            ignored.append((i, pos))
+        elif char == '"' and code.startswith('"""', i):
+            end = code.find('"""', i + 3)
+            if end < 0:
+                raise _error_at(code, i, "Block comment is never closed")
+            pos = end + 3
+            ignored.append((i, pos))
+        elif char in "\"'":
+            if char == "'" and not _starts_token(code, i):
+                continue
+            quoted = (_D2_DOUBLE_QUOTED if char == '"' else _D2_SINGLE_QUOTED).match(code, i)
+            if not quoted:
+                raise _error_at(code, i, "String is never closed")
+            pos = quoted.end()
+            ignored.append((i, pos))
+        elif char == "|":
+            if not _starts_token(code, i):
+                continue
+            end = i
+            while end < len(code) and code[end] == "|":
+                end += 1
+            delimiter = code[i:end]
+            close = code.find(delimiter, end)
+            if close < 0:
+                raise _error_at(code, i, "Block string is never closed")
+            pos = close + len(delimiter)
+            ignored.append((i, pos))
+        else:
+            if char == "{":
+                line_start = code.rfind("\n", 0, i) + 1
+                if _D2_STYLE_OPEN.search(code, line_start, i):
+                    style_depths.add(len(stack) + 1)
+            elif char == "}":
+                style_depths.discard(len(stack))
+            _check_bracket(code, i, stack)
+    _check_closed(code, stack)
+
+    starts = [start for start, _ in ignored]
+
+    def is_code(position: int) -> bool:
+        index = bisect_right(starts, position) - 1
+        return index < 0 or position >= ignored[index][1]
+
+    for match in _D2_HOLDER.finditer(code):
+        start = match.start()
+        if start and (code[start - 1].isalnum() or code[start - 1] in "_-") or not is_code(start):
+            continue
+        holder, key = match.groups()
+        if key is None:
+            if holder == "style":
+                raise _error_at(code, start, "'style' expects a map, not a value")
+        elif key not in (style_keywords if holder == "style" else reserved_keywords):
+            raise _error_at(code, match.start(2), f"Unknown {holder} keyword '{key}'")
+
+
+# Graphviz
+
+_DOT_SPECIAL = re.compile(r"[\"#/<{}\[\]\n]")
+_DOT_HEADER = re.compile(r"\s*(?:strict\s+)?(?:di)?graph\b", re.IGNORECASE)
+_DOT_QUOTED = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def validate_graphviz(code: str) -> None:
+    """Check the ``graph``/``digraph`` header and brace balance, skipping strings,
+    comments and HTML labels."""
+    pos = 0
+    # Leading comments are allowed before the header
+    while True:
+        stripped = code[pos:].lstrip()
+        pos = len(code) - len(stripped)
+        if stripped.startswith(("//", "#")):
+            end = code.find("\n", pos)
+            pos = len(code) if end < 0 else end
+        elif stripped.startswith("/*"):
+            end = code.find("*/", pos + 2)
+            pos = len(code) if end < 0 else end + 2
+        else:
+            break
+    if not _DOT_HEADER.match(code, pos):
+        raise _error_at(code, pos, "Expected 'graph' or 'digraph'")
+
+    stack = []
+    while True:
+        match = _DOT_SPECIAL.search(code, pos)
+        if not match:
+            break
+        i = match.start()
+        char = code[i]
+        pos = i + 1
+        if char == "\n":
+            continue
+        if char == "#":
+            if code.rfind("\n", 0, i) + 1 == i:
+                end = code.find("\n", i)
+                pos = len(code) if end < 0 else end
+        elif char == "/":
+            if code.startswith("//", i):
+                end = code.find("\n", i)
+                pos = len(code) if end < 0 else end
+            elif code.startswith("/*", i):
+                end = code.find("*/", i + 2)
+                if end < 0:
+                    raise _error_at(code, i, "Comment is never closed")
+                pos = end + 2
+        elif char == '"':
+            quoted = _DOT_QUOTED.match(code, i)
+            if not quoted:
+                raise _error_at(code, i, "String is never closed")
+            pos = quoted.end()
+        elif char == "<":
+            depth = 0
+            end = i
+            while end < len(code):
+                if code[end] == "<":
+                    depth += 1
+                elif code[end] == ">":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            if depth:
+                raise _error_at(code, i, "HTML label is never closed")
+            pos = end + 1
+        else:
+            _check_bracket(code, i, stack)
+    _check_closed(code, stack)
+
+
+# JSON and XML based languages
+
+def validate_json(code: str) -> None:
+    try:
+        json.loads(code)
+    except json.JSONDecodeError as e:
+        raise DiagramSyntaxError(e.msg, e.lineno, e.colno) from e
+
+
+def validate_xml(code: str) -> None:
+    parser = expat.ParserCreate()
+    try:
+        parser.Parse(code, True)
+    except expat.ExpatError as e:
+        raise DiagramSyntaxError(expat.errors.messages[e.code], e.lineno, e.offset + 1) from e
+
+
+VALIDATORS: Dict[str, Callable[[str], None]] = {
+    "plantuml": validate_plantuml,
+    "c4plantuml": validate_plantuml,
+    "mermaid": validate_mermaid,
+    "mermaidjs": validate_mermaid,
+    "d2lang": validate_d2,
+    "D2": validate_d2,
+    "d2": validate_d2,
+    "terrastruct": validate_d2,
+    "graphviz": validate_graphviz,
+    "vega": validate_json,
+    "vegalite": validate_json,
+    "excalidraw": validate_json,
+    "bpmn": validate_xml,
+}
+
+
+def validate_source(lang: str, code: str) -> None:
+    """
+    Run the structural check registered for ``lang``, if any.
+
+    Args:
+        lang: The diagram language as accepted by ``/generate_diagram``
+        code: The diagram source
+
+    Raises:
+        DiagramSyntaxError: If the source is structurally invalid
+    """
+    validator = VALIDATORS.get(lang)
+    if validator is not None:
+        validator(code)